@@ -24,7 +24,9 @@ import click
 
 from geomet_mapfile.util import utils
 from geomet_mapfile.mapfile import mapfile_
+from geomet_mapfile.optimize import data
 from geomet_mapfile.store import store
+from geomet_mapfile.tileindex import tileindex
 from geomet_mapfile.wsgi import serve
 
 
@@ -36,5 +38,7 @@ def cli():
 
 cli.add_command(utils)
 cli.add_command(mapfile_)
+cli.add_command(data)
 cli.add_command(store)
+cli.add_command(tileindex)
 cli.add_command(serve)
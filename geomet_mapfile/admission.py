@@ -0,0 +1,211 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Admission control of renders.
+#
+# Each concurrency limit is a set of slot files (e.g. render.0.lock to
+# render.7.lock for a limit of 8 concurrent renders). A render holds an
+# exclusive lock on one slot file of every limit it is subject to, so
+# limits are shared by all worker processes of a host, and slots held by
+# a worker which dies are released by the kernel.
+
+from contextlib import contextmanager
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# bounds of the delay between two attempts to acquire a slot (seconds)
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.05
+
+
+class AdmissionTimeout(Exception):
+    """Render could not be admitted before the queue timeout"""
+    pass
+
+
+def parse_limits(value):
+    """
+    Parse per request type limits
+
+    :param value: `str` of comma separated request=limit pairs
+                  (e.g. GetMap=8,GetFeatureInfo=4)
+
+    :returns: `dict` of request type to limit
+    """
+
+    limits = {}
+
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        request, limit = item.split('=')
+        limits[request.strip()] = int(limit)
+
+    return limits
+
+
+class AdmissionController:
+    """Caps the number of concurrent renders of a host"""
+
+    def __init__(self, lock_dir, max_renders=0, max_renders_per_request=None,
+                 max_renders_per_layer=0, timeout=10):
+        """
+        Initialize object
+
+        :param lock_dir: path to directory of slot files
+        :param max_renders: `int` of maximum concurrent renders
+                            (0 for no limit)
+        :param max_renders_per_request: `dict` of request type to maximum
+                                        concurrent renders
+        :param max_renders_per_layer: `int` of maximum concurrent renders
+                                      of a single layer (0 for no limit)
+        :param timeout: `float` of maximum time to wait for admission
+                        (seconds)
+
+        :returns: `geomet_mapfile.admission.AdmissionController`
+        """
+
+        self.lock_dir = lock_dir
+        self.max_renders = max_renders
+        self.max_renders_per_request = max_renders_per_request or {}
+        self.max_renders_per_layer = max_renders_per_layer
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def limits(self, request, layers=None):
+        """
+        Get the limits a render is subject to, from the most specific to
+        the least specific
+
+        :param request: `str` of request type (e.g. GetMap)
+        :param layers: `list` of requested layer names
+
+        :returns: `list` of (limit name, limit) tuples
+        """
+
+        limits = []
+
+        if self.max_renders_per_layer > 0:
+            for layer in sorted(set(layers or [])):
+                name = 'layer-{}'.format(re.sub(r'[^\w.-]', '_', layer))
+                limits.append((name, self.max_renders_per_layer))
+
+        if self.max_renders_per_request.get(request, 0) > 0:
+            limits.append(('request-{}'.format(request),
+                           self.max_renders_per_request[request]))
+
+        if self.max_renders > 0:
+            limits.append(('render', self.max_renders))
+
+        return limits
+
+    def _try_acquire(self, name, limit):
+        for slot in range(limit):
+            filepath = os.path.join(self.lock_dir,
+                                    '{}.{}.lock'.format(name, slot))
+            fh = open(filepath, 'w')
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fh.close()
+                continue
+            except BaseException:
+                fh.close()
+                raise
+            return fh
+
+        return None
+
+    def _update_gauges(self, queued=0, active=0):
+        with self._lock:
+            self.queued += queued
+            self.active += active
+            METRICS.gauge('admission.queued', self.queued)
+            METRICS.gauge('admission.active', self.active)
+
+    @contextmanager
+    def admit(self, request, layers=None):
+        """
+        Wait for a render slot of every applicable limit
+
+        :param request: `str` of request type (e.g. GetMap)
+        :param layers: `list` of requested layer names
+
+        :raises: `geomet_mapfile.admission.AdmissionTimeout` if the render
+                 is not admitted within the queue timeout
+        """
+
+        limits = self.limits(request, layers)
+
+        if not limits:
+            yield
+            return
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        interval = POLL_INTERVAL
+        slots = []
+
+        self._update_gauges(queued=1)
+        try:
+            for name, limit in limits:
+                while True:
+                    slot = self._try_acquire(name, limit)
+                    if slot is not None:
+                        slots.append(slot)
+                        break
+                    if time.monotonic() >= deadline:
+                        METRICS.incr('admission.rejected')
+                        METRICS.incr('admission.rejected.{}'.format(name))
+                        raise AdmissionTimeout(
+                            'Render not admitted within {}s ({})'.format(
+                                self.timeout, name))
+                    time.sleep(interval)
+                    interval = min(interval * 2, MAX_POLL_INTERVAL)
+        except BaseException:
+            for slot in slots:
+                slot.close()
+            raise
+        finally:
+            self._update_gauges(queued=-1)
+
+        METRICS.incr('admission.admitted')
+        METRICS.incr('admission.wait_seconds', time.monotonic() - start)
+
+        self._update_gauges(active=1)
+        try:
+            yield
+        finally:
+            self._update_gauges(active=-1)
+            for slot in reversed(slots):
+                slot.close()
@@ -0,0 +1,143 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Circuit breaker of calls to an outside service.
+#
+# After `failure_threshold` consecutive failures, the circuit opens and
+# calls fail right away for `reset_timeout` seconds, instead of tying up
+# workers waiting on a service which is down or overloaded. A single trial
+# call is then let through (half-open): the circuit closes if it succeeds,
+# and opens again otherwise.
+
+import logging
+import threading
+import time
+
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """Call rejected by an open circuit breaker"""
+    pass
+
+
+class CircuitBreaker:
+    """Circuit breaker of calls to an outside service"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        """
+        Initialize object
+
+        :param name: `str` of service name (for logs and metrics)
+        :param failure_threshold: `int` of consecutive failures opening
+                                  the circuit (0 to never open)
+        :param reset_timeout: `float` of time before a trial call once the
+                              circuit is open (seconds)
+
+        :returns: `geomet_mapfile.breaker.CircuitBreaker`
+        """
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        METRICS.gauge('{}.breaker_open'.format(self.name), 0)
+
+    def _set_state(self, state):
+        if state != self.state:
+            log = LOGGER.info if state == CLOSED else LOGGER.warning
+            log('{} circuit breaker {} (was {})'.format(
+                self.name, state, self.state))
+            self.state = state
+            METRICS.gauge('{}.breaker_open'.format(self.name),
+                          int(state != CLOSED))
+
+    def _before_call(self):
+        if self.state == CLOSED:
+            return
+
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if (self.state == OPEN and
+                    time.monotonic() - self.opened_at >= self.reset_timeout):
+                self._set_state(HALF_OPEN)
+                return
+            METRICS.incr('{}.breaker_rejected'.format(self.name))
+            raise CircuitOpenError(
+                '{} circuit breaker is open'.format(self.name))
+
+    def _on_success(self):
+        # nothing to reset while closed without failures (most calls)
+        if self.state == CLOSED and not self.failures:
+            return
+
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def _on_failure(self):
+        with self._lock:
+            self.failures += 1
+            METRICS.incr('{}.failures'.format(self.name))
+            if self.state == HALF_OPEN or all([
+                    self.failure_threshold > 0,
+                    self.failures >= self.failure_threshold]):
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def call(self, func, *args, expected=(), **kwargs):
+        """
+        Call a function through the circuit breaker
+
+        :param func: callable to call
+        :param expected: `tuple` of exception types which are not failures
+                         of the service (e.g. not found errors)
+
+        :raises: `geomet_mapfile.breaker.CircuitOpenError` if the circuit
+                 is open
+
+        :returns: result of function
+        """
+
+        self._before_call()
+
+        try:
+            result = func(*args, **kwargs)
+        except expected:
+            self._on_success()
+            raise
+        except Exception:
+            self._on_failure()
+            raise
+
+        self._on_success()
+
+        return result
@@ -0,0 +1,502 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+from collections import OrderedDict
+import fcntl
+from hashlib import sha256
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import unquote_plus
+
+from geomet_mapfile.metrics import METRICS
+from geomet_mapfile.snapshot import version_key, versioned_key
+from geomet_mapfile.util import atomic_write
+
+LOGGER = logging.getLogger(__name__)
+
+# number of disk writes between two disk tier eviction passes
+DISK_EVICTION_INTERVAL = 100
+
+# number of store generations kept in the store mapfile cache
+STORE_MAPFILE_CACHE_VERSIONS = 2
+
+# seconds a superseded store mapfile cache file is kept for readers
+STORE_MAPFILE_CACHE_GRACE = 60
+
+
+def normalize_query_string(query_string, exclude=None):
+    """
+    Normalize an OWS query string so that equivalent requests compare equal
+
+    :param query_string: `str` of request query string
+    :param exclude: `list` of (uppercase) parameter names to leave out
+
+    :returns: `str` of normalized query string
+    """
+
+    exclude = exclude or []
+
+    # same as parse_qsl(keep_blank_values=True), only unquoting encoded
+    # parameters, as this runs before every cache lookup
+    params = []
+    for pair in query_string.split('&'):
+        if not pair:
+            continue
+        key, _, value = pair.partition('=')
+        if '%' in pair or '+' in pair:
+            key, value = unquote_plus(key), unquote_plus(value)
+        key = key.upper()
+        if key not in exclude:
+            params.append((key, value))
+
+    return '&'.join('{}={}'.format(key, value)
+                    for key, value in sorted(params))
+
+
+def response_cache_key(query_string, *parts):
+    """
+    Build a response cache key
+
+    :param query_string: `str` of request query string
+    :param parts: additional values identifying the response (resolved
+                  data filepath, mapfile version, etc.)
+
+    :returns: `str` of cache key
+    """
+
+    key = '|'.join([normalize_query_string(query_string)] +
+                   [str(part) for part in parts])
+
+    return sha256(key.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier (memory and disk) LRU cache of rendered OWS responses"""
+
+    def __init__(self, memory_size, disk_dir=None, disk_size=0):
+        """
+        Initialize object
+
+        :param memory_size: `int` of maximum memory tier size in bytes
+        :param disk_dir: path to disk tier directory (disabled if `None`)
+        :param disk_size: `int` of maximum disk tier size in bytes
+
+        :returns: `geomet_mapfile.cache.ResponseCache`
+        """
+
+        self.memory_size = memory_size
+        self.disk_dir = disk_dir
+        self.disk_size = disk_size
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_writes = 0
+
+        if self.disk_dir is not None and not os.path.exists(self.disk_dir):
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """
+        Get a cached response
+
+        :param key: `str` of cache key
+
+        :returns: `tuple` of content type and content, or `None`
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                METRICS.incr('response_cache.memory.hits')
+                return self._entries[key]
+
+        value = self._disk_get(key)
+
+        if value is None:
+            METRICS.incr('response_cache.misses')
+            return None
+
+        METRICS.incr('response_cache.disk.hits')
+        self._memory_set(key, value)
+
+        return value
+
+    def set(self, key, content_type, content):
+        """
+        Cache a response
+
+        :param key: `str` of cache key
+        :param content_type: `str` of response content type
+        :param content: `bytes` of response content
+
+        :returns: `None`
+        """
+
+        value = (content_type, content)
+
+        METRICS.incr('response_cache.stores')
+        self._memory_set(key, value)
+        self._disk_set(key, value)
+
+    def stats(self):
+        """
+        Get cache statistics
+
+        :returns: `dict` of cache statistics
+        """
+
+        with self._lock:
+            entries = len(self._entries)
+            bytes_ = self._bytes
+
+        hits = ['response_cache.memory.hits', 'response_cache.disk.hits']
+        counters = METRICS.snapshot()['counters']
+        hit_count = sum(counters.get(hit, 0) for hit in hits)
+        misses = counters.get('response_cache.misses', 0)
+
+        return {
+            'memory_entries': entries,
+            'memory_bytes': bytes_,
+            'hits': hit_count,
+            'misses': misses,
+            'hit_ratio': (hit_count / (hit_count + misses)
+                          if hit_count + misses else 0.0)
+        }
+
+    def _memory_set(self, key, value):
+        size = len(value[1])
+
+        if size > self.memory_size:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key)[1])
+
+            self._entries[key] = value
+            self._bytes += size
+
+            while self._bytes > self.memory_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[1])
+                METRICS.incr('response_cache.memory.evictions')
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_get(self, key):
+        if self.disk_dir is None:
+            return None
+
+        filepath = self._disk_path(key)
+
+        try:
+            with open(filepath, 'rb') as fh:
+                content_type = fh.readline().decode().rstrip('\n')
+                content = fh.read()
+            # bump access time for LRU eviction
+            os.utime(filepath)
+        except FileNotFoundError:
+            return None
+
+        return content_type, content
+
+    def _disk_set(self, key, value):
+        if self.disk_dir is None or len(value[1]) > self.disk_size:
+            return
+
+        filepath = self._disk_path(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write('{}\n'.format(value[0]).encode())
+                fh.write(value[1])
+            os.replace(tmp_filepath, filepath)
+        except OSError as err:
+            LOGGER.warning('Could not write cache entry: {}'.format(err))
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            return
+
+        with self._lock:
+            self._disk_writes += 1
+            evict = self._disk_writes % DISK_EVICTION_INTERVAL == 0
+
+        if evict:
+            self.evict_disk()
+
+    def evict_disk(self):
+        """
+        Remove least recently used disk tier entries until the disk tier
+        fits in its configured size
+
+        :returns: `int` of number of evicted entries
+        """
+
+        if self.disk_dir is None:
+            return 0
+
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.disk_dir):
+            for file_ in files:
+                filepath = os.path.join(root, file_)
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filepath))
+                total += stat.st_size
+
+        evicted = 0
+        for mtime, size, filepath in sorted(entries):
+            if total <= self.disk_size:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+        if evicted:
+            LOGGER.debug('Evicted {} disk cache entries'.format(evicted))
+            METRICS.incr('response_cache.disk.evictions', evicted)
+
+        return evicted
+
+
+class StoreMapfileCache:
+    """
+    Host-local cache of store mapfiles, shared by all worker processes.
+
+    Mapfiles are fetched from the store by a single process and written to
+    files keyed by store generation and mapfile content version, which all
+    processes then load by path. A store write only invalidates the
+    mapfiles it changed, and a process only checks the content version of
+    a mapfile against the store once per store revision.
+
+    Superseded files are removed once older than
+    `STORE_MAPFILE_CACHE_GRACE` seconds, so that a path returned to a
+    reader is not removed while the reader loads it.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Initialize object
+
+        :param cache_dir: path to cache directory
+
+        :returns: `geomet_mapfile.cache.StoreMapfileCache`
+        """
+
+        self.cache_dir = cache_dir
+
+        self._lock = threading.Lock()
+        self._known = {}
+
+    def get(self, store, key, generation, revision):
+        """
+        Get a store mapfile
+
+        :param store: store plugin
+        :param key: `str` of mapfile key (e.g. GDPS.ETA_TT_mapfile)
+        :param generation: `int` of current store generation (or `None`)
+        :param revision: `int` of current store revision
+
+        :returns: `str` of cached mapfile path, mapfile content if it could
+                  not be cached, or `None` if key is not in store
+        """
+
+        with self._lock:
+            known = self._known.get(key)
+
+        if (known is not None and known[0] == (generation, revision) and
+                os.path.exists(known[1])):
+            METRICS.incr('store_mapfile_cache.hits')
+            return known[1]
+
+        version = None
+        if generation is not None:
+            version = store.get_key(version_key(key, generation))
+        if version is None:
+            # mapfile written without content version
+            version = 'r{}'.format(revision)
+
+        generation_dir = os.path.join(self.cache_dir, str(generation or 0))
+        filepath = os.path.join(generation_dir,
+                                '{}.{}.map'.format(key, version))
+
+        if os.path.exists(filepath):
+            METRICS.incr('store_mapfile_cache.hits')
+            self._remember(key, generation, revision, filepath)
+            return filepath
+
+        try:
+            os.makedirs(generation_dir)
+        except FileExistsError:
+            pass
+        else:
+            self.evict(generation or 0)
+
+        content = None
+        lock_filepath = '{}.lock'.format(filepath)
+        try:
+            with open(lock_filepath, 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # another process may have cached the mapfile meanwhile
+                    if os.path.exists(filepath):
+                        METRICS.incr('store_mapfile_cache.hits')
+                        self._remember(key, generation, revision, filepath)
+                        return filepath
+
+                    content = store.get_key(versioned_key(key, generation))
+                    METRICS.incr('store_mapfile_cache.misses')
+                    if content is None:
+                        return None
+
+                    atomic_write(filepath, content)
+                finally:
+                    # processes waiting on the lock find the mapfile
+                    # cached, later ones do not need the lock
+                    if os.path.exists(lock_filepath):
+                        os.remove(lock_filepath)
+        except OSError as err:
+            # e.g. generation evicted by a process with a newer generation
+            LOGGER.warning('Could not cache {}: {}'.format(key, err))
+            if content is None:
+                content = store.get_key(versioned_key(key, generation))
+            return content
+
+        self._remember(key, generation, revision, filepath)
+        self.evict_superseded(filepath, key)
+
+        return filepath
+
+    def _remember(self, key, generation, revision, filepath):
+        with self._lock:
+            self._known[key] = ((generation, revision), filepath)
+
+    def cached(self, generation):
+        """
+        Count the cached mapfiles of a store generation
+
+        :param generation: `int` of store generation (or `None`)
+
+        :returns: `int` of number of cached mapfiles
+        """
+
+        try:
+            filenames = os.listdir(os.path.join(self.cache_dir,
+                                                str(generation or 0)))
+        except FileNotFoundError:
+            return 0
+
+        return len([name for name in filenames if name.endswith('.map')])
+
+    def evict_superseded(self, filepath, key):
+        """
+        Remove the cached versions of a mapfile superseded by a newer one
+        for longer than the grace period
+
+        :param filepath: path to current version of mapfile
+        :param key: `str` of mapfile key
+
+        :returns: `int` of number of evicted versions
+        """
+
+        generation_dir, current = os.path.split(filepath)
+        prefix = '{}.'.format(key)
+
+        versions = []
+        for name in os.listdir(generation_dir):
+            version = name[len(prefix):-len('.map')]
+            if (name == current or not name.startswith(prefix) or
+                    not name.endswith('.map') or '.' in version):
+                continue
+            try:
+                versions.append((os.stat(
+                    os.path.join(generation_dir, name)).st_mtime, name))
+            except FileNotFoundError:
+                continue
+
+        # the most recent previous version was current until now
+        superseded = sorted(versions, reverse=True)[1:]
+        threshold = time.time() - STORE_MAPFILE_CACHE_GRACE
+
+        evicted = 0
+        for mtime, name in superseded:
+            if mtime > threshold:
+                continue
+            try:
+                os.remove(os.path.join(generation_dir, name))
+            except FileNotFoundError:
+                continue
+            evicted += 1
+
+        return evicted
+
+    def evict(self, current):
+        """
+        Remove cached generations older than the most recent ones, once
+        unused for longer than the grace period
+
+        :param current: `int` of current generation
+
+        :returns: `int` of number of evicted generations
+        """
+
+        generations = []
+        for name in os.listdir(self.cache_dir):
+            try:
+                generations.append((int(name), name))
+            except ValueError:
+                continue
+
+        older = sorted(
+            (generation, name) for generation, name in generations
+            if generation < current
+        )
+        candidates = older[:max(len(older) - STORE_MAPFILE_CACHE_VERSIONS + 1,
+                                0)]
+        threshold = time.time() - STORE_MAPFILE_CACHE_GRACE
+
+        evicted = 0
+        for generation, name in candidates:
+            generation_dir = os.path.join(self.cache_dir, name)
+            try:
+                if os.stat(generation_dir).st_mtime > threshold:
+                    continue
+            except FileNotFoundError:
+                continue
+            LOGGER.debug('Evicting store mapfile cache generation {}'.format(
+                name))
+            shutil.rmtree(generation_dir, ignore_errors=True)
+            evicted += 1
+
+        return evicted
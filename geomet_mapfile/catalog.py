@@ -0,0 +1,394 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import logging
+import os
+import pickle
+import struct
+import tempfile
+
+from yaml import CLoader, MappingNode, SequenceNode
+
+LOGGER = logging.getLogger(__name__)
+
+CATALOG_MAGIC = b'GMCATALOG2\n'
+
+HEADER_LENGTH = struct.Struct('>Q')
+
+METADATA_ENTRY = '__metadata__'
+
+
+def mapping_value(node, key):
+    """
+    Get the value node of a key of a YAML mapping node
+
+    :param node: `yaml.MappingNode` (or `None`)
+    :param key: `str` of key
+
+    :returns: value node, or `None`
+    """
+
+    if not isinstance(node, MappingNode):
+        return None
+
+    # merged keys come first, and are overridden by later keys
+    for key_node, value_node in reversed(node.value):
+        if key_node.value == key:
+            return value_node
+
+    return None
+
+
+class CatalogLoader(CLoader):
+    """
+    YAML loader which keeps track of the mappings merged into mappings
+    (`<<` merge keys)
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.merged_nodes = {}
+
+    def flatten_mapping(self, node):
+        merged = []
+        for key_node, value_node in node.value:
+            if key_node.tag == 'tag:yaml.org,2002:merge':
+                if isinstance(value_node, SequenceNode):
+                    merged.extend(value_node.value)
+                else:
+                    merged.append(value_node)
+        if merged:
+            self.merged_nodes[node] = merged
+
+        super().flatten_mapping(node)
+
+    def model_name(self, node, model_nodes):
+        """
+        Get the name of the forecast model a layer forecast_model refers to,
+        either as an alias or through merge keys
+
+        :param node: layer forecast_model node
+        :param model_nodes: `dict` of forecast model node to name
+
+        :returns: `str` of forecast model name, or `None`
+        """
+
+        nodes = [node]
+        while nodes:
+            node = nodes.pop(0)
+            if node in model_nodes:
+                return model_nodes[node]
+            nodes.extend(self.merged_nodes.get(node, []))
+
+        return None
+
+    def layer_models(self, root):
+        """
+        Get the forecast model of each layer. Layers refer to their forecast
+        model through YAML anchors, so models are matched by YAML node
+
+        :param root: root node of (constructed) configuration
+
+        :returns: `dict` of layer name to forecast model name
+        """
+
+        models = mapping_value(root, 'forecast_models')
+        model_nodes = {
+            value_node: key_node.value
+            for key_node, value_node in getattr(models, 'value', [])
+        }
+
+        layers = {}
+        for key_node, value_node in mapping_value(root, 'layers').value:
+            model = self.model_name(
+                mapping_value(value_node, 'forecast_model'), model_nodes)
+            if model is not None:
+                layers[key_node.value] = model
+
+        return layers
+
+
+def catalog_filepath(config, basedir):
+    """
+    Get the compiled catalog filepath of a configuration
+
+    :param config: path to YAML configuration
+    :param basedir: base directory of geomet-mapfile
+
+    :returns: `str` of catalog filepath
+    """
+
+    filename = '{}.catalog'.format(os.path.basename(config))
+
+    return os.path.join(basedir, 'catalog', filename)
+
+
+class LayerCatalog:
+    """
+    Compiled, layer-indexed version of the YAML configuration, with
+    anchors and merge keys already resolved.
+
+    The catalog is a header (configuration mtime/size, an index of layer
+    name to position and an index of forecast model to layer names)
+    followed by one pickled entry per layer, so that a single layer can be
+    loaded without reading the rest of the catalog.
+
+    Entries are read from the file the header was read from, which is kept
+    open, so that a catalog compiled meanwhile by another process (and
+    swapped in place) does not shift the entries of the loaded header.
+    """
+
+    def __init__(self, config, filepath):
+        """
+        Initialize object
+
+        :param config: path to YAML configuration
+        :param filepath: path to compiled catalog
+
+        :returns: `geomet_mapfile.catalog.LayerCatalog`
+        """
+
+        self.config = config
+        self.filepath = filepath
+        self.header = None
+        self._data_offset = None
+        self._entries = {}
+        self._fh = None
+
+    def _source_stat(self):
+        stat = os.stat(self.config)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load_header(self):
+        """
+        Read the catalog header
+
+        :returns: `bool` of whether the catalog exists and is up to date
+        """
+
+        try:
+            fh = open(self.filepath, 'rb')
+        except FileNotFoundError:
+            return False
+
+        try:
+            if fh.read(len(CATALOG_MAGIC)) != CATALOG_MAGIC:
+                LOGGER.warning('Invalid catalog {}'.format(self.filepath))
+                fh.close()
+                return False
+            length = HEADER_LENGTH.unpack(fh.read(HEADER_LENGTH.size))[0]
+            header = pickle.loads(fh.read(length))
+        except (pickle.UnpicklingError, struct.error, EOFError) as err:
+            LOGGER.warning('Could not read catalog {}: {}'.format(
+                self.filepath, err))
+            fh.close()
+            return False
+
+        if (header['mtime'], header['size']) != self._source_stat():
+            LOGGER.debug('Catalog {} is stale'.format(self.filepath))
+            fh.close()
+            return False
+
+        self.close()
+        self._fh = fh
+        self._entries = {}
+        self.header = header
+        self._data_offset = (len(CATALOG_MAGIC) + HEADER_LENGTH.size +
+                             length)
+
+        return True
+
+    def compile(self):
+        """
+        Resolve the YAML configuration and write the catalog
+
+        :returns: `dict` of resolved configuration
+        """
+
+        LOGGER.info('Compiling {} to {}'.format(self.config, self.filepath))
+
+        mtime, size = self._source_stat()
+
+        with open(self.config) as fh:
+            loader = CatalogLoader(fh)
+            try:
+                root = loader.get_single_node()
+                cfg = loader.construct_document(root)
+                layer_models = loader.layer_models(root)
+            finally:
+                loader.dispose()
+
+        entries = [(METADATA_ENTRY, cfg['metadata'])]
+        entries.extend(cfg['layers'].items())
+
+        models = {}
+        for name in cfg['layers']:
+            if name in layer_models:
+                models.setdefault(layer_models[name], []).append(name)
+
+        index = {}
+        blobs = []
+        offset = 0
+        for name, value in entries:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            index[name] = (offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+
+        header = {
+            'config': self.config,
+            'mtime': mtime,
+            'size': size,
+            'layers': list(cfg['layers'].keys()),
+            'models': models,
+            'index': index
+        }
+        header_blob = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+
+        fd, tmp_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(self.filepath))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(CATALOG_MAGIC)
+                fh.write(HEADER_LENGTH.pack(len(header_blob)))
+                fh.write(header_blob)
+                for blob in blobs:
+                    fh.write(blob)
+            os.replace(tmp_filepath, self.filepath)
+        except OSError as err:
+            LOGGER.warning('Could not write catalog {}: {}'.format(
+                self.filepath, err))
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+        # keep the resolved configuration for use in this process, all
+        # entries are in memory so the catalog file is not read
+        self.close()
+        self.header = header
+        self._data_offset = (len(CATALOG_MAGIC) + HEADER_LENGTH.size +
+                             len(header_blob))
+        self._entries = dict(entries)
+
+        return cfg
+
+    @property
+    def layer_names(self):
+        """`list` of layer names, in configuration order"""
+
+        return self.header['layers']
+
+    @property
+    def model_names(self):
+        """`list` of forecast model names"""
+
+        return list(self.header['models'].keys())
+
+    def get_model_layers(self, model):
+        """
+        Get the layer names of a forecast model
+
+        :param model: `str` of forecast model name
+                      (key of configuration forecast_models)
+
+        :returns: `list` of layer names
+        """
+
+        return self.header['models'][model]
+
+    def close(self):
+        """
+        Close the catalog file
+
+        :returns: `None`
+        """
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _read(self, names):
+        for name in names:
+            if name not in self._entries:
+                offset, length = self.header['index'][name]
+                # positional reads, as the file may be shared by forked
+                # processes
+                self._entries[name] = pickle.loads(os.pread(
+                    self._fh.fileno(), length, self._data_offset + offset))
+
+        return {name: self._entries[name] for name in names}
+
+    @property
+    def metadata(self):
+        """`dict` of configuration metadata section"""
+
+        return self._read([METADATA_ENTRY])[METADATA_ENTRY]
+
+    def get_layer(self, name):
+        """
+        Get the resolved configuration of a single layer
+
+        :param name: `str` of layer name
+
+        :returns: `dict` of layer configuration
+        """
+
+        if name not in self.header['index'] or name == METADATA_ENTRY:
+            raise KeyError(name)
+
+        return self._read([name])[name]
+
+    def get_layers(self, names=None):
+        """
+        Get the resolved configuration of many layers
+
+        :param names: `list` of layer names (all layers if `None`)
+
+        :returns: `dict` of layer name to layer configuration
+        """
+
+        if names is None:
+            names = self.layer_names
+
+        for name in names:
+            if name not in self.header['index'] or name == METADATA_ENTRY:
+                raise KeyError(name)
+
+        return self._read(names)
+
+
+def load_catalog(config, basedir):
+    """
+    Load the compiled catalog of a configuration, compiling it if it does
+    not exist or if the configuration changed since it was compiled
+
+    :param config: path to YAML configuration
+    :param basedir: base directory of geomet-mapfile
+
+    :returns: `geomet_mapfile.catalog.LayerCatalog`
+    """
+
+    catalog = LayerCatalog(config, catalog_filepath(config, basedir))
+
+    if not catalog.load_header():
+        catalog.compile()
+
+    return catalog
@@ -0,0 +1,197 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# minimum size of the smallest overview (pixels)
+MIN_OVERVIEW_SIZE = 256
+
+
+def overview_levels(width, height, min_size=MIN_OVERVIEW_SIZE):
+    """
+    Get the overview levels of a raster
+
+    :param width: `int` of raster width
+    :param height: `int` of raster height
+    :param min_size: `int` of minimum size of the smallest overview
+
+    :returns: `list` of overview decimation factors
+    """
+
+    levels = []
+    level = 2
+
+    while max(width, height) / level >= min_size:
+        levels.append(level)
+        level *= 2
+
+    return levels
+
+
+class DatasetCache:
+    """
+    Per-worker LRU cache of opened GDAL datasets, keyed by filepath and
+    modification time so that replaced files are reopened
+    """
+
+    def __init__(self, size=32, shared=False):
+        """
+        Initialize object
+
+        :param size: `int` of maximum number of open datasets
+        :param shared: `bool` of whether datasets are opened in shared
+                       mode, so that GDAL (and MapServer rendering in the
+                       same thread) reuses them while they are cached
+
+        :returns: `geomet_mapfile.dataset.DatasetCache`
+        """
+
+        self.size = size
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._datasets = OrderedDict()
+
+    def _get(self, filepath):
+        try:
+            key = (filepath, os.stat(filepath).st_mtime_ns)
+        except OSError:
+            key = (filepath, None)
+
+        with self._lock:
+            entry = self._datasets.get(key)
+            if entry is not None:
+                self._datasets.move_to_end(key)
+                METRICS.incr('dataset_cache.hits')
+                METRICS.incr('dataset_cache.saved_seconds', entry[2])
+                return entry
+
+            # a replaced file must not be served from its previous
+            # dataset, which GDAL would otherwise share
+            for stale in [k for k in self._datasets if k[0] == filepath]:
+                del self._datasets[stale]
+
+        METRICS.incr('dataset_cache.misses')
+
+        start = time.monotonic()
+        if self.shared:
+            dataset = gdal.OpenShared(filepath)
+        else:
+            dataset = gdal.Open(filepath)
+        open_time = time.monotonic() - start
+        METRICS.incr('dataset_cache.open_seconds', open_time)
+
+        if dataset is None:
+            return None
+
+        entry = (dataset, threading.Lock(), open_time)
+        with self._lock:
+            entry = self._datasets.setdefault(key, entry)
+            while len(self._datasets) > self.size:
+                self._datasets.popitem(last=False)
+
+        return entry
+
+    @contextmanager
+    def open(self, filepath):
+        """
+        Open a dataset, or reuse a cached one. A dataset is used by a single
+        thread at a time
+
+        :param filepath: path to raster file
+
+        :returns: context manager of `osgeo.gdal.Dataset`, or of `None`
+                  if the file cannot be opened
+        """
+
+        entry = self._get(filepath)
+
+        if entry is None:
+            yield None
+            return
+
+        with entry[1]:
+            yield entry[0]
+
+    def hold(self, filepath):
+        """
+        Keep a dataset open (or reopen it if its file was replaced), for
+        other users of the GDAL shared dataset (i.e. MapServer) to reuse
+
+        :param filepath: path to raster file
+
+        :returns: `bool` of whether the dataset is open
+        """
+
+        return self._get(filepath) is not None
+
+
+class ThreadDatasetCache(threading.local):
+    """
+    Per-thread shared dataset caches, as GDAL only shares datasets within
+    the thread which opened them
+    """
+
+    def __init__(self, size=32):
+        """
+        Initialize object
+
+        :param size: `int` of maximum number of open datasets per thread
+
+        :returns: `geomet_mapfile.dataset.ThreadDatasetCache`
+        """
+
+        self.cache = DatasetCache(size, shared=True)
+
+    def open(self, filepath):
+        """
+        Open a dataset in the current thread, or reuse a cached one
+
+        :param filepath: path to raster file
+
+        :returns: context manager of `osgeo.gdal.Dataset`, or of `None`
+                  if the file cannot be opened
+        """
+
+        return self.cache.open(filepath)
+
+    def hold(self, filepath):
+        """
+        Keep a dataset open in the current thread
+
+        :param filepath: path to raster file
+
+        :returns: `bool` of whether the dataset is open
+        """
+
+        return self.cache.hold(filepath)
@@ -36,10 +36,64 @@ STORE_URL = os.environ.get('GEOMET_MAPFILE_STORE_URL', None)
 TILEINDEX_NAME = os.environ.get('GEOMET_MAPFILE_TILEINDEX_NAME', None)
 TILEINDEX_TYPE = os.environ.get('GEOMET_MAPFILE_TILEINDEX_TYPE', None)
 TILEINDEX_URL = os.environ.get('GEOMET_MAPFILE_TILEINDEX_URL', None)
+TILEINDEX_REPLICA = os.environ.get('GEOMET_MAPFILE_TILEINDEX_REPLICA', None)
+TILEINDEX_TIMEOUT = float(os.environ.get(
+    'GEOMET_MAPFILE_TILEINDEX_TIMEOUT', 0))
+TILEINDEX_BREAKER_THRESHOLD = int(os.environ.get(
+    'GEOMET_MAPFILE_TILEINDEX_BREAKER_THRESHOLD', 0))
+TILEINDEX_BREAKER_RESET = float(os.environ.get(
+    'GEOMET_MAPFILE_TILEINDEX_BREAKER_RESET', 30))
+TILEINDEX_STALE_CACHE = int(os.environ.get(
+    'GEOMET_MAPFILE_TILEINDEX_STALE_CACHE', 0))
+TILEINDEX_STALE_TTL = float(os.environ.get(
+    'GEOMET_MAPFILE_TILEINDEX_STALE_TTL', 0))
 MAPFILE_STORAGE = os.environ.get('GEOMET_MAPFILE_STORAGE', 'file')
 ALLOW_LAYER_DATA_DOWNLOAD = str2bool(os.environ.get(
     'GEOMET_MAPFILE_ALLOW_LAYER_DATA_DOWNLOAD', False))
 CELERY_BROKER_URL = os.environ.get('GEOMET_CELERY_BROKER_URL', None)
+RESPONSE_CACHE = str2bool(os.environ.get(
+    'GEOMET_MAPFILE_RESPONSE_CACHE', False))
+RESPONSE_CACHE_MEMORY_SIZE = int(os.environ.get(
+    'GEOMET_MAPFILE_RESPONSE_CACHE_MEMORY_SIZE', 67108864))
+RESPONSE_CACHE_DIR = os.environ.get('GEOMET_MAPFILE_RESPONSE_CACHE_DIR', None)
+RESPONSE_CACHE_DISK_SIZE = int(os.environ.get(
+    'GEOMET_MAPFILE_RESPONSE_CACHE_DISK_SIZE', 1073741824))
+METATILE_SIZE = int(os.environ.get('GEOMET_MAPFILE_METATILE_SIZE', 0))
+METATILE_BUFFER = int(os.environ.get('GEOMET_MAPFILE_METATILE_BUFFER', 64))
+REFRESH_BATCH_WINDOW = float(os.environ.get(
+    'GEOMET_MAPFILE_REFRESH_BATCH_WINDOW', 5))
+STORE_MAPFILE_CACHE = str2bool(os.environ.get(
+    'GEOMET_MAPFILE_STORE_MAPFILE_CACHE', False))
+STORE_MAPFILE_CACHE_DIR = os.environ.get(
+    'GEOMET_MAPFILE_STORE_MAPFILE_CACHE_DIR', None)
+STREAMING_THRESHOLD = int(os.environ.get(
+    'GEOMET_MAPFILE_STREAMING_THRESHOLD', 8388608))
+MAX_RENDERS = int(os.environ.get('GEOMET_MAPFILE_MAX_RENDERS', 0))
+MAX_RENDERS_PER_REQUEST = os.environ.get(
+    'GEOMET_MAPFILE_MAX_RENDERS_PER_REQUEST', None)
+MAX_RENDERS_PER_LAYER = int(os.environ.get(
+    'GEOMET_MAPFILE_MAX_RENDERS_PER_LAYER', 0))
+ADMISSION_TIMEOUT = float(os.environ.get(
+    'GEOMET_MAPFILE_ADMISSION_TIMEOUT', 10))
+ADMISSION_DIR = os.environ.get('GEOMET_MAPFILE_ADMISSION_DIR', None)
+REQUEST_COLLAPSING = str2bool(os.environ.get(
+    'GEOMET_MAPFILE_REQUEST_COLLAPSING', False))
+REQUEST_COLLAPSING_STORE = str2bool(os.environ.get(
+    'GEOMET_MAPFILE_REQUEST_COLLAPSING_STORE', False))
+REQUEST_COLLAPSING_TIMEOUT = float(os.environ.get(
+    'GEOMET_MAPFILE_REQUEST_COLLAPSING_TIMEOUT', 10))
+LEGEND_CACHE = str2bool(os.environ.get('GEOMET_MAPFILE_LEGEND_CACHE', False))
+FEATUREINFO_FAST_PATH = str2bool(os.environ.get(
+    'GEOMET_MAPFILE_FEATUREINFO_FAST_PATH', False))
+DATASET_CACHE_SIZE = int(os.environ.get(
+    'GEOMET_MAPFILE_DATASET_CACHE_SIZE', 0))
+OPTIMIZE_DATA = str2bool(os.environ.get(
+    'GEOMET_MAPFILE_OPTIMIZE_DATA', False))
+OPTIMIZED_DATA_DIR = os.environ.get('GEOMET_MAPFILE_OPTIMIZED_DATA_DIR', None)
+PREWARP_CRS = os.environ.get('GEOMET_MAPFILE_PREWARP_CRS', '')
+PREWARP_GRID_DISK_SIZE = int(os.environ.get(
+    'GEOMET_MAPFILE_PREWARP_GRID_DISK_SIZE', 1073741824))
+READINESS_TTL = float(os.environ.get('GEOMET_MAPFILE_READINESS_TTL', 5))
 
 LOGGER.debug(BASEDIR)
 LOGGER.debug(CONFIG)
@@ -47,9 +101,41 @@ LOGGER.debug(STORE_TYPE)
 LOGGER.debug(STORE_URL)
 LOGGER.debug(TILEINDEX_NAME)
 LOGGER.debug(TILEINDEX_URL)
+LOGGER.debug(TILEINDEX_REPLICA)
+LOGGER.debug(TILEINDEX_TIMEOUT)
+LOGGER.debug(TILEINDEX_BREAKER_THRESHOLD)
+LOGGER.debug(TILEINDEX_BREAKER_RESET)
+LOGGER.debug(TILEINDEX_STALE_CACHE)
+LOGGER.debug(TILEINDEX_STALE_TTL)
 LOGGER.debug(MAPFILE_STORAGE)
 LOGGER.debug(ALLOW_LAYER_DATA_DOWNLOAD)
 LOGGER.debug(CELERY_BROKER_URL)
+LOGGER.debug(RESPONSE_CACHE)
+LOGGER.debug(RESPONSE_CACHE_MEMORY_SIZE)
+LOGGER.debug(RESPONSE_CACHE_DIR)
+LOGGER.debug(RESPONSE_CACHE_DISK_SIZE)
+LOGGER.debug(METATILE_SIZE)
+LOGGER.debug(METATILE_BUFFER)
+LOGGER.debug(REFRESH_BATCH_WINDOW)
+LOGGER.debug(STORE_MAPFILE_CACHE)
+LOGGER.debug(STORE_MAPFILE_CACHE_DIR)
+LOGGER.debug(STREAMING_THRESHOLD)
+LOGGER.debug(MAX_RENDERS)
+LOGGER.debug(MAX_RENDERS_PER_REQUEST)
+LOGGER.debug(MAX_RENDERS_PER_LAYER)
+LOGGER.debug(ADMISSION_TIMEOUT)
+LOGGER.debug(ADMISSION_DIR)
+LOGGER.debug(REQUEST_COLLAPSING)
+LOGGER.debug(REQUEST_COLLAPSING_STORE)
+LOGGER.debug(REQUEST_COLLAPSING_TIMEOUT)
+LOGGER.debug(LEGEND_CACHE)
+LOGGER.debug(FEATUREINFO_FAST_PATH)
+LOGGER.debug(DATASET_CACHE_SIZE)
+LOGGER.debug(OPTIMIZE_DATA)
+LOGGER.debug(OPTIMIZED_DATA_DIR)
+LOGGER.debug(PREWARP_CRS)
+LOGGER.debug(PREWARP_GRID_DISK_SIZE)
+LOGGER.debug(READINESS_TTL)
 
 if None in [BASEDIR, CONFIG]:
     msg = 'Environment variables not set!'
@@ -0,0 +1,698 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# GetFeatureInfo of raster layers by direct point sampling.
+#
+# The value of the pixel under the requested point is read with GDAL and
+# classified with the layer classes, and the response is formatted as
+# MapServer formats raster query results (items x, y, value_<band>,
+# value_list, class, red, green, blue). Requests which cannot be answered
+# the same way as MapServer raise FeatureInfoUnsupported and are
+# dispatched to MapServer.
+
+import ast
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+import json
+import logging
+import math
+import operator
+import re
+import struct
+import threading
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = osr = None
+
+from geomet_mapfile.dataset import DatasetCache
+from geomet_mapfile.util import DATEFORMAT
+
+LOGGER = logging.getLogger(__name__)
+
+INFO_FORMATS = ['text/plain', 'application/json']
+
+TIME_SERIES_INFO_FORMATS = ['text/plain', 'text/csv', 'application/json']
+
+# maximum number of time steps of a time series request
+MAX_TIME_STEPS = 1000
+
+# number of threads sampling the files of a time series
+SAMPLE_THREADS = 8
+
+DATASETS = DatasetCache()
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge
+}
+
+# per-thread spatial references and coordinate transformations, which
+# are not thread-safe
+_SRS = threading.local()
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+class FeatureInfoUnsupported(Exception):
+    """Request cannot be answered by point sampling"""
+    pass
+
+
+@lru_cache(maxsize=4096)
+def compile_expression(expression):
+    """
+    Compile a MapServer class expression on raster values
+
+    :param expression: `str` of class expression
+                       (e.g. ( ( [pixel] >= 0 ) AND ( [pixel] < 5 ) ))
+
+    :returns: callable of pixel value returning `bool`
+    """
+
+    if expression is None:
+        return lambda pixel: True
+
+    source = expression.strip()
+    if source.startswith('"') and source.endswith('"'):
+        source = source[1:-1]
+
+    source = re.sub(r'\[pixel\]', 'pixel', source)
+    source = re.sub(r'\bAND\b', ' and ', source, flags=re.IGNORECASE)
+    source = re.sub(r'\bOR\b', ' or ', source, flags=re.IGNORECASE)
+    source = re.sub(r'(?<![<>!=])=(?!=)', '==', source)
+    source = source.replace('^', '**')
+
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        raise FeatureInfoUnsupported(
+            'Unsupported expression {}'.format(expression))
+
+    def evaluate(node, pixel):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body, pixel)
+        if isinstance(node, ast.BoolOp):
+            values = (evaluate(value, pixel) for value in node.values)
+            if isinstance(node.op, ast.And):
+                return all(values)
+            return any(values)
+        if isinstance(node, ast.Compare):
+            left = evaluate(node.left, pixel)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = evaluate(comparator, pixel)
+                if not OPERATORS[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.BinOp):
+            return OPERATORS[type(node.op)](evaluate(node.left, pixel),
+                                            evaluate(node.right, pixel))
+        if isinstance(node, ast.UnaryOp):
+            return OPERATORS[type(node.op)](evaluate(node.operand, pixel))
+        if isinstance(node, ast.Name):
+            return pixel
+        return node.value
+
+    allowed = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.Compare,
+               ast.BinOp, ast.UnaryOp, ast.Load) + tuple(OPERATORS.keys())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == 'pixel':
+            continue
+        if isinstance(node, ast.Constant) and isinstance(
+                node.value, (int, float)):
+            continue
+        if not isinstance(node, allowed):
+            raise FeatureInfoUnsupported(
+                'Unsupported expression {}'.format(expression))
+
+    return lambda pixel: evaluate(tree, pixel)
+
+
+def compile_classes(classes, classgroup=None):
+    """
+    Compile the classes of a layer which apply to a class group
+
+    :param classes: `list` of (name, group, expression, (red, green, blue))
+    :param classgroup: `str` of class group (`None` for all classes)
+
+    :returns: `list` of (name, (red, green, blue), callable)
+    """
+
+    return [
+        (name, color, compile_expression(expression))
+        for name, group, expression, color in classes
+        if not classgroup or group == classgroup
+    ]
+
+
+def classify(value, classes):
+    """
+    Find the first class matching a value
+
+    :param value: `float` of pixel value
+    :param classes: `list` of compiled classes
+
+    :returns: `tuple` of class name and (red, green, blue), or `None`
+    """
+
+    for name, color, expression in classes:
+        if expression(value):
+            return name, color
+
+    return None
+
+
+def request_point(params):
+    """
+    Get the map coordinates of the point of a GetFeatureInfo request
+
+    :param params: `dict` of (uppercase) request parameters
+
+    :returns: `tuple` of x, y and `str` of CRS
+    """
+
+    version = params.get('VERSION', '1.3.0')
+    crs = (params.get('CRS') or params.get('SRS') or '').upper()
+
+    try:
+        bbox = [float(value) for value in params['BBOX'].split(',')]
+        width = int(params['WIDTH'])
+        height = int(params['HEIGHT'])
+        if version == '1.3.0':
+            i, j = int(params['I']), int(params['J'])
+        else:
+            i, j = int(params['X']), int(params['Y'])
+    except (KeyError, ValueError):
+        raise FeatureInfoUnsupported('Invalid GetFeatureInfo parameters')
+
+    if len(bbox) != 4 or not crs:
+        raise FeatureInfoUnsupported('Invalid GetFeatureInfo parameters')
+
+    if crs == 'CRS:84':
+        crs = 'EPSG:4326'
+    elif version == '1.3.0' and axis_inverted(crs):
+        bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+
+    minx, miny, maxx, maxy = bbox
+
+    # MapServer queries the center of the pixel
+    x = minx + (i + 0.5) * (maxx - minx) / width
+    y = maxy - (j + 0.5) * (maxy - miny) / height
+
+    return x, y, crs
+
+
+def axis_inverted(crs):
+    """
+    Check whether a CRS uses northing/easting (lat/lon) axis order in
+    WMS 1.3.0
+
+    :param crs: `str` of CRS (e.g. EPSG:4326)
+
+    :returns: `bool` of whether axis order is inverted
+    """
+
+    if crs == 'EPSG:4326':
+        return True
+
+    if osr is None or not crs.startswith('EPSG:'):
+        return False
+
+    srs = osr.SpatialReference()
+    if srs.SetFromUserInput(crs) != 0:
+        return False
+
+    return bool(srs.EPSGTreatsAsLatLong() or
+                srs.EPSGTreatsAsNorthingEasting())
+
+
+def _srs_cache():
+    # spatial references and transformations of the current thread
+    if not hasattr(_SRS, 'cache'):
+        _SRS.cache = {}
+
+    return _SRS.cache
+
+
+def spatial_reference(definition):
+    """
+    Get the (cached, per thread) spatial reference of a CRS or a
+    MapServer projection
+
+    :param definition: `str` of CRS or PROJ definition
+
+    :returns: `osgeo.osr.SpatialReference`
+    """
+
+    cache = _srs_cache()
+
+    if definition not in cache:
+        cache[definition] = build_spatial_reference(definition)
+
+    return cache[definition]
+
+
+def build_spatial_reference(definition):
+    """
+    Build a spatial reference from a CRS or a MapServer projection
+
+    :param definition: `str` of CRS or PROJ definition
+
+    :returns: `osgeo.osr.SpatialReference`
+    """
+
+    match = re.match(r'^\+?init=epsg:(\d+)$', definition.strip(),
+                     re.IGNORECASE)
+    if match is not None:
+        definition = 'EPSG:{}'.format(match.group(1))
+
+    srs = osr.SpatialReference()
+    if srs.SetFromUserInput(definition) != 0:
+        raise FeatureInfoUnsupported(
+            'Unsupported projection {}'.format(definition))
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return srs
+
+
+def transform(source, target):
+    """
+    Get a (cached, per thread) coordinate transformation
+
+    :param source: `str` of source CRS or PROJ definition
+    :param target: `str` of target CRS or PROJ definition
+
+    :returns: `osgeo.osr.CoordinateTransformation`, or `None` if source
+              and target are the same
+    """
+
+    if source == target:
+        return None
+
+    cache = _srs_cache()
+    key = (source, target)
+
+    if key not in cache:
+        cache[key] = osr.CoordinateTransformation(
+            spatial_reference(source), spatial_reference(target))
+
+    return cache[key]
+
+
+def transform_point(x, y, source, target):
+    """
+    Transform a point between CRSs
+
+    :param x: `float` of point x coordinate
+    :param y: `float` of point y coordinate
+    :param source: `str` of source CRS or PROJ definition
+    :param target: `str` of target CRS or PROJ definition
+
+    :returns: `tuple` of x, y in target CRS
+    """
+
+    ct = transform(source, target)
+    if ct is None:
+        return x, y
+
+    return tuple(ct.TransformPoint(x, y)[:2])
+
+
+def sample(filepath, x, y, crs, projection, bands=None):
+    """
+    Read the values of the pixel under a point
+
+    :param filepath: path to raster file
+    :param x: `float` of point x coordinate
+    :param y: `float` of point y coordinate
+    :param crs: `str` of point CRS
+    :param projection: `str` of raster PROJ definition
+    :param bands: `list` of band numbers (all bands if `None`)
+
+    :returns: `tuple` of pixel center x, y (raster CRS) and `list` of band
+              values, or `None` if the point is outside of the raster or
+              on a nodata value
+    """
+
+    x, y = transform_point(x, y, crs, projection)
+
+    with DATASETS.open(filepath) as dataset:
+        if dataset is None:
+            raise FeatureInfoUnsupported('Cannot open {}'.format(filepath))
+
+        geotransform = dataset.GetGeoTransform()
+        inverse = gdal.InvGeoTransform(geotransform)
+
+        candidates = [x]
+        if spatial_reference(projection).IsGeographic():
+            # grids may use 0/360 longitudes
+            candidates.extend([x + 360, x - 360])
+
+        for x_ in candidates:
+            col, row = gdal.ApplyGeoTransform(inverse, x_, y)
+            col, row = int(math.floor(col)), int(math.floor(row))
+            if all([0 <= col < dataset.RasterXSize,
+                    0 <= row < dataset.RasterYSize]):
+                break
+        else:
+            return None
+
+        values = []
+        for band_number in bands or range(1, dataset.RasterCount + 1):
+            band = dataset.GetRasterBand(band_number)
+            data = band.ReadRaster(col, row, 1, 1,
+                                   buf_type=gdal.GDT_Float64)
+            value = struct.unpack('d', data)[0]
+            if value == band.GetNoDataValue() or math.isnan(value):
+                return None
+            values.append(value)
+
+    center_x, center_y = gdal.ApplyGeoTransform(geotransform, col + 0.5,
+                                                row + 0.5)
+
+    return center_x, center_y, values
+
+
+def format_items(x, y, values, class_):
+    """
+    Build the items of a raster query result, as MapServer does
+
+    :param x: `float` of pixel center x coordinate
+    :param y: `float` of pixel center y coordinate
+    :param values: `list` of band values
+    :param class_: `tuple` of class name and (red, green, blue), or `None`
+
+    :returns: `list` of (item name, `str` value)
+    """
+
+    items = [('x', '%.8g' % x), ('y', '%.8g' % y)]
+
+    for band, value in enumerate(values):
+        items.append(('value_{}'.format(band), '%.8g' % value))
+
+    items.append(('value_list', ','.join('%.8g' % value
+                                         for value in values)))
+
+    if class_ is not None:
+        name, color = class_
+        items.append(('class', name or ''))
+        items.extend(zip(['red', 'green', 'blue'],
+                         ['%d' % component for component in color]))
+
+    return items
+
+
+def format_response(layer, items, info_format, x=None, y=None):
+    """
+    Format a GetFeatureInfo response
+
+    :param layer: `str` of layer name
+    :param items: `list` of (item name, value), or `None` if no results
+    :param info_format: `str` of INFO_FORMAT
+    :param x: `float` of point x coordinate (request CRS)
+    :param y: `float` of point y coordinate (request CRS)
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    if info_format == 'application/json':
+        features = []
+        if items is not None:
+            features.append({
+                'type': 'Feature',
+                'properties': dict(items),
+                'geometry': {'type': 'Point', 'coordinates': [x, y]}
+            })
+        content = json.dumps({
+            'type': 'FeatureCollection',
+            'name': layer,
+            'features': features
+        })
+        return 'application/json; subtype=geojson', content.encode()
+
+    lines = ['GetFeatureInfo results:']
+    if items is None:
+        lines.extend(['', '  Search returned no results.'])
+    else:
+        lines.extend(['', "Layer '{}'".format(layer), '  Feature 0: '])
+        lines.extend("    {} = '{}'".format(name, value)
+                     for name, value in items)
+
+    return 'text/plain; charset=UTF-8', '\n'.join(lines + ['']).encode()
+
+
+def feature_info(filepath, layer, projection, classes, params, bands=None):
+    """
+    Answer a GetFeatureInfo request by point sampling
+
+    :param filepath: path to raster file
+    :param layer: `str` of layer name
+    :param projection: `str` of layer PROJ definition
+    :param classes: `list` of compiled layer classes
+    :param params: `dict` of (uppercase) request parameters
+    :param bands: `list` of band numbers (all bands if `None`)
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    if gdal is None:
+        raise FeatureInfoUnsupported('GDAL is not available')
+
+    info_format = params.get('INFO_FORMAT', 'text/plain')
+    if info_format not in INFO_FORMATS:
+        raise FeatureInfoUnsupported(
+            'Unsupported INFO_FORMAT {}'.format(info_format))
+
+    x, y, crs = request_point(params)
+
+    items = None
+    result = sample(filepath, x, y, crs, projection, bands)
+
+    if result is not None:
+        center_x, center_y, values = result
+        class_ = classify(values[0], classes) if classes else None
+        # MapServer drops pixels which do not match any class
+        if class_ is not None or not classes:
+            items = format_items(center_x, center_y, values, class_)
+
+    return format_response(layer, items, info_format, x, y)
+
+
+def parse_period(period):
+    """
+    Parse an ISO 8601 duration of days, hours and/or minutes
+
+    :param period: `str` of duration (e.g. PT3H, P1D)
+
+    :returns: `datetime.timedelta`
+    """
+
+    match = re.match(r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?)?$', period)
+
+    if match is None or not any(match.groups()):
+        raise FeatureInfoUnsupported('Unsupported period {}'.format(period))
+
+    days, hours, minutes = [int(value or 0) for value in match.groups()]
+
+    return timedelta(days=days, hours=hours, minutes=minutes)
+
+
+def is_time_series(time):
+    """
+    Check whether a TIME parameter requests many times
+
+    :param time: `str` of TIME parameter value
+
+    :returns: `bool` of whether TIME is a range or a list
+    """
+
+    return time is not None and ('/' in time or ',' in time)
+
+
+def expand_times(time, time_extent=None, available_times=None):
+    """
+    Expand the TIME parameter of a time series request
+
+    :param time: `str` of TIME parameter value: a list of times, a
+                 start/end range, or a start/end/period range
+    :param time_extent: `str` of layer time extent (start/end/period)
+    :param available_times: `str` of comma separated layer times
+
+    :returns: `list` of `str` of times
+    """
+
+    try:
+        if ',' in time:
+            times = [datetime.strptime(value.strip(), DATEFORMAT)
+                     for value in time.split(',')]
+        else:
+            parts = time.split('/')
+            start = datetime.strptime(parts[0], DATEFORMAT)
+            end = datetime.strptime(parts[1], DATEFORMAT)
+
+            if len(parts) == 3:
+                step = parse_period(parts[2])
+                times = []
+                while start <= end and len(times) <= MAX_TIME_STEPS:
+                    times.append(start)
+                    start += step
+            elif available_times:
+                times = [
+                    value
+                    for value in (datetime.strptime(value, DATEFORMAT)
+                                  for value in available_times.split(','))
+                    if start <= value <= end
+                ]
+            elif time_extent:
+                extent_start, extent_end, period = time_extent.split('/')
+                value = datetime.strptime(extent_start, DATEFORMAT)
+                extent_end = datetime.strptime(extent_end, DATEFORMAT)
+                step = parse_period(period)
+                times = []
+                while value <= min(end, extent_end):
+                    if value >= start:
+                        times.append(value)
+                    value += step
+            else:
+                raise FeatureInfoUnsupported('Layer has no time extent')
+    except (IndexError, ValueError):
+        raise FeatureInfoUnsupported('Invalid TIME {}'.format(time))
+
+    if not times or len(times) > MAX_TIME_STEPS:
+        raise FeatureInfoUnsupported(
+            'TIME must select 1 to {} times'.format(MAX_TIME_STEPS))
+
+    return [value.strftime(DATEFORMAT) for value in times]
+
+
+def executor():
+    """
+    Get the thread pool sampling time series files
+
+    :returns: `concurrent.futures.ThreadPoolExecutor`
+    """
+
+    global _EXECUTOR
+
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(SAMPLE_THREADS)
+
+    return _EXECUTOR
+
+
+def time_series(layer, times, filepaths, projection, classes, params,
+                reference_time=None, bands=None):
+    """
+    Answer a time series GetFeatureInfo request by point sampling
+
+    :param layer: `str` of layer name
+    :param times: `list` of `str` of times
+    :param filepaths: `list` of paths to raster files of times (`None`
+                      for times without data)
+    :param projection: `str` of layer PROJ definition
+    :param classes: `list` of compiled layer classes
+    :param params: `dict` of (uppercase) request parameters
+    :param reference_time: `str` of model run of series
+    :param bands: `list` of band numbers (all bands if `None`)
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    if gdal is None:
+        raise FeatureInfoUnsupported('GDAL is not available')
+
+    info_format = params.get('INFO_FORMAT', 'text/plain')
+    if info_format not in TIME_SERIES_INFO_FORMATS:
+        raise FeatureInfoUnsupported(
+            'Unsupported INFO_FORMAT {}'.format(info_format))
+
+    x, y, crs = request_point(params)
+
+    # the point is transformed once, files are sampled in the raster CRS
+    raster_x, raster_y = transform_point(x, y, crs, projection)
+
+    def sample_(filepath):
+        if filepath is None:
+            return None
+        try:
+            result = sample(filepath, raster_x, raster_y, projection,
+                            projection, bands)
+        except FeatureInfoUnsupported as err:
+            LOGGER.debug(err)
+            return None
+        if result is None:
+            return None
+        value = result[2][0]
+        if not classes:
+            return value, None
+        class_ = classify(value, classes)
+        # as in feature_info, values which do not match any class are
+        # dropped
+        if class_ is None:
+            return None
+        return value, class_[0]
+
+    results = list(executor().map(sample_, filepaths))
+
+    series = [
+        {
+            'time': time,
+            'value': result[0] if result is not None else None,
+            'class': result[1] if result is not None else None
+        }
+        for time, result in zip(times, results)
+    ]
+
+    if info_format == 'application/json':
+        content = json.dumps({
+            'layer': layer,
+            'reference_time': reference_time,
+            'crs': crs,
+            'coordinates': [x, y],
+            'series': series
+        })
+        return 'application/json', content.encode()
+
+    lines = ['time,value,class']
+    for item in series:
+        lines.append('{},{},{}'.format(
+            item['time'],
+            '%.8g' % item['value'] if item['value'] is not None else '',
+            json.dumps(item['class']) if item['class'] is not None else ''
+        ))
+
+    return ('{}; charset=UTF-8'.format(info_format),
+            '\n'.join(lines + ['']).encode())
@@ -0,0 +1,214 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Collapsing of identical in-flight renders.
+#
+# Within a worker, the first request of a given key renders while identical
+# requests wait for its result. Across workers, the leader is elected with
+# a short-lived store lock (geomet-mapfile_flight_<key>) and publishes its
+# result to a short-lived store key (geomet-mapfile_flight_<key>_result)
+# which the other workers poll.
+
+import base64
+import json
+import logging
+import threading
+import time
+
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# time to live of store locks and results (seconds)
+LOCK_TTL = 30
+RESULT_TTL = 5
+
+# largest result shared through the store (bytes)
+RESULT_MAX_SIZE = 4194304
+
+# delay between two polls of the store for a result (seconds)
+POLL_INTERVAL = 0.01
+
+
+class Flight:
+    """In-flight render"""
+
+    def __init__(self):
+        """
+        Initialize object
+
+        :returns: `geomet_mapfile.flight.Flight`
+        """
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def encode_result(result):
+    """
+    Serialize a render result for the store
+
+    :param result: `tuple` of content type and `bytes` of content
+
+    :returns: `str` of serialized result
+    """
+
+    content_type, content = result
+
+    return json.dumps({
+        'content_type': content_type,
+        'content': base64.b64encode(content).decode()
+    })
+
+
+def decode_result(value):
+    """
+    Deserialize a render result from the store
+
+    :param value: `str` of serialized result
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    result = json.loads(value)
+
+    return result['content_type'], base64.b64decode(result['content'])
+
+
+class SingleFlight:
+    """Collapses identical concurrent renders into a single render"""
+
+    def __init__(self, store=None, timeout=10):
+        """
+        Initialize object
+
+        :param store: store plugin to collapse renders across workers
+                      (`None` to collapse renders within the worker only)
+        :param timeout: `float` of maximum time to wait for the result of
+                        another render before rendering (seconds)
+
+        :returns: `geomet_mapfile.flight.SingleFlight`
+        """
+
+        self.store = store
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def in_flight(self):
+        """
+        Count the renders in flight in the worker
+
+        :returns: `int` of number of renders in flight
+        """
+
+        with self._lock:
+            return len(self._flights)
+
+    def do(self, key, func):
+        """
+        Render, or wait for the result of an identical in-flight render
+
+        :param key: `str` of render key (normalized request)
+        :param func: callable rendering the request, returning a `tuple`
+                     of content type and `bytes` of content
+
+        :returns: `tuple` of content type and `bytes` of content
+        """
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            METRICS.incr('single_flight.waits')
+            if flight.done.wait(self.timeout):
+                if flight.error is not None:
+                    raise flight.error
+                METRICS.incr('single_flight.collapsed')
+                return flight.result
+            LOGGER.debug('Timed out waiting for in-flight render')
+            return func()
+
+        try:
+            flight.result = self._lead(key, func)
+            return flight.result
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key, func):
+        if self.store is None:
+            return func()
+
+        lock_key = 'flight_{}'.format(key)
+        result_key = 'flight_{}_result'.format(key)
+
+        try:
+            locked = self.store.set_key_nx(lock_key, 1, LOCK_TTL)
+        except Exception as err:
+            LOGGER.warning('Could not lock render in store: {}'.format(err))
+            return func()
+
+        if locked:
+            try:
+                result = func()
+                if len(result[1]) <= RESULT_MAX_SIZE:
+                    # other workers render themselves once the lock is
+                    # released without a result
+                    try:
+                        self.store.set_key(result_key, encode_result(result),
+                                           expire=RESULT_TTL)
+                    except Exception as err:
+                        LOGGER.warning(
+                            'Could not publish render to store: {}'.format(
+                                err))
+                return result
+            finally:
+                try:
+                    self.store.delete_key(lock_key)
+                except Exception as err:
+                    # lock expires after LOCK_TTL
+                    LOGGER.warning(
+                        'Could not unlock render in store: {}'.format(err))
+
+        # another worker is rendering: wait for its result
+        METRICS.incr('single_flight.remote_waits')
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            values = self.store.get_keys([result_key, lock_key])
+            if values[result_key] is not None:
+                METRICS.incr('single_flight.remote_collapsed')
+                return decode_result(values[result_key])
+            if values[lock_key] is None:
+                # render finished without a shareable result
+                break
+            time.sleep(POLL_INTERVAL)
+
+        return func()
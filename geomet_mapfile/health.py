@@ -0,0 +1,193 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Health and readiness of WSGI workers.
+#
+# Health only tells that the worker answers. Readiness runs dependency
+# checks (mapfiles, store, tile index) and reports their latency; a worker
+# whose failing dependencies have a fallback is degraded, not unready. As load
+# balancers probe often, the readiness report is refreshed at most every
+# `ttl` seconds, and probes arriving while it is refreshed get the previous
+# report instead of waiting.
+
+import logging
+import os
+import threading
+import time
+
+from geomet_data_registry.tileindex.base import TileNotFoundError
+
+from geomet_mapfile.metrics import METRICS
+from geomet_mapfile.snapshot import current_generation
+
+LOGGER = logging.getLogger(__name__)
+
+# identifier looked up to check the tile index (not expected to exist)
+PROBE_IDENTIFIER = 'geomet-mapfile-readiness-probe'
+
+
+def check_mapfiles(mapfile_dir):
+    """
+    Check mapfiles on disk
+
+    :param mapfile_dir: path to mapfile directory (BASEDIR/mapfile)
+
+    :raises: `FileNotFoundError` if the mapfile directory does not exist
+
+    :returns: `dict` of mapfile version in use (`None` if the mapfile
+              directory is not versioned)
+    """
+
+    if not os.path.isdir(mapfile_dir):
+        raise FileNotFoundError('No mapfile directory {}'.format(
+            mapfile_dir))
+
+    version = None
+    if os.path.islink(mapfile_dir):
+        version = os.path.basename(os.path.realpath(mapfile_dir))
+
+    return {'version': version}
+
+
+def check_store(store):
+    """
+    Check the store
+
+    :param store: store plugin
+
+    :returns: `dict` of current store generation and revision
+    """
+
+    generation, revision = current_generation(store)
+
+    return {'generation': generation, 'revision': revision}
+
+
+def check_tileindex(tileindex):
+    """
+    Check the tile index, through its circuit breaker (so that a successful
+    check closes an open circuit once the reset timeout has elapsed)
+
+    :param tileindex: `geomet_mapfile.tileindex.guard.GuardedTileIndex`
+
+    :raises: `geomet_mapfile.breaker.CircuitOpenError` if the circuit is
+             open
+
+    :returns: `dict` of circuit breaker state
+    """
+
+    try:
+        tileindex.breaker.call(
+            lambda: tileindex.tileindex.get(PROBE_IDENTIFIER),
+            expected=(TileNotFoundError,))
+    except TileNotFoundError:
+        pass
+
+    return {'breaker': tileindex.breaker.state}
+
+
+def run_checks(checks, optional=None):
+    """
+    Run dependency checks
+
+    :param checks: `dict` of check name to callable returning a `dict` of
+                   check details, and raising on failure
+    :param optional: `list` of names of checks whose failure degrades
+                     the worker without making it unready (e.g. when
+                     requests can still be served from a fallback)
+
+    :returns: `tuple` of `bool` of whether all required checks passed,
+              `bool` of whether an optional check failed and `dict` of
+              check name to `dict` of check results
+    """
+
+    results = {}
+
+    for name, check in checks.items():
+        start = time.monotonic()
+        try:
+            result = dict(check() or {}, ok=True)
+        except Exception as err:
+            LOGGER.warning('Readiness check {} failed: {}'.format(name, err))
+            result = {'ok': False, 'error': '{}: {}'.format(
+                type(err).__name__, err)}
+        result['latency_ms'] = round((time.monotonic() - start) * 1000, 3)
+        results[name] = result
+
+    optional = optional or []
+
+    ready = all(result['ok'] for name, result in results.items()
+                if name not in optional)
+    degraded = not all(result['ok'] for name, result in results.items()
+                       if name in optional)
+
+    METRICS.gauge('health.ready', int(ready))
+    METRICS.gauge('health.degraded', int(degraded))
+
+    return ready, degraded, results
+
+
+class ReadinessProbe:
+    """Readiness report of the worker, refreshed at most every `ttl`"""
+
+    def __init__(self, report, ttl=5):
+        """
+        Initialize object
+
+        :param report: callable returning a `tuple` of `bool` of readiness
+                       and `dict` of readiness report
+        :param ttl: `float` of time during which a report is reused
+                    (seconds)
+
+        :returns: `geomet_mapfile.health.ReadinessProbe`
+        """
+
+        self.report = report
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = None
+
+    def get(self):
+        """
+        Get the readiness report
+
+        :returns: `tuple` of `bool` of readiness, `dict` of readiness report
+                  and `float` of report age (seconds)
+        """
+
+        result, checked_at = self._result, self._checked_at
+
+        if result is None or time.monotonic() - checked_at >= self.ttl:
+            # a single thread refreshes the report, others get the
+            # previous one (or wait for the first one)
+            if self._lock.acquire(blocking=result is None):
+                try:
+                    if (self._result is None or
+                            time.monotonic() - self._checked_at >= self.ttl):
+                        self._result = self.report()
+                        self._checked_at = time.monotonic()
+                        METRICS.incr('health.checks')
+                    result, checked_at = self._result, self._checked_at
+                finally:
+                    self._lock.release()
+
+        return result[0], result[1], time.monotonic() - checked_at
@@ -0,0 +1,283 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Pre-rendered GetLegendGraphic responses.
+#
+# A legend only depends on the layer type, classes (styles) and layer
+# parameters, which are shared by many layers. Legends are rendered once
+# per distinct legend key (hash of those inputs), style, format and
+# language to BASEDIR/legend/<key>/<style>_<lang>.<ext>, and
+# BASEDIR/legend/legends.json maps layer names to legend keys.
+
+from hashlib import sha256
+import json
+import logging
+import os
+import re
+import shutil
+from urllib.parse import urlencode
+
+try:
+    import mapscript
+except ImportError:
+    mapscript = None
+
+from geomet_mapfile.metrics import METRICS
+from geomet_mapfile.util import atomic_write
+
+LOGGER = logging.getLogger(__name__)
+
+LEGEND_INDEX = 'legends.json'
+
+LEGEND_FORMATS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif'
+}
+
+LANGUAGES = ['en', 'fr']
+
+# GetLegendGraphic parameters changing a legend beyond its layer, style,
+# format and language
+UNCACHED_PARAMS = ['RULE', 'SCALE', 'WIDTH', 'HEIGHT', 'SLD', 'SLD_BODY']
+
+
+def legend_key(layer_info, classes):
+    """
+    Build the legend key of a layer
+
+    :param layer_info: `dict` of layer configuration
+    :param classes: `list` of mappyfile class objects of layer
+
+    :returns: `str` of legend key
+    """
+
+    key = json.dumps({
+        'type': layer_info.get('type', 'RASTER').upper(),
+        'layer_params': layer_info.get('layer_params', []),
+        'classes': classes
+    }, sort_keys=True)
+
+    return sha256(key.encode()).hexdigest()
+
+
+def legend_styles(classes):
+    """
+    Get the styles (class groups) of a legend
+
+    :param classes: `list` of mappyfile class objects of layer
+
+    :returns: `list` of style names, in class order
+    """
+
+    styles = []
+
+    for class_ in classes:
+        group = class_.get('group')
+        if group is not None and group not in styles:
+            styles.append(group)
+
+    return styles
+
+
+def legend_filename(style, lang, format_):
+    """
+    Get the filename of a pre-rendered legend
+
+    :param style: `str` of style name (`None` for layer default style)
+    :param lang: `str` of language
+    :param format_: `str` of legend format (e.g. image/png)
+
+    :returns: `str` of legend filename
+    """
+
+    style = re.sub(r'[^\w.-]', '_', style) if style else 'default'
+
+    return '{}_{}.{}'.format(style, lang, LEGEND_FORMATS[format_])
+
+
+def render_legends(mapfile, legends, legend_dir, formats=None,
+                   languages=LANGUAGES):
+    """
+    Render legends and write the legend index
+
+    :param mapfile: `str` of mapfile with one layer per legend key
+    :param legends: `dict` of legend key to (layer name, `list` of styles)
+    :param legend_dir: path to legend directory
+    :param formats: `list` of legend formats (all supported if `None`)
+    :param languages: `list` of languages
+
+    :returns: `dict` of legend key to `dict` of filename to content type
+    """
+
+    if mapscript is None:
+        raise RuntimeError('mapscript is required to render legends')
+
+    formats = formats or list(LEGEND_FORMATS.keys())
+    m = mapscript.fromstring(mapfile)
+
+    rendered = {}
+
+    for key, (layer_name, styles) in legends.items():
+        key_dir = os.path.join(legend_dir, key)
+        os.makedirs(key_dir, exist_ok=True)
+        rendered[key] = {}
+
+        for style in [None] + styles:
+            for format_ in formats:
+                for lang in languages:
+                    params = {
+                        'SERVICE': 'WMS',
+                        'VERSION': '1.3.0',
+                        'REQUEST': 'GetLegendGraphic',
+                        'SLD_VERSION': '1.1.0',
+                        'LAYER': layer_name,
+                        'FORMAT': format_,
+                        'LANG': lang
+                    }
+                    if style is not None:
+                        params['STYLE'] = style
+
+                    request = mapscript.OWSRequest()
+                    request.loadParamsFromURL(urlencode(params))
+                    mapscript.msIO_installStdoutToBuffer()
+                    try:
+                        m.OWSDispatch(request)
+                    except (mapscript.MapServerError, IOError) as err:
+                        LOGGER.warning('Could not render legend of {}: '
+                                       '{}'.format(layer_name, err))
+                        continue
+                    headers = mapscript.msIO_getAndStripStdoutBufferMimeHeaders()  # noqa
+                    content = mapscript.msIO_getStdoutBufferBytes()
+
+                    content_type = headers.get('Content-Type', '')
+                    if not content_type.startswith('image/'):
+                        LOGGER.warning('Could not render legend of {}: '
+                                       '{}'.format(layer_name, content))
+                        continue
+
+                    filename = legend_filename(style, lang, format_)
+                    atomic_write(os.path.join(key_dir, filename), content)
+                    rendered[key][filename] = content_type
+
+    mapscript.msIO_resetHandlers()
+
+    return rendered
+
+
+def write_legend_index(legend_dir, layers, legends):
+    """
+    Write the legend index and remove legends no longer referenced
+
+    :param legend_dir: path to legend directory
+    :param layers: `dict` of layer name to legend key
+    :param legends: `dict` of legend key to `dict` of filename to
+                    content type
+
+    :returns: `None`
+    """
+
+    index = {
+        'layers': layers,
+        'legends': legends
+    }
+
+    atomic_write(os.path.join(legend_dir, LEGEND_INDEX), json.dumps(index))
+
+    for name in os.listdir(legend_dir):
+        filepath = os.path.join(legend_dir, name)
+        if os.path.isdir(filepath) and name not in legends:
+            LOGGER.debug('Removing legend {}'.format(name))
+            shutil.rmtree(filepath, ignore_errors=True)
+
+
+class LegendCache:
+    """Lookup of pre-rendered legends"""
+
+    def __init__(self, legend_dir):
+        """
+        Initialize object
+
+        :param legend_dir: path to legend directory
+
+        :returns: `geomet_mapfile.legend.LegendCache`
+        """
+
+        self.legend_dir = legend_dir
+        self._index = None
+        self._index_mtime = None
+
+    @property
+    def index(self):
+        """`dict` of legend index (`None` if legends were not rendered)"""
+
+        filepath = os.path.join(self.legend_dir, LEGEND_INDEX)
+
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if mtime != self._index_mtime:
+            with open(filepath) as fh:
+                self._index = json.load(fh)
+            self._index_mtime = mtime
+
+        return self._index
+
+    def get(self, layer, style, format_, lang):
+        """
+        Get a pre-rendered legend
+
+        :param layer: `str` of layer name
+        :param style: `str` of style name (`None` for layer default style)
+        :param format_: `str` of legend format (e.g. image/png)
+        :param lang: `str` of language
+
+        :returns: `tuple` of content type and `bytes` of legend, or `None`
+                  if the legend was not rendered
+        """
+
+        index = self.index
+
+        if index is None or format_ not in LEGEND_FORMATS:
+            return None
+
+        key = index['layers'].get(layer)
+        if key is None:
+            return None
+
+        filename = legend_filename(style, lang, format_)
+        content_type = index['legends'].get(key, {}).get(filename)
+        if content_type is None:
+            METRICS.incr('legend_cache.misses')
+            return None
+
+        try:
+            with open(os.path.join(self.legend_dir, key, filename),
+                      'rb') as fh:
+                content = fh.read()
+        except FileNotFoundError:
+            METRICS.incr('legend_cache.misses')
+            return None
+
+        METRICS.incr('legend_cache.hits')
+
+        return content_type, content
@@ -19,25 +19,37 @@
 ###############################################################################
 
 from collections import OrderedDict
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from fnmatch import fnmatchcase
 from glob import glob
+import fcntl
 import json
 import logging
 import os
 import re
+import shutil
+import time
 from urllib.parse import urlencode
 
 import click
-import mappyfile
+from mappyfile.pprint import PrettyPrinter
 from yaml import load, CLoader
 
 from geomet_mapfile import __version__
+from geomet_mapfile.catalog import load_catalog
 from geomet_mapfile.env import (BASEDIR, CONFIG, STORE_TYPE,
                                 STORE_URL, URL, MAPFILE_STORAGE)
+from geomet_mapfile.legend import (LANGUAGES, LEGEND_FORMATS, legend_key,
+                                   legend_styles, render_legends,
+                                   write_legend_index)
 from geomet_mapfile.plugin import load_plugin
-from geomet_mapfile.util import DATEFORMAT, get_nearest
+from geomet_mapfile.profiling import profiling, timed
+from geomet_mapfile.snapshot import (current_generation, publish_snapshot,
+                                     update_snapshot, versioned_key)
+from geomet_mapfile.util import atomic_write, DATEFORMAT, get_nearest
 
 
 LOGGER = logging.getLogger(__name__)
@@ -46,13 +58,35 @@ THISDIR = os.path.dirname(os.path.realpath(__file__))
 
 MAPFILE_BASE = os.path.join(THISDIR, 'resources', 'mapfile-base.json')
 
-NOW = datetime.utcnow()
-
 PROVIDER_DEF = {
     'type': STORE_TYPE,
     'url': STORE_URL
 }
 
+# directory (relative to BASEDIR) of mapfile directory versions, and
+# number of previous versions to keep
+MAPFILE_VERSIONS_DIR = 'mapfile-versions'
+MAPFILE_VERSIONS_KEEP = 2
+
+# lock file (relative to BASEDIR) of the mapfile directory
+MAPFILE_LOCK = '.mapfile.lock'
+
+# directory (relative to BASEDIR) of pre-rendered legends
+LEGEND_DIR = 'legend'
+
+# geomet-data-registry time keys of a layer
+TIME_KEYS = [
+    'time_extent',
+    'default_time',
+    'model_run_extent',
+    'default_model_run'
+]
+
+# minimum time to wait for a key change before checking pending layers,
+# and time to wait before listening again after a store error (seconds)
+WATCH_MIN_TIMEOUT = 0.05
+WATCH_RETRY_DELAY = 5
+
 
 def mcf2layer_metadata(mcf_file):
     """
@@ -103,30 +137,44 @@ def mcf2layer_metadata(mcf_file):
     return dict_
 
 
-def layer_time_config(layer_name):
+def layer_time_keys(layer_name):
+    """
+    Helper function to get the store keys of layer time information
+
+    :param layer_name: name of layer
+
+    :returns: `list` of raw store keys, in `TIME_KEYS` order
+    """
+
+    return [f'geomet-data-registry_{layer_name}_{key}' for key in TIME_KEYS]
+
+
+def layer_time_config(layer_name, store=None, time_keys=None):
     """
     # TODO: add description
 
     :param layer_name: name of layer
+    :param store: store plugin to fetch time keys from (loaded if `None`)
+    :param time_keys: `dict` of prefetched raw time keys to values
+                      (fetched from store if `None`)
 
     :returns: `dict` of time values for layer (default time, time extent,
               default model run, model run extent)
     """
 
-    st = load_plugin('store', PROVIDER_DEF)
+    if time_keys is not None:
+        values = [time_keys.get(key) for key in layer_time_keys(layer_name)]
+    else:
+        if store is None:
+            st = load_plugin('store', PROVIDER_DEF)
+        else:
+            st = store
 
-    time_extent = st.get_key(
-        f'geomet-data-registry_{layer_name}_time_extent', raw=True
-    )
-    default_time = st.get_key(
-        f'geomet-data-registry_{layer_name}_default_time', raw=True
-    )
-    model_run_extent = st.get_key(
-        f'geomet-data-registry_{layer_name}_model_run_extent', raw=True
-    )
-    default_model_run = st.get_key(
-        f'geomet-data-registry_{layer_name}_default_model_run', raw=True
-    )
+        values = [
+            st.get_key(key, raw=True) for key in layer_time_keys(layer_name)
+        ]
+
+    time_extent, default_time, model_run_extent, default_model_run = values
 
     if not time_extent:
         msg = (
@@ -170,8 +218,11 @@ def layer_time_config(layer_name):
             while start <= end:
                 intervals.append(start)
                 start += relative_delta
+            # current time of each call, as long running watchers and
+            # workers regenerate defaults long after they started
+            now = datetime.utcnow()
             nearest_interval = min(
-                intervals, key=lambda interval: abs(interval - NOW)
+                intervals, key=lambda interval: abs(interval - now)
             ).strftime(DATEFORMAT)
         else:
             nearest_interval = end.strftime(DATEFORMAT)
@@ -285,22 +336,29 @@ def gen_web_metadata(m, c, url):
     return d
 
 
-def gen_layer(layer_name, layer_info):
+def gen_layer(layer_name, layer_info, context=None, time_keys=None):
     """
     mapfile layer object generator
 
     :param layer_name: name of layer
     :param layer_info: layer information
+    :param context: `GenerationContext` to reuse (created if `None`)
+    :param time_keys: `dict` of prefetched raw time keys to values
+                      (fetched from store if `None`)
 
     :returns: list of mappyfile layer objects of layer
     """
 
     LOGGER.debug('Setting up layer configuration')
 
+    if context is None:
+        context = GenerationContext()
+
     layer = {}
 
     # get layer time information
-    time_dict = layer_time_config(layer_name)
+    with timed('time-key fetch', layer_name):
+        time_dict = layer_time_config(layer_name, context.store, time_keys)
 
     layer['__type__'] = 'layer'
     layer['tolerance'] = 15
@@ -322,11 +380,9 @@ def gen_layer(layer_name, layer_info):
 
     # set layer projection
     LOGGER.debug('Setting up layer projection')
-    proj_file = os.path.join(THISDIR, 'resources',
-                             layer_info['forecast_model']['projection'])
-    with open(proj_file) as f:
-        lines = [l.replace('\n', '').replace('"', '') for l in f.readlines()]  # noqa
-        layer['projection'] = lines
+    layer['projection'] = list(
+        context.projection(layer_info['forecast_model']['projection'])
+    )
 
     # set layer processing directives
     LOGGER.debug('Setting up layer processing directives')
@@ -364,11 +420,9 @@ def gen_layer(layer_name, layer_info):
     layer['classgroup'] = layer_info['styles'][0].split("/")[-1].strip('.json')
 
     layer['classes'] = []
-    for style in layer_info['styles']:
-        with open(
-            os.path.join(THISDIR, 'resources', style)
-        ) as json_style:
-            for class_ in json.load(json_style):
+    with timed('style load', layer_name):
+        for style in layer_info['styles']:
+            for class_ in context.style(style):
                 layer['classes'].append(class_)
 
     # set layer metadata
@@ -448,37 +502,292 @@ def gen_layer(layer_name, layer_info):
 
     LOGGER.debug('Reading MCF and updating layer metadata')
 
-    mcf_file = os.path.join(THISDIR, 'resources', 'mcf',
-                            layer_info['forecast_model']['mcf'])
-
-    layer['metadata'].update(mcf2layer_metadata(mcf_file))
+    layer['metadata'].update(
+        context.mcf_metadata(layer_info['forecast_model']['mcf'])
+    )
 
     return layer
 
 
-def generate_mapfile(layer=None, output='file', use_includes=True):
-    st = load_plugin('store', PROVIDER_DEF)
+class GenerationContext:
+    """
+    Inputs of mapfile generation (base mapfile, layer catalog, styles,
+    projections, MCF metadata and store connection).
+
+    A context can be kept alive across `generate_mapfile` calls (e.g. in a
+    Celery worker) so that only per-layer work is done on each call.
+    File-based inputs are reloaded when their modification time changes.
+    Returned objects are shared between calls and must not be modified.
+    """
+
+    def __init__(self):
+        """
+        Initialize object
+
+        :returns: `geomet_mapfile.mapfile.GenerationContext`
+        """
+
+        self._files = {}
+        self._catalog = None
+        self._catalog_stat = None
+        self._store = None
+        self._printer = None
+
+    def _load(self, filepath, loader):
+        mtime = os.stat(filepath).st_mtime_ns
+        cached = self._files.get(filepath)
+
+        if cached is None or cached[0] != mtime:
+            LOGGER.debug('Loading {}'.format(filepath))
+            cached = (mtime, loader(filepath))
+            self._files[filepath] = cached
+
+        return cached[1]
+
+    @property
+    def store(self):
+        """store plugin"""
+
+        if self._store is None:
+            self._store = load_plugin('store', PROVIDER_DEF)
+
+        return self._store
+
+    @property
+    def catalog(self):
+        """`geomet_mapfile.catalog.LayerCatalog` of configuration"""
+
+        stat = os.stat(CONFIG)
+        stat = (stat.st_mtime_ns, stat.st_size)
+
+        if self._catalog is None or stat != self._catalog_stat:
+            self._catalog = load_catalog(CONFIG, BASEDIR)
+            self._catalog_stat = stat
+
+        return self._catalog
+
+    def base_mapfile(self):
+        """
+        Get the base mapfile, including symbols
+
+        :returns: `OrderedDict` of base mapfile (copy)
+        """
+
+        def loader(filepath):
+            with open(filepath) as fh:
+                return json.load(fh, object_pairs_hook=OrderedDict)
+
+        mapfile = deepcopy(self._load(MAPFILE_BASE, loader))
+        # symbols are only ever filtered, never modified
+        symbols_file = os.path.join(THISDIR, 'resources/mapserv/symbols.json')
+        mapfile['symbols'] = list(self._load(symbols_file, loader))
+
+        return mapfile
+
+    def dumps(self, mapfile):
+        """
+        Serialize a mappyfile object. The printer is reused across calls
+        as it caches the expanded mapfile schemas
+
+        :param mapfile: mappyfile object (`dict` or `list`)
+
+        :returns: `str` of mapfile
+        """
+
+        if self._printer is None:
+            self._printer = PrettyPrinter()
+
+        return self._printer.pprint(mapfile)
+
+    def projection(self, projection):
+        """
+        Get projection definition
+
+        :param projection: path to projection file (relative to resources)
+
+        :returns: `list` of projection parameters
+        """
+
+        def loader(filepath):
+            with open(filepath) as f:
+                return [l.replace('\n', '').replace('"', '') for l in f.readlines()]  # noqa
+
+        return self._load(os.path.join(THISDIR, 'resources', projection),
+                          loader)
+
+    def style(self, style):
+        """
+        Get style classes
+
+        :param style: path to style JSON file (relative to resources)
+
+        :returns: `list` of mappyfile class objects
+        """
+
+        def loader(filepath):
+            with open(filepath) as json_style:
+                return json.load(json_style)
+
+        return self._load(os.path.join(THISDIR, 'resources', style), loader)
+
+    def mcf_metadata(self, mcf):
+        """
+        Get partial LAYER.METADATA object from MCF
+
+        :param mcf: path to MCF file (relative to resources/mcf)
+
+        :returns: `dict` of LAYER.METADATA object
+        """
+
+        return self._load(os.path.join(THISDIR, 'resources', 'mcf', mcf),
+                          mcf2layer_metadata)
+
+
+@contextmanager
+def mapfile_lock(basedir, shared=False):
+    """
+    Lock the mapfile directory. Entire generations hold an exclusive lock
+    until their version is published, so that partial generations and
+    updates (holding a shared lock) are not written to a version about to
+    be replaced
+
+    :param basedir: base directory of geomet-mapfile
+    :param shared: `bool` of whether to hold a shared lock (partial
+                   generations and updates) or an exclusive lock
+
+    :returns: context manager holding the lock
+    """
+
+    os.makedirs(basedir, exist_ok=True)
+
+    with open(os.path.join(basedir, MAPFILE_LOCK), 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def new_mapfile_version(basedir):
+    """
+    Create a new mapfile directory version
+
+    :param basedir: base directory of geomet-mapfile
+
+    :returns: `str` of version directory path
+    """
+
+    version = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    version_dir = os.path.join(basedir, MAPFILE_VERSIONS_DIR, version)
+    os.makedirs(version_dir)
+
+    return version_dir
+
+
+def publish_mapfile_version(basedir, version_dir,
+                            keep=MAPFILE_VERSIONS_KEEP):
+    """
+    Make a mapfile directory version current, by atomically swapping the
+    BASEDIR/mapfile symlink. Files of the current version which are not
+    mapfiles (e.g. cached capabilities) are carried over, and versions
+    older than the `keep` previous versions are deleted
+
+    :param basedir: base directory of geomet-mapfile
+    :param version_dir: path of version directory to publish
+    :param keep: `int` of number of previous versions to keep
+
+    :returns: `None`
+    """
+
+    mapfile_dir = os.path.join(basedir, 'mapfile')
+    versions_dir = os.path.join(basedir, MAPFILE_VERSIONS_DIR)
+
+    if os.path.isdir(mapfile_dir):
+        for filename in os.listdir(mapfile_dir):
+            filepath = os.path.join(mapfile_dir, filename)
+            target = os.path.join(version_dir, filename)
+            if (filename.endswith('.map') or os.path.exists(target) or
+                    not os.path.isfile(filepath)):
+                continue
+            try:
+                os.link(filepath, target)
+            except OSError:
+                shutil.copy2(filepath, target)
+
+    if os.path.isdir(mapfile_dir) and not os.path.islink(mapfile_dir):
+        # directory of a previous release, moved to versions once
+        legacy_dir = os.path.join(versions_dir, '0-legacy')
+        LOGGER.info(f'Moving {mapfile_dir} to {legacy_dir}')
+        os.rename(mapfile_dir, legacy_dir)
+
+    tmp_link = os.path.join(basedir, f'.mapfile.{os.getpid()}')
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(version_dir, basedir), tmp_link)
+    os.replace(tmp_link, mapfile_dir)
+
+    LOGGER.info(f'Published mapfile version {version_dir}')
+
+    # versions newer than the published one may be under construction
+    version = os.path.basename(version_dir)
+    previous = sorted(
+        name for name in os.listdir(versions_dir) if name < version
+    )
+    for name in previous[:max(len(previous) - keep, 0)]:
+        LOGGER.debug(f'Deleting mapfile version {name}')
+        shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
+
+
+def generate_mapfile(layer=None, output='file', use_includes=True,
+                     context=None):
+    """
+    Generates mapfile(s)
+
+    :param layer: `str` of layer name, or `list` of layer names
+                  (all layers if `None`)
+    :param output: `str` of output (file or store)
+    :param use_includes: `bool` of whether to use INCLUDE directives
+    :param context: `GenerationContext` to reuse (created if `None`)
+
+    :returns: `bool` of whether time keys were found for all layers
+    """
+
+    # held from the time-key fetch, so that partial generations waiting for
+    # an entire generation write newer time keys over its mapfiles
+    with mapfile_lock(BASEDIR, shared=layer is not None):
+        return _generate_mapfile(layer, output, use_includes, context)
+
+
+def _generate_mapfile(layer, output, use_includes, context):
+    if context is None:
+        context = GenerationContext()
+
+    st = context.store
     time_errors = False
     output_dir = f'{BASEDIR}{os.sep}mapfile'
 
     all_layers = []
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    # an entire generation is written to a new version of the mapfile
+    # directory, which is published once complete. Mapfiles always refer
+    # to each other through output_dir
+    if layer is None:
+        build_dir = new_mapfile_version(BASEDIR)
+    else:
+        build_dir = output_dir
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
-    with open(MAPFILE_BASE) as fh:
-        mapfile = json.load(fh, object_pairs_hook=OrderedDict)
-        symbols_file = os.path.join(THISDIR, 'resources/mapserv/symbols.json')
-        with open(symbols_file) as fh2:
-            mapfile['symbols'] = json.load(fh2)
+    with timed('config load'):
+        mapfile = context.base_mapfile()
+        catalog = context.catalog
 
-    with open(CONFIG) as fh:
-        cfg = load(fh, Loader=CLoader)
+        if isinstance(layer, str):
+            mapfiles = {layer: catalog.get_layer(layer)}
+        else:
+            mapfiles = catalog.get_layers(layer)
 
-    if layer is not None:
-        mapfiles = {layer: cfg['layers'][layer]}
-    else:
-        mapfiles = cfg['layers']
+        metadata = catalog.metadata
 
     # set PROJ_LIB path
     mapfile['config']['proj_lib'] = os.path.join(
@@ -486,18 +795,29 @@ def generate_mapfile(layer=None, output='file', use_includes=True):
     )
 
     mapfile['web']['metadata'] = gen_web_metadata(
-        mapfile, cfg['metadata'], URL
+        mapfile, metadata, URL
     )
 
+    # fetch time keys of all layers at once
+    with timed('time-key fetch'):
+        time_keys = st.get_keys(
+            [key_ for key in mapfiles for key_ in layer_time_keys(key)],
+            raw=True
+        )
+
+    # store values are written at once after all layers are generated
+    store_values = {}
+
     for key, value in mapfiles.items():
-        mapfile_copy = deepcopy(mapfile)
-        mapfile_copy['layers'] = []
+        with timed('layer build', key):
+            mapfile_copy = deepcopy(mapfile)
+            mapfile_copy['layers'] = []
 
-        try:
-            lyr = gen_layer(key, value)
-        except LayerTimeConfigError:
-            lyr = None
-            time_errors = True
+            try:
+                lyr = gen_layer(key, value, context, time_keys)
+            except LayerTimeConfigError:
+                lyr = None
+                time_errors = True
 
         if lyr:
             mapfile_copy['layers'].append(lyr)
@@ -525,40 +845,58 @@ def generate_mapfile(layer=None, output='file', use_includes=True):
             else:
                 mapfile_copy['symbols'] = []
 
-        layer_only_filepath = (
-            f'{output_dir}{os.sep}geomet-weather-{key}_layer.map'
-        )
+        layer_only_filename = f'geomet-weather-{key}_layer.map'
+        layer_only_filepath = f'{output_dir}{os.sep}{layer_only_filename}'
 
         # collect and write LAYER-only mapfile to disk in order to use
         # in global mapfile with INCLUDE directive
         all_layers.append(layer_only_filepath)
-        with open(layer_only_filepath, 'w', encoding='utf-8') as fh:
-            mappyfile.dump(mapfile_copy['layers'], fh)
+        with timed('serialization', key):
+            layer_only_content = context.dumps(mapfile_copy['layers'])
+        with timed('file write', key):
+            atomic_write(f'{build_dir}{os.sep}{layer_only_filename}',
+                         layer_only_content)
 
         if output == 'file' and mapfile_copy['layers']:
-            mapfile_filepath = f'{output_dir}{os.sep}geomet-weather-{key}.map'
-            with open(mapfile_filepath, 'w', encoding='utf-8') as fh:
+            mapfile_filepath = f'{build_dir}{os.sep}geomet-weather-{key}.map'
+            with timed('serialization', key):
                 if use_includes:
                     mapfile['include'] = [layer_only_filepath]
-                    mappyfile.dump(mapfile, fh)
+                    mapfile_content = context.dumps(mapfile)
                 else:
-                    mappyfile.dump(mapfile_copy, fh)
+                    mapfile_content = context.dumps(mapfile_copy)
+            with timed('file write', key):
+                atomic_write(mapfile_filepath, mapfile_content)
 
         elif output == 'store' and mapfile_copy['layers']:
-            st.set_key(f'{key}_mapfile', mappyfile.dumps(mapfile_copy))
-            st.set_key(f'{key}_layer', mappyfile.dumps(mapfile_copy['layers']))
+            with timed('serialization', key):
+                mapfile_content = context.dumps(mapfile_copy)
+            store_values[f'{key}_mapfile'] = mapfile_content
+            store_values[f'{key}_layer'] = layer_only_content
 
     if layer is None:  # generate entire mapfile
         # always write global mapfile to disk for caching purposes
         mapfile['include'] = all_layers
         filename = 'geomet-weather.map'
-        filepath = f'{output_dir}{os.sep}{filename}'
-
-        with open(filepath, 'w', encoding='utf-8') as fh:
-            mappyfile.dump(mapfile, fh)
+        filepath = f'{build_dir}{os.sep}{filename}'
+
+        with timed('serialization'):
+            mapfile_content = context.dumps(mapfile)
+        with timed('file write'):
+            atomic_write(filepath, mapfile_content)
+        with timed('publish'):
+            publish_mapfile_version(BASEDIR, build_dir)
         # also write to store if required
         if output == 'store':
-            st.set_key('geomet-weather_mapfile', mappyfile.dumps(mapfile))
+            store_values['geomet-weather_mapfile'] = mapfile_content
+
+    # an entire generation is published as a new store snapshot
+    if store_values:
+        with timed('store write'):
+            if layer is None:
+                publish_snapshot(st, store_values)
+            else:
+                update_snapshot(st, store_values)
 
     # returns False if time keys could not be retrieved (meaning empty/no
     # layer mapfiles generated)
@@ -568,6 +906,68 @@ def generate_mapfile(layer=None, output='file', use_includes=True):
     return True
 
 
+def select_layers(catalog, forecast_models=None, patterns=None, regex=None,
+                  changed_since=None, store=None):
+    """
+    Select layers of a catalog. Layers must match all given selectors
+
+    :param catalog: `geomet_mapfile.catalog.LayerCatalog`
+    :param forecast_models: `list` of forecast model names
+    :param patterns: `list` of layer name glob patterns
+    :param regex: `str` of layer name regular expression
+    :param changed_since: `datetime` of oldest last update of selected
+                          layers (default model run, or end of time extent
+                          for layers without model runs)
+    :param store: store plugin to fetch time keys from (loaded if `None`)
+
+    :returns: `list` of layer names, in configuration order
+    """
+
+    names = catalog.layer_names
+
+    if forecast_models:
+        selected = set()
+        for model in forecast_models:
+            selected.update(catalog.get_model_layers(model))
+        names = [name for name in names if name in selected]
+
+    if patterns:
+        names = [
+            name for name in names
+            if any(fnmatchcase(name, pattern) for pattern in patterns)
+        ]
+
+    if regex is not None:
+        regex_ = re.compile(regex)
+        names = [name for name in names if regex_.search(name)]
+
+    if changed_since is not None and names:
+        if store is None:
+            store = load_plugin('store', PROVIDER_DEF)
+
+        time_keys = store.get_keys(
+            [key for name in names for key in layer_time_keys(name)],
+            raw=True
+        )
+
+        def changed(name):
+            time_extent, _, _, default_model_run = [
+                time_keys.get(key) for key in layer_time_keys(name)
+            ]
+            if default_model_run:
+                last_update = default_model_run
+            elif time_extent:
+                last_update = time_extent.split('/')[1]
+            else:
+                return False
+
+            return datetime.strptime(last_update, DATEFORMAT) >= changed_since
+
+        names = [name for name in names if changed(name)]
+
+    return names
+
+
 def find_replace_wms_timedefault(name, mapfile):
     """
     Finds the wms_timedefault and wms_available_intervals and updates the
@@ -620,47 +1020,230 @@ def update_mapfile(layer=None):
     :param layer: `str` of layer ID to update
     :returns: `bool` of update result
     """
-    if layer:
-        mapfiles = [
-            f'{BASEDIR}{os.sep}mapfile{os.sep}geomet-weather-{layer}_layer.map'
-        ]
-    else:
-        mapfiles = glob(f'{BASEDIR}{os.sep}mapfile{os.sep}*_layer.map')
-    for mapfile in mapfiles:
-        try:
-            LOGGER.debug(f'Updating {mapfile}.')
-            with open(mapfile, 'r+') as fp:
-                mapfile_ = fp.read()
-                updated_mapfile = find_replace_wms_timedefault(
-                    mapfile, mapfile_
-                )
-                # go to start of file and re-write mapfile
-                fp.seek(0)
-                fp.write(updated_mapfile)
-        except FileNotFoundError as e:
-            LOGGER.error(e)
-            pass
-
-    # update mapfiles in store if MAPFILE_STORAGE set to store
-    if MAPFILE_STORAGE == 'store':
-        st = load_plugin('store', PROVIDER_DEF)
+    with mapfile_lock(BASEDIR, shared=True):
         if layer:
             mapfiles = [
-                (f'geomet-mapfile_{layer}_layer', st.get_key(f'{layer}_layer'))
+                f'{BASEDIR}{os.sep}mapfile{os.sep}'
+                f'geomet-weather-{layer}_layer.map'
             ]
         else:
-            mapfiles = [
-                (key, st.get_key(f'{key}', raw=True))
-                for key in st.list_keys('geomet-mapfile*_layer')
-            ]
-        for name, mapfile in mapfiles:
-            LOGGER.debug(f'Updating {name} in store.')
-            updated_mapfile = find_replace_wms_timedefault(name, mapfile)
-            st.set_key(name, updated_mapfile, raw=True)
+            mapfiles = glob(f'{BASEDIR}{os.sep}mapfile{os.sep}*_layer.map')
+        for mapfile in mapfiles:
+            try:
+                LOGGER.debug(f'Updating {mapfile}.')
+                with timed('file read', mapfile):
+                    with open(mapfile) as fp:
+                        mapfile_ = fp.read()
+                with timed('time default update', mapfile):
+                    updated_mapfile = find_replace_wms_timedefault(
+                        mapfile, mapfile_
+                    )
+                with timed('file write', mapfile):
+                    atomic_write(mapfile, updated_mapfile)
+            except FileNotFoundError as e:
+                LOGGER.error(e)
+                pass
+
+    # update mapfiles in store if MAPFILE_STORAGE set to store
+    if MAPFILE_STORAGE == 'store':
+        st = load_plugin('store', PROVIDER_DEF)
+        with timed('store read'):
+            generation, _ = current_generation(st)
+            if layer:
+                keys = [f'{layer}_layer']
+            else:
+                suffix = versioned_key('', generation)
+                keys = [
+                    key[len('geomet-mapfile_'):len(key) - len(suffix)]
+                    for key in st.list_keys(
+                        f'geomet-mapfile_*_layer{suffix}')
+                ]
+            mapfiles = st.get_keys(
+                [versioned_key(key, generation) for key in keys])
+        updated_mapfiles = {}
+        for key in keys:
+            mapfile = mapfiles[versioned_key(key, generation)]
+            if mapfile is None:
+                LOGGER.error(f'{key} not found in store')
+                continue
+            LOGGER.debug(f'Updating {key} in store.')
+            with timed('time default update', key):
+                updated_mapfiles[key] = find_replace_wms_timedefault(
+                    key, mapfile)
+        with timed('store write'):
+            update_snapshot(st, updated_mapfiles, generation)
 
     return True
 
 
+def watch_mapfiles(output=MAPFILE_STORAGE, use_includes=True, debounce=1,
+                   max_delay=5, context=None):
+    """
+    Regenerate the mapfiles of layers whose geomet-data-registry time keys
+    change. Changes are debounced: layers are regenerated together once no
+    change happened for `debounce` seconds, or at most `max_delay` seconds
+    after the first change
+
+    :param output: `str` of output (file or store)
+    :param use_includes: `bool` of whether to use INCLUDE directives
+    :param debounce: `float` of seconds without changes before regenerating
+    :param max_delay: `float` of maximum seconds between a change and
+                      regeneration
+    :param context: `GenerationContext` to reuse (created if `None`)
+
+    :raises: `ValueError` if `debounce` is not positive
+
+    :returns: `None`
+    """
+
+    if debounce <= 0:
+        raise ValueError('debounce must be positive')
+
+    if context is None:
+        context = GenerationContext()
+
+    patterns = [f'geomet-data-registry_*_{key}' for key in TIME_KEYS]
+    key_regex = re.compile(
+        '^geomet-data-registry_(.+)_({})$'.format('|'.join(TIME_KEYS))
+    )
+
+    pending = set()
+    first_change = last_change = None
+
+    def regenerate():
+        layer_names = context.catalog.layer_names
+        layers = [name for name in layer_names if name in pending]
+        if not layers:
+            return
+
+        start = time.perf_counter()
+        try:
+            result = generate_mapfile(layers, output, use_includes,
+                                      context=context)
+        except Exception as err:
+            # the watcher keeps running: layers are regenerated again on
+            # their next change
+            LOGGER.exception(f'Could not regenerate {len(layers)} layers: '
+                             f'{err}')
+            return
+        elapsed = time.perf_counter() - start
+
+        LOGGER.info(f'Regenerated {len(layers)} layers in {elapsed:.3f}s '
+                    f'({time.monotonic() - first_change:.3f}s after first '
+                    f'change)')
+        if not result:
+            LOGGER.error('Could not retrieve time extent information from '
+                         'store for some layers')
+
+    LOGGER.info('Watching geomet-data-registry time keys')
+
+    timeout = max(debounce / 4, WATCH_MIN_TIMEOUT)
+
+    while True:
+        try:
+            for key in context.store.listen_keys(patterns, timeout=timeout):
+                now = time.monotonic()
+
+                if key is not None:
+                    match = key_regex.match(key)
+                    if match is not None:
+                        LOGGER.debug(f'{key} changed')
+                        pending.add(match.group(1))
+                        last_change = now
+                        if first_change is None:
+                            first_change = now
+
+                if pending and (now - last_change >= debounce or
+                                now - first_change >= max_delay):
+                    regenerate()
+                    pending.clear()
+                    first_change = last_change = None
+            break
+        except Exception as err:
+            LOGGER.exception(f'Could not listen to time key changes: {err}')
+            time.sleep(WATCH_RETRY_DELAY)
+
+    if pending:
+        regenerate()
+
+
+def generate_legends(formats=None, languages=LANGUAGES, context=None):
+    """
+    Render the legend of every distinct layer style
+
+    :param formats: `list` of legend formats (all supported if `None`)
+    :param languages: `list` of languages
+    :param context: `GenerationContext` to reuse (created if `None`)
+
+    :returns: `tuple` of number of layers and number of distinct legends
+    """
+
+    if context is None:
+        context = GenerationContext()
+
+    with timed('config load'):
+        mapfile = context.base_mapfile()
+        catalog = context.catalog
+        layers = catalog.get_layers()
+
+    mapfile['config']['proj_lib'] = os.path.join(
+        THISDIR, 'resources', 'mapserv'
+    )
+    mapfile['web']['metadata'] = gen_web_metadata(
+        mapfile, catalog.metadata, URL
+    )
+    mapfile['layers'] = []
+
+    # layers sharing a legend key are rendered once, through the first
+    # layer using it
+    layer_keys = {}
+    legends = {}
+
+    for name, layer_info in layers.items():
+        with timed('style load', name):
+            try:
+                classes = [
+                    class_
+                    for style in layer_info['styles']
+                    for class_ in context.style(style)
+                ]
+            except FileNotFoundError as err:
+                LOGGER.warning('Skipping legend of {}: {}'.format(name, err))
+                continue
+        key = legend_key(layer_info, classes)
+        layer_keys[name] = key
+
+        if key in legends:
+            continue
+
+        legends[key] = (name, legend_styles(classes))
+
+        layer = {
+            '__type__': 'layer',
+            'name': name,
+            'status': 'ON',
+            'type': layer_info.get('type', 'RASTER'),
+            'classgroup': layer_info['styles'][0].split('/')[-1].strip('.json'),  # noqa
+            'classes': classes
+        }
+        for params in layer_info.get('layer_params', []):
+            param, value = params.split(maxsplit=1)
+            layer[param] = value
+        mapfile['layers'].append(layer)
+
+    legend_dir = os.path.join(BASEDIR, LEGEND_DIR)
+
+    with timed('serialization'):
+        mapfile_content = context.dumps(mapfile)
+    with timed('legend render'):
+        rendered = render_legends(mapfile_content, legends, legend_dir,
+                                  formats, languages)
+    with timed('file write'):
+        write_legend_index(legend_dir, layer_keys, rendered)
+
+    return len(layer_keys), len(legends)
+
+
 @click.group('mapfile')
 def mapfile_():
     """mapfile management"""
@@ -670,6 +1253,14 @@ def mapfile_():
 @click.command()
 @click.pass_context
 @click.option('--layer', '-l', help='layer name')
+@click.option('--forecast-model', '-m', 'forecast_models', multiple=True,
+              help='Select layers of forecast model (configuration key)')
+@click.option('--match', 'patterns', multiple=True,
+              help='Select layers whose name matches glob pattern')
+@click.option('--regex', help='Select layers whose name matches regex')
+@click.option('--changed-since',
+              type=click.DateTime(formats=[DATEFORMAT, '%Y-%m-%d']),
+              help='Select layers updated since given UTC time')
 @click.option(
     '--output',
     '-o',
@@ -683,20 +1274,123 @@ def mapfile_():
     default=True,
     help='Indicated whether to use INCLUDE directives in mapfile',
 )
-def generate(ctx, layer, output, includes):
-    generate_mapfile(layer, output, includes)
+@click.option('--profile', is_flag=True,
+              help='Profile generation and report timings per phase')
+@click.option('--profile-output', type=click.Path(dir_okay=False),
+              help='Path to write cProfile stats (implies --profile)')
+@click.option('--profile-top', type=int, default=10,
+              help='Number of slowest layers to report when profiling')
+def generate(ctx, layer, forecast_models, patterns, regex, changed_since,
+             output, includes, profile, profile_output, profile_top):
+    """generate mapfile(s)"""
+
+    selectors = any([forecast_models, patterns, regex is not None,
+                     changed_since is not None])
+
+    if layer is not None and selectors:
+        raise click.UsageError('--layer cannot be used with layer selectors')
+
+    with profiling(profile or profile_output is not None, profile_output,
+                   profile_top):
+        context = GenerationContext()
+
+        if selectors:
+            with timed('layer selection'):
+                try:
+                    layer = select_layers(
+                        context.catalog, forecast_models, patterns, regex,
+                        changed_since, context.store
+                    )
+                except KeyError as err:
+                    raise click.BadParameter(
+                        'Unknown forecast model {}'.format(err),
+                        param_hint='--forecast-model')
+                except re.error as err:
+                    raise click.BadParameter(str(err), param_hint='--regex')
+
+            if not layer:
+                click.echo('No layers selected')
+                return
+
+            click.echo('Generating {} layers'.format(len(layer)))
+
+        generate_mapfile(layer, output, includes, context=context)
+
+
+@click.command(name='compile')
+@click.pass_context
+def compile_catalog(ctx):
+    """compile configuration to layer catalog"""
+
+    catalog = load_catalog(CONFIG, BASEDIR)
+    click.echo('Catalog of {} layers at {}'.format(
+        len(catalog.layer_names), catalog.filepath))
 
 
 @click.command(name='update')
 @click.pass_context
 @click.option('--layer', '-l', help='layer name')
-def update(ctx, layer):
+@click.option('--profile', is_flag=True,
+              help='Profile update and report timings per phase')
+@click.option('--profile-output', type=click.Path(dir_okay=False),
+              help='Path to write cProfile stats (implies --profile)')
+@click.option('--profile-top', type=int, default=10,
+              help='Number of slowest mapfiles to report when profiling')
+def update(ctx, layer, profile, profile_output, profile_top):
     """update mapfile(s) wms_timedefault value"""
-    update_mapfile(layer)
+    with profiling(profile or profile_output is not None, profile_output,
+                   profile_top):
+        update_mapfile(layer)
+
+
+@click.command()
+@click.pass_context
+@click.option(
+    '--output',
+    '-o',
+    type=click.Choice(['store', 'file']),
+    default=MAPFILE_STORAGE,
+    help='Write to configured store or to disk',
+)
+@click.option(
+    '--includes/--no-includes',
+    default=True,
+    help='Indicated whether to use INCLUDE directives in mapfile',
+)
+@click.option('--debounce', type=float, default=1,
+              help='Seconds without changes before regenerating layers')
+@click.option('--max-delay', type=float, default=5,
+              help='Maximum seconds between a change and regeneration')
+def watch(ctx, output, includes, debounce, max_delay):
+    """regenerate layer mapfiles when their time keys change"""
+
+    if debounce <= 0:
+        raise click.BadParameter('must be positive', param_hint='--debounce')
+
+    watch_mapfiles(output, includes, debounce, max_delay)
+
+
+@click.command()
+@click.pass_context
+@click.option('--format', '-f', 'formats', multiple=True,
+              type=click.Choice(list(LEGEND_FORMATS.keys())),
+              help='Legend format (default: all supported formats)')
+@click.option('--profile', is_flag=True,
+              help='Profile rendering and report timings per phase')
+def legends(ctx, formats, profile):
+    """pre-render GetLegendGraphic responses of all layer styles"""
+
+    with profiling(profile):
+        layers, legends_ = generate_legends(list(formats) or None)
+
+    click.echo('Rendered {} legends for {} layers'.format(legends_, layers))
 
 
 mapfile_.add_command(generate)
 mapfile_.add_command(update)
+mapfile_.add_command(compile_catalog)
+mapfile_.add_command(watch)
+mapfile_.add_command(legends)
 
 
 class LayerTimeConfigError(Exception):
@@ -0,0 +1,334 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import io
+import logging
+import math
+from urllib.parse import parse_qsl, urlencode
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LOGGER = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+
+# tile grids supported for metatiling: top-left origin, tile span at
+# zoom level 0 and matrix size (columns, rows) at zoom level 0
+GRIDS = {
+    'EPSG:3857': {
+        'origin': (-20037508.342789244, 20037508.342789244),
+        'span': 40075016.68557849,
+        'matrix': (1, 1)
+    },
+    'EPSG:4326': {
+        'origin': (-180.0, 90.0),
+        'span': 180.0,
+        'matrix': (2, 1)
+    }
+}
+
+IMAGE_FORMATS = {
+    'image/png': 'PNG',
+    'image/jpeg': 'JPEG'
+}
+
+# relative tolerance when matching a BBOX to the tile grid
+TOLERANCE = 1e-6
+
+# MapServer default JPEG quality
+JPEG_QUALITY = 75
+
+
+def encoder_options(format_, options, image):
+    """
+    Get the PIL encoder options matching the options of the MapServer
+    output format a metatile was rendered with
+
+    :param format_: `str` of PIL image format
+    :param options: `dict` of output format options (FORMATOPTION)
+    :param image: `PIL.Image` of rendered metatile
+
+    :returns: `dict` of PIL encoder options
+    """
+
+    encoder = {}
+
+    if format_ == 'JPEG':
+        encoder['quality'] = int(options.get('QUALITY', JPEG_QUALITY))
+    elif format_ == 'PNG':
+        if 'COMPRESSION' in options:
+            encoder['compress_level'] = int(options['COMPRESSION'])
+        # transparent palette index of quantized images
+        if 'transparency' in image.info:
+            encoder['transparency'] = image.info['transparency']
+
+    return encoder
+
+
+def replace_params(query_string, **params):
+    """
+    Replace parameters of a query string
+
+    :param query_string: `str` of request query string
+    :param params: parameters (uppercase) to replace
+
+    :returns: `str` of updated query string
+    """
+
+    query = [
+        (key, params[key.upper()]) if key.upper() in params else (key, value)
+        for key, value in parse_qsl(query_string, keep_blank_values=True)
+    ]
+
+    return urlencode(query, safe=',:/')
+
+
+class Metatile:
+    """N x N block of grid aligned tiles rendered as a single image"""
+
+    def __init__(self, crs, zoom, col, row, size, axis_swap=False,
+                 buffer=0):
+        """
+        Initialize object
+
+        :param crs: `str` of tile grid CRS
+        :param zoom: `int` of zoom level
+        :param col: `int` of requested tile column
+        :param row: `int` of requested tile row
+        :param size: `int` of metatile size (in tiles)
+        :param axis_swap: `bool` of whether BBOX is in lat/lon order
+        :param buffer: `int` of pixels rendered around the metatile, so that
+                       labels and symbols are not clipped at its edges
+
+        :returns: `geomet_mapfile.metatile.Metatile`
+        """
+
+        self.crs = crs
+        self.zoom = zoom
+        self.col = col
+        self.row = row
+        self.axis_swap = axis_swap
+        self.buffer = buffer
+
+        grid = GRIDS[crs]
+        self.span = grid['span'] / 2 ** zoom
+        matrix_cols = grid['matrix'][0] * 2 ** zoom
+        matrix_rows = grid['matrix'][1] * 2 ** zoom
+
+        # align metatile on the grid and clip it to the matrix
+        self.mincol = col // size * size
+        self.minrow = row // size * size
+        self.maxcol = min(self.mincol + size, matrix_cols) - 1
+        self.maxrow = min(self.minrow + size, matrix_rows) - 1
+
+    @classmethod
+    def from_query_string(cls, query_string, size, buffer=0):
+        """
+        Detect whether a GetMap request is for a grid aligned tile
+
+        :param query_string: `str` of request query string
+        :param size: `int` of metatile size (in tiles)
+        :param buffer: `int` of pixels rendered around the metatile
+
+        :returns: `geomet_mapfile.metatile.Metatile` or `None`
+        """
+
+        params = {
+            key.upper(): value
+            for key, value in parse_qsl(query_string, keep_blank_values=True)
+        }
+
+        crs = (params.get('CRS') or params.get('SRS') or '').upper()
+
+        if crs not in GRIDS:
+            return None
+
+        try:
+            if any([int(params.get('WIDTH')) != TILE_SIZE,
+                    int(params.get('HEIGHT')) != TILE_SIZE]):
+                return None
+            bbox = [float(value) for value in params['BBOX'].split(',')]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        if len(bbox) != 4:
+            return None
+
+        # WMS 1.3.0 uses lat/lon axis order for EPSG:4326
+        axis_swap = all([crs == 'EPSG:4326',
+                         params.get('VERSION', '1.3.0') == '1.3.0'])
+        if axis_swap:
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+
+        minx, miny, maxx, maxy = bbox
+        width = maxx - minx
+
+        if width <= 0 or abs((maxy - miny) - width) > width * TOLERANCE:
+            return None
+
+        grid = GRIDS[crs]
+        zoom = math.log2(grid['span'] / width)
+        col = (minx - grid['origin'][0]) / width
+        row = (grid['origin'][1] - maxy) / width
+
+        if any(abs(value - round(value)) > TOLERANCE
+               for value in [zoom, col, row]) or round(zoom) < 0:
+            return None
+
+        zoom, col, row = int(round(zoom)), int(round(col)), int(round(row))
+
+        if any([col < 0, row < 0,
+                col >= grid['matrix'][0] * 2 ** zoom,
+                row >= grid['matrix'][1] * 2 ** zoom]):
+            return None
+
+        return cls(crs, zoom, col, row, size, axis_swap, buffer)
+
+    @property
+    def tiles(self):
+        """`list` of (column, row) of tiles in metatile"""
+
+        return [
+            (col, row)
+            for row in range(self.minrow, self.maxrow + 1)
+            for col in range(self.mincol, self.maxcol + 1)
+        ]
+
+    @property
+    def width(self):
+        """`int` of metatile width in pixels (including buffer)"""
+
+        return (self.maxcol - self.mincol + 1) * TILE_SIZE + 2 * self.buffer
+
+    @property
+    def height(self):
+        """`int` of metatile height in pixels (including buffer)"""
+
+        return (self.maxrow - self.minrow + 1) * TILE_SIZE + 2 * self.buffer
+
+    @property
+    def bbox(self):
+        """`str` of metatile BBOX parameter value (including buffer)"""
+
+        origin = GRIDS[self.crs]['origin']
+        buffer_ = self.buffer * self.span / TILE_SIZE
+
+        minx = origin[0] + self.mincol * self.span - buffer_
+        maxx = origin[0] + (self.maxcol + 1) * self.span + buffer_
+        maxy = origin[1] - self.minrow * self.span + buffer_
+        miny = origin[1] - (self.maxrow + 1) * self.span - buffer_
+
+        if self.axis_swap:
+            bbox = [miny, minx, maxy, maxx]
+        else:
+            bbox = [minx, miny, maxx, maxy]
+
+        return ','.join(repr(value) for value in bbox)
+
+    def tile_query_string(self, query_string, col=None, row=None):
+        """
+        Build a tile query string which does not depend on BBOX formatting,
+        for use in response cache keys
+
+        :param query_string: `str` of request query string
+        :param col: `int` of tile column (defaults to requested tile)
+        :param row: `int` of tile row (defaults to requested tile)
+
+        :returns: `str` of query string with BBOX replaced by tile address
+        """
+
+        col = self.col if col is None else col
+        row = self.row if row is None else row
+
+        return replace_params(
+            query_string,
+            BBOX='{}/{}/{}/{}'.format(self.crs, self.zoom, col, row)
+        )
+
+    def render_query_string(self, query_string):
+        """
+        Build the query string of the metatile GetMap request
+
+        :param query_string: `str` of request query string
+
+        :returns: `str` of metatile query string
+        """
+
+        return replace_params(query_string, BBOX=self.bbox,
+                              WIDTH=str(self.width),
+                              HEIGHT=str(self.height))
+
+    def split(self, content, content_type, options=None):
+        """
+        Slice a rendered metatile into tiles
+
+        :param content: `bytes` of rendered metatile
+        :param content_type: `str` of rendered metatile content type
+        :param options: `dict` of options of the MapServer output format the
+                        metatile was rendered with (FORMATOPTION), applied
+                        when encoding tiles
+
+        :returns: `dict` of (column, row) to tile `bytes`
+        """
+
+        options = {key.upper(): value
+                   for key, value in (options or {}).items()}
+
+        format_ = IMAGE_FORMATS[content_type.split(';')[0].strip()]
+        image = Image.open(io.BytesIO(content))
+        image.load()
+
+        # quantized by MapServer unless forced to quantize each tile
+        quantize = all([format_ == 'PNG', image.mode != 'P',
+                        options.get('QUANTIZE_FORCE', '').upper() == 'ON'])
+        encoder = encoder_options(format_, options, image)
+
+        tiles = {}
+        for col, row in self.tiles:
+            left = (col - self.mincol) * TILE_SIZE + self.buffer
+            top = (row - self.minrow) * TILE_SIZE + self.buffer
+            tile = image.crop((left, top, left + TILE_SIZE, top + TILE_SIZE))
+            if quantize:
+                tile = tile.quantize(
+                    int(options.get('QUANTIZE_COLORS', 256)),
+                    method=Image.FASTOCTREE)
+            buffer_ = io.BytesIO()
+            tile.save(buffer_, format=format_, **encoder)
+            tiles[(col, row)] = buffer_.getvalue()
+
+        return tiles
+
+
+def metatiling_supported(content_type):
+    """
+    Check whether a rendered image can be sliced into tiles
+
+    :param content_type: `str` of rendered image content type
+
+    :returns: `bool` of whether the image can be sliced
+    """
+
+    if Image is None:
+        return False
+
+    return content_type.split(';')[0].strip() in IMAGE_FORMATS
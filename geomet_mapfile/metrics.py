@@ -0,0 +1,82 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Thread-safe in-process counters and gauges"""
+
+    def __init__(self):
+        """
+        Initialize object
+
+        :returns: `geomet_mapfile.metrics.Metrics`
+        """
+
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter
+
+        :param name: `str` of counter name
+        :param value: `int` or `float` to add to the counter
+
+        :returns: new value of counter
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            return self.counters[name]
+
+    def gauge(self, name, value):
+        """
+        Set a gauge to a given value
+
+        :param name: `str` of gauge name
+        :param value: value of gauge
+
+        :returns: `None`
+        """
+
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        Get a copy of all metrics
+
+        :returns: `dict` of counters and gauges
+        """
+
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges)
+            }
+
+
+METRICS = Metrics()
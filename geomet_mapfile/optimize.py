@@ -0,0 +1,329 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Optimized copies of layer data files.
+#
+# GRIB2 files are neither tiled nor overviewed, so rendering any part of a
+# grid at a low zoom level decodes the whole grid. Data files are converted
+# to internally tiled GeoTIFF with overviews (Cloud Optimized GeoTIFF when
+# the GDAL COG driver is available), keeping band metadata, to
+# <optimized_dir>/<original path>.tif (warp grids, see geomet_mapfile.warp,
+# are kept in <optimized_dir>/grids). Copies have the modification time of
+# the original file, and rendering uses a copy whenever its modification
+# time matches the one of the original file.
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import click
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+from geomet_mapfile.dataset import overview_levels
+from geomet_mapfile.env import BASEDIR, OPTIMIZED_DATA_DIR
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# data files converted to optimized copies
+OPTIMIZED_FORMATS = ('.grib2', '.grb2')
+
+BLOCK_SIZE = 512
+
+# resampling of overviews, keeping data values (as MapServer does)
+OVERVIEW_RESAMPLING = 'NEAREST'
+
+
+def convert(filepath, target, block_size=BLOCK_SIZE,
+            resampling=OVERVIEW_RESAMPLING):
+    """
+    Convert a data file to a tiled GeoTIFF with overviews
+
+    :param filepath: path to data file
+    :param target: path to GeoTIFF to write (replaced atomically)
+    :param block_size: `int` of tile size
+    :param resampling: `str` of overview resampling method
+
+    :returns: `bool` of whether the file was converted
+    """
+
+    if gdal is None:
+        raise RuntimeError('GDAL is required to optimize data files')
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target),
+                               prefix='.optimize-', suffix='.tif')
+    os.close(fd)
+
+    start = time.monotonic()
+    stat = os.stat(filepath)
+
+    try:
+        src = gdal.Open(filepath)
+        if src is None:
+            LOGGER.warning('Could not open {}'.format(filepath))
+            return False
+
+        if gdal.GetDriverByName('COG') is not None:
+            options = gdal.TranslateOptions(format='COG', creationOptions=[
+                'BLOCKSIZE={}'.format(block_size),
+                'COMPRESS=DEFLATE',
+                'OVERVIEW_RESAMPLING={}'.format(resampling)
+            ])
+            dst = gdal.Translate(tmp, src, options=options)
+        else:
+            options = gdal.TranslateOptions(format='GTiff', creationOptions=[
+                'TILED=YES',
+                'BLOCKXSIZE={}'.format(block_size),
+                'BLOCKYSIZE={}'.format(block_size),
+                'COMPRESS=DEFLATE'
+            ])
+            dst = gdal.Translate(tmp, src, options=options)
+            if dst is not None:
+                levels = overview_levels(dst.RasterXSize, dst.RasterYSize)
+                if levels:
+                    dst.BuildOverviews(resampling, levels)
+
+        if dst is None:
+            LOGGER.warning('Could not convert {}'.format(filepath))
+            return False
+
+        # flush and close datasets before publishing the copy
+        dst = src = None
+
+        os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    METRICS.incr('data_optimizer.converted')
+    METRICS.incr('data_optimizer.convert_seconds', time.monotonic() - start)
+    LOGGER.debug('Converted {} to {}'.format(filepath, target))
+
+    return True
+
+
+class DataOptimizer:
+    """Maps data files to their optimized copies, converting them as needed"""
+
+    def __init__(self, optimized_dir, workers=1):
+        """
+        Initialize object
+
+        :param optimized_dir: path to directory of optimized copies
+        :param workers: `int` of number of background conversions
+
+        :returns: `geomet_mapfile.optimize.DataOptimizer`
+        """
+
+        self.optimized_dir = optimized_dir
+        self.workers = workers
+
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+
+    def path(self, filepath):
+        """
+        Get the path to the optimized copy of a data file
+
+        :param filepath: path to data file
+
+        :returns: `str` of path to optimized copy
+        """
+
+        return '{}.tif'.format(
+            os.path.join(self.optimized_dir, filepath.lstrip(os.sep)))
+
+    def is_current(self, filepath):
+        """
+        Check whether the optimized copy of a data file is up to date
+
+        :param filepath: path to data file
+
+        :returns: `bool` of whether the optimized copy can be used
+        """
+
+        try:
+            return (os.stat(self.path(filepath)).st_mtime_ns ==
+                    os.stat(filepath).st_mtime_ns)
+        except OSError:
+            return False
+
+    def optimize(self, filepath):
+        """
+        Convert a data file to its optimized copy, if needed
+
+        :param filepath: path to data file
+
+        :returns: `bool` of whether the optimized copy is up to date
+        """
+
+        if not filepath.lower().endswith(OPTIMIZED_FORMATS):
+            return False
+
+        if self.is_current(filepath):
+            return True
+
+        try:
+            return convert(filepath, self.path(filepath))
+        except Exception as err:
+            LOGGER.warning('Could not optimize {}: {}'.format(filepath, err))
+            return False
+
+    def _run(self, key, func, *args):
+        try:
+            func(*args)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _submit(self, key, func, *args):
+        # run a conversion in the background, unless already pending
+        with self._lock:
+            if key not in self._pending:
+                self._pending.add(key)
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers)
+                self._executor.submit(self._run, key, func, *args)
+
+    def resolve(self, filepath):
+        """
+        Get the data file to render: the optimized copy if it is up to
+        date, or the data file itself while its copy is converted in the
+        background
+
+        :param filepath: path to data file
+
+        :returns: `str` of path to data file to render
+        """
+
+        if not filepath.lower().endswith(OPTIMIZED_FORMATS):
+            return filepath
+
+        if self.is_current(filepath):
+            METRICS.incr('data_optimizer.hits')
+            return self.path(filepath)
+
+        METRICS.incr('data_optimizer.misses')
+
+        if os.path.isfile(filepath):
+            self._submit(filepath, self.optimize, filepath)
+
+        return filepath
+
+    def prune(self):
+        """
+        Remove the optimized copies of data files which no longer exist
+        or were replaced
+
+        :returns: `int` of number of removed copies
+        """
+
+        count = 0
+
+        for root, dirs, files in os.walk(self.optimized_dir):
+            if root == self.optimized_dir and 'grids' in dirs:
+                # warp grids are evicted by geomet_mapfile.warp
+                dirs.remove('grids')
+            for name in files:
+                optimized = os.path.join(root, name)
+                if name.startswith('.optimize-'):
+                    # conversion interrupted more than a day ago
+                    if os.stat(optimized).st_mtime < time.time() - 86400:
+                        os.remove(optimized)
+                    continue
+                filepath = optimized_source(
+                    os.path.relpath(optimized, self.optimized_dir))
+                if not self.is_current(os.sep + filepath):
+                    LOGGER.debug('Removing {}'.format(optimized))
+                    os.remove(optimized)
+                    count += 1
+
+        return count
+
+
+def optimized_source(path):
+    """
+    Get the data file of an optimized copy
+
+    :param path: `str` of path to optimized copy, relative to the
+                 optimized copies directory
+
+    :returns: `str` of path to data file (relative to the root directory)
+    """
+
+    return path[:-len('.tif')]
+
+
+@click.group()
+def data():
+    """Manage optimized copies of layer data files"""
+    pass
+
+
+def get_optimizer():
+    """
+    Get the data optimizer of the configured directory
+
+    :returns: `geomet_mapfile.optimize.DataOptimizer`
+    """
+
+    return DataOptimizer(
+        OPTIMIZED_DATA_DIR or os.path.join(BASEDIR, 'cache', 'data'))
+
+
+@click.command()
+@click.pass_context
+@click.argument('filepaths', nargs=-1,
+                type=click.Path(exists=True, resolve_path=True,
+                                dir_okay=False))
+def optimize(ctx, filepaths):
+    """convert data files to tiled GeoTIFF with overviews"""
+
+    optimizer = get_optimizer()
+
+    for filepath in filepaths:
+        if optimizer.optimize(filepath):
+            click.echo('{} -> {}'.format(filepath, optimizer.path(filepath)))
+        else:
+            click.echo('Could not optimize {}'.format(filepath))
+
+
+@click.command()
+@click.pass_context
+def prune(ctx):
+    """remove optimized copies of removed or replaced data files"""
+
+    count = get_optimizer().prune()
+    click.echo('Removed {} optimized copies'.format(count))
+
+
+data.add_command(optimize)
+data.add_command(prune)
@@ -25,10 +25,12 @@ LOGGER = logging.getLogger(__name__)
 
 PLUGINS = {
     'store': {
-        'Redis': 'geomet_mapfile.store.redis_.RedisStore'
+        'Redis': 'geomet_mapfile.store.redis_.RedisStore',
+        'SQLite': 'geomet_mapfile.store.sqlite_.SQLiteStore'
     },
     'tileindex': {
-        'Elasticsearch': 'geomet_data_registry.tileindex.elasticsearch_.ElasticsearchTileIndex'  # noqa
+        'Elasticsearch': 'geomet_mapfile.tileindex.elasticsearch_.ElasticsearchTileIndex',  # noqa
+        'SQLite': 'geomet_mapfile.tileindex.sqlite_.SQLiteTileIndex'
     }
 }
 
@@ -0,0 +1,166 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import cProfile
+import io
+import logging
+import pstats
+import time
+
+import click
+
+LOGGER = logging.getLogger(__name__)
+
+# active phase profiler (None when profiling is disabled)
+PROFILER = None
+
+NULL_CONTEXT = nullcontext()
+
+
+class PhaseProfiler:
+    """Collects exclusive wall clock time per phase and per layer"""
+
+    def __init__(self):
+        """
+        Initialize object
+
+        :returns: `geomet_mapfile.profiling.PhaseProfiler`
+        """
+
+        self.phases = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.layers = defaultdict(float)
+        self._stack = []
+
+    @contextmanager
+    def timed(self, phase, layer=None):
+        """
+        Time a phase. Time spent in nested phases is only accounted
+        for in the nested phase
+
+        :param phase: `str` of phase name
+        :param layer: `str` of layer the phase is run for, if any
+        """
+
+        frame = [0.0]
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            exclusive = elapsed - frame[0]
+
+            self.phases[phase] += exclusive
+            self.calls[phase] += 1
+            if layer is not None:
+                self.layers[layer] += exclusive
+            if self._stack:
+                self._stack[-1][0] += elapsed
+
+    def report(self, top=10):
+        """
+        Format the per-phase breakdown and the slowest layers
+
+        :param top: `int` of number of slowest layers to list
+
+        :returns: `str` of timing report
+        """
+
+        total = sum(self.phases.values())
+        lines = ['{:<20} {:>8} {:>12} {:>7}'.format(
+            'phase', 'calls', 'seconds', '%')]
+
+        for phase, seconds in sorted(self.phases.items(),
+                                     key=lambda item: item[1], reverse=True):
+            lines.append('{:<20} {:>8} {:>12.4f} {:>6.1f}%'.format(
+                phase, self.calls[phase], seconds,
+                seconds / total * 100 if total else 0))
+
+        lines.append('{:<20} {:>8} {:>12.4f}'.format('total', '', total))
+
+        if self.layers:
+            lines.append('')
+            lines.append('slowest {} layers:'.format(
+                min(top, len(self.layers))))
+            slowest = sorted(self.layers.items(),
+                             key=lambda item: item[1], reverse=True)[:top]
+            for layer, seconds in slowest:
+                lines.append('{:<50} {:>12.4f}'.format(layer, seconds))
+
+        return '\n'.join(lines)
+
+
+def timed(phase, layer=None):
+    """
+    Time a phase with the active profiler, if any
+
+    :param phase: `str` of phase name
+    :param layer: `str` of layer the phase is run for, if any
+
+    :returns: context manager
+    """
+
+    if PROFILER is None:
+        return NULL_CONTEXT
+
+    return PROFILER.timed(phase, layer)
+
+
+@contextmanager
+def profiling(enabled=True, output=None, top=10):
+    """
+    Profile a block of code with cProfile and the phase profiler, and
+    report results on exit
+
+    :param enabled: `bool` of whether to profile
+    :param output: path to write cProfile stats to (printed if `None`)
+    :param top: `int` of number of slowest layers to list
+    """
+
+    global PROFILER
+
+    if not enabled:
+        yield
+        return
+
+    PROFILER = PhaseProfiler()
+    profile = cProfile.Profile()
+    profile.enable()
+
+    try:
+        yield
+    finally:
+        profile.disable()
+        profiler, PROFILER = PROFILER, None
+
+        if output is not None:
+            profile.dump_stats(output)
+            click.echo('cProfile stats written to {}'.format(output))
+        else:
+            stream = io.StringIO()
+            stats = pstats.Stats(profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(25)
+            click.echo(stream.getvalue())
+
+        click.echo(profiler.report(top))
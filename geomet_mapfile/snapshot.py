@@ -0,0 +1,302 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Versioned store snapshots of mapfiles.
+#
+# An entire mapfile generation is written to the store under generation
+# numbered keys (e.g. geomet-mapfile_GDPS.ETA_TT_mapfile@42), then made
+# current by setting the geomet-mapfile_current pointer. Partial
+# generations and updates write to the current generation. Every write
+# increments geomet-mapfile_revision, so that readers can detect changes
+# of the current generation with a single request.
+#
+# Switching the current generation and partial updates hold a short-lived
+# store lock (geomet-mapfile_generation_lock), so that updates are not
+# written to a generation which is being replaced. The keys of each
+# generation are tracked in a store set (geomet-mapfile_generation_<n>_keys)
+# so that old generations are deleted without scanning the keyspace.
+#
+# Each mapfile of a generation has a content version key (e.g.
+# geomet-mapfile_GDPS.ETA_TT_mapfile@42#version), so that readers caching
+# mapfiles only fetch again the mapfiles which changed.
+
+from contextlib import contextmanager
+import logging
+import re
+import time
+import uuid
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+CURRENT_KEY = 'current'
+GENERATION_KEY = 'generation'
+REVISION_KEY = 'revision'
+LOCK_KEY = 'generation_lock'
+MEMBERS_KEY = 'generation_{}_keys'
+MEMBERS_KEY_REGEX = re.compile(r'generation_(\d+)_keys$')
+VERSION_SUFFIX = '#version'
+
+# number of previous generations to keep for in-flight readers
+KEEP_GENERATIONS = 1
+
+# time to live of the generation lock, and maximum time to wait for it
+# (seconds)
+LOCK_TTL = 30
+LOCK_TIMEOUT = 10
+
+# delay between two attempts to acquire the generation lock (seconds)
+LOCK_POLL_INTERVAL = 0.01
+
+# number of attempts of a partial update racing generation publications
+UPDATE_ATTEMPTS = 3
+
+
+def versioned_key(key, generation):
+    """
+    Get the store key of a mapfile key in a given generation
+
+    :param key: `str` of mapfile key (e.g. GDPS.ETA_TT_mapfile)
+    :param generation: `int` of generation (`None` for unversioned key)
+
+    :returns: `str` of store key
+    """
+
+    if generation is None:
+        return key
+
+    return f'{key}@{generation}'
+
+
+def current_generation(store):
+    """
+    Get the current generation and revision of store snapshots
+
+    :param store: store plugin
+
+    :returns: `tuple` of current generation (`None` if no generation
+              was published) and revision
+    """
+
+    values = store.get_keys([CURRENT_KEY, REVISION_KEY])
+
+    generation = values[CURRENT_KEY]
+    revision = values[REVISION_KEY]
+
+    return (int(generation) if generation is not None else None,
+            int(revision) if revision is not None else 0)
+
+
+def version_key(key, generation):
+    """
+    Get the store key of the content version of a mapfile
+
+    :param key: `str` of mapfile key (e.g. GDPS.ETA_TT_mapfile)
+    :param generation: `int` of generation
+
+    :returns: `str` of store key
+    """
+
+    return versioned_key(key, generation) + VERSION_SUFFIX
+
+
+def content_version(content):
+    """
+    Get the content version of a mapfile
+
+    :param content: `str` of mapfile
+
+    :returns: `str` of content version
+    """
+
+    return '{:08x}'.format(zlib.crc32(str(content).encode()))
+
+
+@contextmanager
+def generation_lock(store, timeout=None):
+    """
+    Hold the generation lock
+
+    :param store: store plugin
+    :param timeout: `float` of maximum time to wait for the lock (seconds,
+                    `LOCK_TIMEOUT` if `None`)
+
+    :returns: context manager of `bool` of whether the lock is held (the
+              block runs unlocked if the lock could not be acquired)
+    """
+
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + (
+        LOCK_TIMEOUT if timeout is None else timeout)
+
+    while not store.set_key_nx(LOCK_KEY, token, LOCK_TTL):
+        if time.monotonic() >= deadline:
+            LOGGER.warning('Could not acquire store generation lock')
+            yield False
+            return
+        time.sleep(LOCK_POLL_INTERVAL)
+
+    try:
+        yield True
+    finally:
+        # the lock may have expired and been acquired by another writer
+        if store.get_key(LOCK_KEY) == token:
+            store.delete_key(LOCK_KEY)
+
+
+def write_generation(store, values, generation):
+    """
+    Write mapfiles and their content versions to a generation, and track
+    them in the generation keys
+
+    :param store: store plugin
+    :param values: `dict` of mapfile key to mapfile
+    :param generation: `int` of generation (`None` for unversioned keys)
+
+    :returns: `None`
+    """
+
+    keys = {versioned_key(key, generation): value
+            for key, value in values.items()}
+
+    if generation is not None:
+        keys.update({version_key(key, generation): content_version(value)
+                     for key, value in values.items()})
+
+    # tracked first, so that keys of an interrupted write are deleted with
+    # their generation
+    if generation is not None:
+        store.add_members(MEMBERS_KEY.format(generation), list(keys))
+
+    store.set_keys(keys)
+
+
+def publish_snapshot(store, values):
+    """
+    Write the mapfiles of an entire generation and make it current
+
+    :param store: store plugin
+    :param values: `dict` of mapfile key to mapfile
+
+    :returns: `int` of published generation
+    """
+
+    generation = store.incr_key(GENERATION_KEY)
+
+    write_generation(store, values, generation)
+
+    with generation_lock(store):
+        previous, _ = current_generation(store)
+        # a slower concurrent publication does not replace a newer one
+        if previous is None or generation > previous:
+            store.set_key(CURRENT_KEY, generation)
+            store.incr_key(REVISION_KEY)
+
+    LOGGER.info(f'Published store generation {generation}')
+
+    delete_old_generations(store, generation, legacy=previous is None)
+
+    return generation
+
+
+def update_snapshot(store, values, generation=None):
+    """
+    Write mapfiles to a generation. Updates of the current generation
+    replaced by a new generation meanwhile are written again to the new
+    current generation
+
+    :param store: store plugin
+    :param values: `dict` of mapfile key to mapfile
+    :param generation: `int` of generation the mapfiles were read from, only
+                       written to if still current (current generation if
+                       `None`)
+
+    :returns: `int` of updated generation (`None` if no generation
+              was published, in which case unversioned keys are written)
+    """
+
+    for _ in range(UPDATE_ATTEMPTS):
+        with generation_lock(store):
+            current, _ = current_generation(store)
+            if generation is not None and generation != current:
+                LOGGER.warning(f'Store generation {generation} was '
+                               f'replaced by {current}, skipping update')
+                return current
+
+            write_generation(store, values, current)
+            store.incr_key(REVISION_KEY)
+
+        # the generation cannot change while the lock is held, unless the
+        # lock could not be acquired or expired
+        if current_generation(store)[0] == current:
+            return current
+
+        if generation is not None:
+            LOGGER.warning(f'Store generation {generation} was replaced '
+                           'while updating')
+            return current
+
+        LOGGER.debug('Store generation replaced while updating, writing '
+                     'again')
+
+    return current
+
+
+def delete_old_generations(store, generation, keep=KEEP_GENERATIONS,
+                           legacy=False):
+    """
+    Delete the mapfiles of generations older than the `keep` generations
+    preceding a generation
+
+    :param store: store plugin
+    :param generation: `int` of current generation
+    :param keep: `int` of number of previous generations to keep
+    :param legacy: `bool` of whether to also delete unversioned mapfiles
+                   (written before the first generation)
+
+    :returns: `int` of number of deleted keys
+    """
+
+    keys = []
+
+    # generations are listed rather than counted down, as publications
+    # interrupted before tracking their keys leave gaps
+    pattern = 'geomet-mapfile_{}'.format(MEMBERS_KEY.format('*'))
+    for members_key in store.list_keys(pattern):
+        match = MEMBERS_KEY_REGEX.search(members_key)
+        if match is None or int(match.group(1)) >= generation - keep:
+            continue
+        keys.extend(store.pop_members(MEMBERS_KEY.format(match.group(1))))
+
+    if keys:
+        LOGGER.debug(f'Deleting {len(keys)} keys of old generations')
+        store.delete_keys(keys)
+
+    if legacy:
+        legacy_keys = []
+        for pattern in ['geomet-mapfile_*_mapfile',
+                        'geomet-mapfile_*_layer']:
+            legacy_keys.extend(store.list_keys(pattern))
+        if legacy_keys:
+            LOGGER.debug(f'Deleting {len(legacy_keys)} unversioned keys')
+            store.delete_keys(legacy_keys, raw=True)
+        keys.extend(legacy_keys)
+
+    return len(keys)
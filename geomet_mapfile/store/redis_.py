@@ -19,6 +19,9 @@
 ###############################################################################
 
 import logging
+import time
+
+import redis
 
 from geomet_mapfile import __version__
 from geomet_data_registry.store.redis_ import RedisStore as RedisStore_
@@ -72,17 +75,196 @@ class RedisStore(RedisStore_):
 
         return self.redis.get('geomet-mapfile_{}'.format(key))
 
-    def set_key(self, key, value, raw=False):
+    def set_key(self, key, value, raw=False, expire=None):
         """
         Set key value from Redis store
 
         :param key: key to set value
         :param value: value to set
+        :param raw: `bool` of whether key is used as is (without
+                    geomet-mapfile prefix)
+        :param expire: `int` of key time to live (seconds)
 
         :returns: `bool` of set success
         """
 
         if raw:
-            return self.redis.set(key, value)
+            return self.redis.set(key, value, ex=expire)
+
+        return self.redis.set('geomet-mapfile_{}'.format(key), value,
+                              ex=expire)
+
+    def get_keys(self, keys, raw=False):
+        """
+        Get the values of many keys from Redis store at once
+
+        :param keys: `list` of keys
+        :param raw: `bool` of whether keys are used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `dict` of key to value (`None` if key does not exist)
+        """
+
+        if not keys:
+            return {}
+
+        names = keys if raw else [f'geomet-mapfile_{key}' for key in keys]
+
+        return dict(zip(keys, self.redis.mget(names)))
+
+    def set_keys(self, values, raw=False):
+        """
+        Set the values of many keys in Redis store in a single round trip
+
+        :param values: `dict` of key to value
+        :param raw: `bool` of whether keys are used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `bool` of set success
+        """
+
+        if not values:
+            return True
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(key if raw else f'geomet-mapfile_{key}', value)
+
+        return all(pipeline.execute())
+
+    def incr_key(self, key):
+        """
+        Increment the integer value of a key in Redis store
+
+        :param key: key to increment
+
+        :returns: `int` of incremented value
+        """
+
+        return self.redis.incr(f'geomet-mapfile_{key}')
+
+    def delete_keys(self, keys, raw=False):
+        """
+        Delete many keys from Redis store at once
+
+        :param keys: `list` of keys
+        :param raw: `bool` of whether keys are used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `int` of number of deleted keys
+        """
+
+        if not keys:
+            return 0
+
+        names = keys if raw else [f'geomet-mapfile_{key}' for key in keys]
+
+        return self.redis.delete(*names)
+
+    def add_members(self, key, members):
+        """
+        Add members to a set in Redis store
+
+        :param key: key of set
+        :param members: `list` of members to add
+
+        :returns: `int` of number of members added
+        """
+
+        if not members:
+            return 0
+
+        return self.redis.sadd(f'geomet-mapfile_{key}', *members)
+
+    def pop_members(self, key):
+        """
+        Get and delete all members of a set in Redis store
+
+        :param key: key of set
+
+        :returns: `set` of members
+        """
+
+        pipeline = self.redis.pipeline()
+        pipeline.smembers(f'geomet-mapfile_{key}')
+        pipeline.delete(f'geomet-mapfile_{key}')
+        members, _ = pipeline.execute()
+
+        return members
+
+    def set_key_nx(self, key, value, expire=None):
+        """
+        Set key value in Redis store only if it does not exist
+
+        :param key: key to set value
+        :param value: value to set
+        :param expire: `int` of key time to live (seconds)
+
+        :returns: `bool` of whether key was set
+        """
+
+        return bool(self.redis.set(f'geomet-mapfile_{key}', value,
+                                   nx=True, ex=expire))
+
+    def delete_key(self, key):
+        """
+        Delete key from Redis store
+
+        :param key: key to delete
+
+        :returns: `bool` of whether key was deleted
+        """
+
+        return bool(self.redis.delete(f'geomet-mapfile_{key}'))
+
+    def listen_keys(self, patterns, timeout=1):
+        """
+        Listen to changes of keys, through Redis keyspace notifications.
+        Keyspace notifications are enabled for string commands if needed.
+        Notifications are not persisted: changes made while not listening
+        (e.g. while reconnecting) are missed
+
+        :param patterns: `list` of glob-style raw key patterns
+        :param timeout: `float` of seconds to wait for a change before
+                        yielding `None`
+
+        :returns: generator of changed key names (`None` on timeout)
+        """
+
+        db = self.redis.connection_pool.connection_kwargs.get('db', 0)
+        prefix = f'__keyspace@{db}__:'
+
+        while True:
+            try:
+                self._enable_keyspace_notifications()
+
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(
+                    *[f'{prefix}{pattern}' for pattern in patterns]
+                )
+                try:
+                    while True:
+                        message = pubsub.get_message(timeout=timeout)
+                        if message is None:
+                            yield None
+                        else:
+                            yield message['channel'][len(prefix):]
+                finally:
+                    pubsub.close()
+            except redis.exceptions.ConnectionError as err:
+                LOGGER.warning(f'Lost Redis connection: {err}. Retrying')
+                time.sleep(timeout)
 
-        return self.redis.set('geomet-mapfile_{}'.format(key), value)
+    def _enable_keyspace_notifications(self):
+        try:
+            events = self.redis.config_get(
+                'notify-keyspace-events'
+            ).get('notify-keyspace-events', '')
+            if 'K' not in events or not ('$' in events or 'A' in events):
+                LOGGER.info('Enabling Redis keyspace notifications')
+                self.redis.config_set('notify-keyspace-events',
+                                      f'{events}K$')
+        except redis.exceptions.ResponseError as err:
+            LOGGER.warning(
+                f'Could not enable Redis keyspace notifications: {err}'
+            )
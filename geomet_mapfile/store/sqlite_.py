@@ -0,0 +1,406 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+from fnmatch import fnmatchcase
+import logging
+import time
+
+from geomet_data_registry.store.base import BaseStore
+
+from geomet_mapfile import __version__
+from geomet_mapfile.util import SQLiteDatabase
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS keys (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        expiry REAL,
+        revision INTEGER
+    )''',
+    '''CREATE INDEX IF NOT EXISTS keys_revision ON keys (revision)''',
+    '''CREATE TABLE IF NOT EXISTS members (
+        key TEXT,
+        member TEXT,
+        PRIMARY KEY (key, member)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS revision (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        value INTEGER
+    )''',
+    '''INSERT OR IGNORE INTO revision VALUES (0, 0)'''
+]
+
+# maximum number of SQL variables of a single query
+MAX_VARIABLES = 500
+
+# delay between two polls of changed keys (seconds)
+POLL_INTERVAL = 0.1
+
+NOT_EXPIRED = '(expiry IS NULL OR expiry > ?)'
+
+
+def to_text(value):
+    """
+    Convert a value to text, as stored by Redis
+
+    :param value: value to convert
+
+    :returns: `str` of value
+    """
+
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return str(value)
+
+
+class SQLiteStore(BaseStore):
+    """SQLite key-value store implementation, in a single local file"""
+
+    def __init__(self, provider_def):
+        """
+        Initialize object
+
+        :param provider_def: provider definition `dict` (url is the path
+                             to the SQLite file)
+
+        :returns: `geomet_mapfile.store.sqlite_.SQLiteStore`
+        """
+
+        super().__init__(provider_def)
+
+        self.database = SQLiteDatabase(self.url, SCHEMA)
+
+    @property
+    def db(self):
+        """`sqlite3.Connection` of current thread"""
+
+        return self.database.connect()
+
+    def _key(self, key, raw=False):
+        return key if raw else f'geomet-mapfile_{key}'
+
+    def _lock(self, db):
+        # take the write lock of the database, so that reads and writes of
+        # the current transaction are atomic across processes
+        db.execute('UPDATE revision SET value = value')
+
+    def _set(self, db, items, expire=None):
+        # items are (key, value) tuples, keys are prefixed
+        expiry = time.time() + expire if expire is not None else None
+
+        db.execute('UPDATE revision SET value = value + 1')
+        db.executemany(
+            'INSERT OR REPLACE INTO keys VALUES '
+            '(?, ?, ?, (SELECT value FROM revision))',
+            [(key, to_text(value), expiry) for key, value in items]
+        )
+
+    def setup(self):
+        """
+        Create the store
+
+        :returns: `bool` of process status
+        """
+
+        return self.set_key('geomet-mapfile-version', __version__, raw=True)
+
+    def teardown(self):
+        """
+        Delete the store
+
+        :returns: `bool` of process status
+        """
+
+        LOGGER.debug('Deleting all geomet-mapfile SQLite keys')
+
+        with self.db as db:
+            db.execute("DELETE FROM keys WHERE key GLOB 'geomet-mapfile*'")
+            db.execute("DELETE FROM members WHERE key GLOB 'geomet-mapfile*'")
+
+        return True
+
+    def get_key(self, key, raw=False):
+        """
+        Get key value from SQLite store
+
+        :param key: key to get value
+        :param raw: `bool` of whether key is used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `str` of key value (`None` if key does not exist)
+        """
+
+        row = self.db.execute(
+            f'SELECT value FROM keys WHERE key = ? AND {NOT_EXPIRED}',
+            (self._key(key, raw), time.time())
+        ).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_key(self, key, value, raw=False, expire=None):
+        """
+        Set key value in SQLite store
+
+        :param key: key to set value
+        :param value: value to set
+        :param raw: `bool` of whether key is used as is (without
+                    geomet-mapfile prefix)
+        :param expire: `int` of key time to live (seconds)
+
+        :returns: `bool` of set success
+        """
+
+        with self.db as db:
+            self._set(db, [(self._key(key, raw), value)], expire)
+
+        return True
+
+    def list_keys(self, pattern=None):
+        """
+        List all store keys
+
+        :param pattern: glob-style pattern to filter keys on
+
+        :returns: `list` of all store keys
+        """
+
+        rows = self.db.execute(
+            f'SELECT key FROM keys WHERE {NOT_EXPIRED} AND key GLOB ? '
+            'UNION SELECT DISTINCT key FROM members WHERE key GLOB ?',
+            (time.time(), pattern or '*', pattern or '*')
+        )
+
+        return [row[0] for row in rows]
+
+    def get_keys(self, keys, raw=False):
+        """
+        Get the values of many keys from SQLite store at once
+
+        :param keys: `list` of keys
+        :param raw: `bool` of whether keys are used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `dict` of key to value (`None` if key does not exist)
+        """
+
+        names = {self._key(key, raw): key for key in keys}
+        values = {key: None for key in keys}
+        now = time.time()
+
+        names_ = list(names)
+        for i in range(0, len(names_), MAX_VARIABLES):
+            chunk = names_[i:i + MAX_VARIABLES]
+            rows = self.db.execute(
+                'SELECT key, value FROM keys WHERE key IN ({}) AND {}'.format(
+                    ','.join('?' * len(chunk)), NOT_EXPIRED),
+                chunk + [now]
+            )
+            for name, value in rows:
+                values[names[name]] = value
+
+        return values
+
+    def set_keys(self, values, raw=False):
+        """
+        Set the values of many keys in SQLite store in a single transaction
+
+        :param values: `dict` of key to value
+        :param raw: `bool` of whether keys are used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `bool` of set success
+        """
+
+        if not values:
+            return True
+
+        with self.db as db:
+            self._set(db, [(self._key(key, raw), value)
+                           for key, value in values.items()])
+
+        return True
+
+    def incr_key(self, key):
+        """
+        Increment the integer value of a key in SQLite store
+
+        :param key: key to increment
+
+        :returns: `int` of incremented value
+        """
+
+        name = self._key(key)
+
+        with self.db as db:
+            db.execute('UPDATE revision SET value = value + 1')
+            db.execute(
+                'INSERT INTO keys VALUES '
+                '(?, 1, NULL, (SELECT value FROM revision)) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                'value = CASE WHEN expiry IS NULL OR expiry > ? '
+                'THEN CAST(value AS INTEGER) + 1 ELSE 1 END, '
+                'expiry = CASE WHEN expiry > ? THEN expiry END, '
+                'revision = excluded.revision',
+                (name, time.time(), time.time())
+            )
+            value = db.execute('SELECT value FROM keys WHERE key = ?',
+                               (name,)).fetchone()[0]
+
+        return int(value)
+
+    def delete_keys(self, keys, raw=False):
+        """
+        Delete many keys from SQLite store at once
+
+        :param keys: `list` of keys
+        :param raw: `bool` of whether keys are used as is (without
+                    geomet-mapfile prefix)
+
+        :returns: `int` of number of deleted keys
+        """
+
+        names = [self._key(key, raw) for key in keys]
+        count = 0
+
+        with self.db as db:
+            for i in range(0, len(names), MAX_VARIABLES):
+                chunk = names[i:i + MAX_VARIABLES]
+                count += db.execute(
+                    'DELETE FROM keys WHERE key IN ({})'.format(
+                        ','.join('?' * len(chunk))), chunk).rowcount
+
+        return count
+
+    def add_members(self, key, members):
+        """
+        Add members to a set in SQLite store
+
+        :param key: key of set
+        :param members: `list` of members to add
+
+        :returns: `int` of number of members added
+        """
+
+        name = self._key(key)
+
+        with self.db as db:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO members VALUES (?, ?)',
+                           [(name, to_text(member)) for member in members])
+            count = db.total_changes - before
+
+        return count
+
+    def pop_members(self, key):
+        """
+        Get and delete all members of a set in SQLite store
+
+        :param key: key of set
+
+        :returns: `set` of members
+        """
+
+        name = self._key(key)
+
+        with self.db as db:
+            self._lock(db)
+            members = {row[0] for row in db.execute(
+                'SELECT member FROM members WHERE key = ?', (name,))}
+            db.execute('DELETE FROM members WHERE key = ?', (name,))
+
+        return members
+
+    def set_key_nx(self, key, value, expire=None):
+        """
+        Set key value in SQLite store only if it does not exist
+
+        :param key: key to set value
+        :param value: value to set
+        :param expire: `int` of key time to live (seconds)
+
+        :returns: `bool` of whether key was set
+        """
+
+        name = self._key(key)
+
+        with self.db as db:
+            self._lock(db)
+            db.execute(f'DELETE FROM keys WHERE key = ? AND NOT {NOT_EXPIRED}',
+                       (name, time.time()))
+            if db.execute('SELECT 1 FROM keys WHERE key = ?',
+                          (name,)).fetchone() is not None:
+                return False
+            self._set(db, [(name, value)], expire)
+
+        return True
+
+    def delete_key(self, key):
+        """
+        Delete key from SQLite store
+
+        :param key: key to delete
+
+        :returns: `bool` of whether key was deleted
+        """
+
+        return self.delete_keys([key]) > 0
+
+    def listen_keys(self, patterns, timeout=1):
+        """
+        Listen to changes of keys, by polling the revisions of keys.
+        Deleted keys are not reported
+
+        :param patterns: `list` of glob-style raw key patterns
+        :param timeout: `float` of seconds to wait for a change before
+                        yielding `None`
+
+        :returns: generator of changed key names (`None` on timeout)
+        """
+
+        revision = self.db.execute(
+            'SELECT value FROM revision').fetchone()[0]
+        waited = 0
+
+        while True:
+            rows = self.db.execute(
+                'SELECT key, revision FROM keys WHERE revision > ? '
+                'ORDER BY revision', (revision,)).fetchall()
+
+            changed = False
+            for key, revision_ in rows:
+                revision = max(revision, revision_)
+                if any(fnmatchcase(key, pattern) for pattern in patterns):
+                    changed = True
+                    yield key
+
+            if changed:
+                waited = 0
+            elif waited >= timeout:
+                waited = 0
+                yield None
+            else:
+                time.sleep(min(POLL_INTERVAL, timeout))
+                waited += min(POLL_INTERVAL, timeout)
+
+    def __repr__(self):
+        return '<SQLiteStore> {}'.format(self.database.filepath)
@@ -18,24 +18,39 @@
 ###############################################################################
 
 import logging
+import time
 
 from celery import Celery
 from geomet_mapfile.env import (
     CELERY_BROKER_URL,
     MAPFILE_STORAGE,
+    REFRESH_BATCH_WINDOW
 )
-from geomet_mapfile.mapfile import generate_mapfile, LayerTimeConfigError
+from geomet_mapfile.mapfile import (
+    GenerationContext,
+    generate_mapfile,
+    LayerTimeConfigError
+)
+from geomet_mapfile.optimize import get_optimizer
 
 LOGGER = logging.getLogger(__name__)
 
+# store keys of layers pending a batched refresh and of the scheduled flush
+# of these layers, per output
+PENDING_KEY = 'refresh_pending_{}'
+SCHEDULED_KEY = 'refresh_scheduled_{}'
+
 if CELERY_BROKER_URL is not None:
     app = Celery(
         'geomet-mapfile', backend=CELERY_BROKER_URL, broker=CELERY_BROKER_URL
     )
 
+    # generation inputs are kept warm across the tasks of a worker process
+    CONTEXT = GenerationContext()
+
     @app.task(name='refresh_mapfile')
     def refresh_mapfile(layer_name, output=MAPFILE_STORAGE):
-        result = generate_mapfile(layer_name, output)
+        result = generate_mapfile(layer_name, output, context=CONTEXT)
         if not result:
             msg = (
                 f'Error refreshing mapfile. Could not retrieve {layer_name} '
@@ -43,6 +58,126 @@ if CELERY_BROKER_URL is not None:
             )
             raise LayerTimeConfigError(msg)
 
+    def refresh_batch(layers, output):
+        """
+        Generate the mapfiles of many layers in a single pass
+
+        :param layers: iterable of layer names
+        :param output: `str` of output (file or store)
+
+        :returns: `dict` of batch report
+        """
+
+        catalog = CONTEXT.catalog
+        requested = set(layers)
+        # keep configuration order
+        layers = [name for name in catalog.layer_names if name in requested]
+        unknown = sorted(requested.difference(layers))
+
+        if unknown:
+            LOGGER.warning(f'Skipping unknown layers: {", ".join(unknown)}')
+
+        start = time.perf_counter()
+        if layers:
+            result = generate_mapfile(layers, output, context=CONTEXT)
+        else:
+            result = True
+        elapsed = time.perf_counter() - start
+
+        report = {
+            'layers': len(layers),
+            'unknown': unknown,
+            'seconds': round(elapsed, 3),
+            'time_errors': not result
+        }
+
+        LOGGER.info(
+            f'Refreshed {len(layers)} layers in {elapsed:.3f}s '
+            f'({elapsed / max(len(layers), 1):.3f}s per layer)'
+        )
+        if not result:
+            LOGGER.error(
+                'Could not retrieve time extent information from store '
+                'for some layers of batch'
+            )
+
+        return report
+
+    @app.task(name='refresh_mapfiles')
+    def refresh_mapfiles(layers=None, forecast_model=None,
+                         output=MAPFILE_STORAGE):
+        """
+        Refresh the mapfiles of many layers. Layers are queued and
+        refreshed together with the layers requested during the next
+        GEOMET_MAPFILE_REFRESH_BATCH_WINDOW seconds (refreshed right away
+        if 0)
+
+        :param layers: `list` of layer names
+        :param forecast_model: `str` of forecast model whose layers to refresh
+        :param output: `str` of output (file or store)
+
+        :returns: `dict` of batch report or of queued layers
+        """
+
+        layers = list(layers or [])
+
+        if forecast_model is not None:
+            try:
+                layers.extend(CONTEXT.catalog.get_model_layers(forecast_model))
+            except KeyError:
+                LOGGER.warning(f'Unknown forecast model {forecast_model}')
+
+        if not layers or REFRESH_BATCH_WINDOW <= 0:
+            return refresh_batch(layers, output)
+
+        st = CONTEXT.store
+        st.add_members(PENDING_KEY.format(output), layers)
+
+        # the flag expires in case the scheduled flush is lost
+        if st.set_key_nx(SCHEDULED_KEY.format(output), 1,
+                         expire=int(REFRESH_BATCH_WINDOW) + 60):
+            flush_mapfile_refreshes.apply_async(
+                args=[output], countdown=REFRESH_BATCH_WINDOW
+            )
+
+        return {'queued': len(layers)}
+
+    @app.task(name='flush_mapfile_refreshes')
+    def flush_mapfile_refreshes(output=MAPFILE_STORAGE):
+        """
+        Refresh the mapfiles of all layers pending a batched refresh
+
+        :param output: `str` of output (file or store)
+
+        :returns: `dict` of batch report
+        """
+
+        st = CONTEXT.store
+
+        # clear the flag first, so that layers queued from now on are
+        # refreshed by a new flush
+        st.delete_key(SCHEDULED_KEY.format(output))
+        layers = st.pop_members(PENDING_KEY.format(output))
+
+        return refresh_batch(layers, output)
+
+    @app.task(name='optimize_data')
+    def optimize_data(filepaths):
+        """
+        Convert newly received data files to their optimized copies, ahead
+        of the first requests rendering them
+
+        :param filepaths: `list` of paths to data files
+
+        :returns: `dict` of optimization report
+        """
+
+        optimizer = get_optimizer()
+        optimized = [filepath for filepath in filepaths
+                     if optimizer.optimize(filepath)]
+
+        return {'optimized': len(optimized), 'total': len(filepaths)}
+
 
 else:
     LOGGER.debug(
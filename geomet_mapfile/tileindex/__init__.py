@@ -0,0 +1,74 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import logging
+import time
+
+import click
+
+from geomet_mapfile.env import (TILEINDEX_NAME, TILEINDEX_REPLICA,
+                                TILEINDEX_TYPE, TILEINDEX_URL)
+from geomet_mapfile.plugin import load_plugin
+from geomet_mapfile.tileindex.replica import sync_replica
+from geomet_mapfile.tileindex.sqlite_ import SQLiteTileIndex
+
+LOGGER = logging.getLogger(__name__)
+
+
+@click.group()
+def tileindex():
+    """Manage the local tile index replica"""
+    pass
+
+
+@click.command()
+@click.pass_context
+@click.option('--full', is_flag=True, help='replicate all documents')
+@click.option('--interval', type=int, default=0,
+              help='sync every INTERVAL seconds (0 to sync once)')
+def sync(ctx, full=False, interval=0):
+    """refresh the local tile index replica"""
+
+    if not TILEINDEX_REPLICA:
+        raise click.ClickException(
+            'GEOMET_MAPFILE_TILEINDEX_REPLICA is not set')
+
+    source = load_plugin('tileindex', {
+        'type': TILEINDEX_TYPE,
+        'url': TILEINDEX_URL,
+        'name': TILEINDEX_NAME
+    })
+    replica = SQLiteTileIndex({
+        'type': 'SQLite',
+        'url': TILEINDEX_REPLICA,
+        'name': TILEINDEX_NAME
+    })
+
+    while True:
+        count = sync_replica(source, replica, full)
+        click.echo('Replicated {} documents to {}'.format(
+            count, TILEINDEX_REPLICA))
+        if interval <= 0:
+            break
+        full = False
+        time.sleep(interval)
+
+
+tileindex.add_command(sync)
@@ -0,0 +1,195 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import logging
+from urllib.parse import urlparse
+
+from elasticsearch import Elasticsearch, exceptions, helpers
+from geomet_data_registry.tileindex.base import (BaseTileIndex,
+                                                 TileIndexError,
+                                                 TileNotFoundError)
+from geomet_data_registry.tileindex.elasticsearch_ import \
+    ElasticsearchTileIndex as ElasticsearchTileIndex_
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ElasticsearchTileIndex(ElasticsearchTileIndex_):
+    """Elasticsearch tile index implementation"""
+
+    def __init__(self, provider_def):
+        """
+        Initialize object
+
+        :param provider_def: provider definition `dict` (with optional
+                             timeout of connection check and lookups, in
+                             seconds)
+
+        :returns: `geomet_mapfile.tileindex.elasticsearch_.ElasticsearchTileIndex`  # noqa
+        """
+
+        self.timeout = provider_def.get('timeout') or None
+
+        if self.timeout is None:
+            super().__init__(provider_def)
+            return
+
+        # as geomet-data-registry, with a timeout on the connection check
+        BaseTileIndex.__init__(self, provider_def)
+
+        self.url_parsed = urlparse(self.url)
+        self.type_name = 'FeatureCollection'
+
+        if self.url_parsed.port is None:
+            port = 443 if self.url_parsed.scheme == 'https' else 80
+        else:
+            port = self.url_parsed.port
+
+        url_settings = {
+            'host': self.url_parsed.hostname,
+            'port': port
+        }
+
+        if self.url_parsed.path:
+            url_settings['url_prefix'] = self.url_parsed.path
+
+        self.es = Elasticsearch([url_settings])
+
+        es, params = self._client()
+        try:
+            connected = es.ping(**params)
+        except exceptions.TransportError as err:
+            LOGGER.debug(err)
+            connected = False
+
+        if not connected:
+            msg = 'Cannot connect to Elasticsearch'
+            LOGGER.error(msg)
+            raise TileIndexError(msg)
+
+    def _client(self):
+        # Elasticsearch client and request parameters of lookups
+        if self.timeout is None:
+            return self.es, {}
+
+        if hasattr(self.es, 'options'):
+            return self.es.options(request_timeout=self.timeout), {}
+
+        return self.es, {'request_timeout': self.timeout}
+
+    def get(self, identifier):
+        """
+        Get a document
+
+        :param identifier: identifier of document to retrieve
+
+        :returns: `dict` of single GeoJSON feature
+        """
+
+        es, params = self._client()
+
+        try:
+            result = es.get(index=self.name, id=identifier, **params)
+        except exceptions.NotFoundError as err:
+            LOGGER.debug('Could not get document with id: {}'.format(err))
+            raise TileNotFoundError(identifier)
+
+        return result['_source']
+
+    def get_many(self, identifiers):
+        """
+        Get many documents at once
+
+        :param identifiers: `list` of identifiers of documents to retrieve
+
+        :returns: `dict` of identifier to GeoJSON feature (`None` if not
+                  found)
+        """
+
+        if not identifiers:
+            return {}
+
+        es, params = self._client()
+
+        result = es.mget(index=self.name, body={'ids': identifiers}, **params)
+
+        return {
+            doc['_id']: doc['_source'] if doc.get('found') else None
+            for doc in result['docs']
+        }
+
+    def query_layer(self, layer, reference_datetime=None, start=None,
+                    end=None):
+        """
+        Get the documents of a layer, optionally of a single model run and
+        range of forecast hours
+
+        :param layer: `str` of layer name
+        :param reference_datetime: `str` of model run
+        :param start: `str` of first forecast hour datetime
+        :param end: `str` of last forecast hour datetime
+
+        :returns: `list` of GeoJSON features, sorted by forecast hour
+        """
+
+        filters = [{'term': {'properties.layer.raw': layer}}]
+
+        if reference_datetime is not None:
+            filters.append({
+                'term': {'properties.reference_datetime': reference_datetime}
+            })
+        if start is not None or end is not None:
+            range_ = {}
+            if start is not None:
+                range_['gte'] = start
+            if end is not None:
+                range_['lte'] = end
+            filters.append({
+                'range': {'properties.forecast_hour_datetime': range_}
+            })
+
+        query = {'query': {'bool': {'filter': filters}}}
+
+        features = [doc['_source'] for doc in
+                    helpers.scan(self.es, query=query, index=self.name)]
+
+        return sorted(features, key=lambda feature: feature['properties'].get(
+            'forecast_hour_datetime') or '')
+
+    def registered_since(self, datetime_):
+        """
+        Get the documents registered since a given datetime
+
+        :param datetime_: `str` of register datetime (ISO 8601, or
+                          Elasticsearch date math)
+
+        :returns: generator of GeoJSON features
+        """
+
+        query = {
+            'query': {
+                'range': {
+                    'properties.register_datetime': {'gte': datetime_}
+                }
+            }
+        }
+
+        for doc in helpers.scan(self.es, query=query, index=self.name):
+            yield doc['_source']
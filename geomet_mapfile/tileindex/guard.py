@@ -0,0 +1,254 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Tile index lookups resilient to a slow or unavailable tile index.
+#
+# Lookups (including loading the tile index plugin, which connects to
+# Elasticsearch) go through a circuit breaker. Successful lookups are kept
+# in a bounded in-process map of identifiers to documents: when the tile
+# index fails or the circuit is open, the last known document is served
+# (stale) instead. Optionally, documents younger than `stale_ttl` are
+# served without a lookup, and older ones are served right away while
+# they are revalidated in the background (stale-while-revalidate).
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from geomet_data_registry.tileindex.base import TileNotFoundError
+
+from geomet_mapfile.breaker import CircuitBreaker
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TileIndexUnavailable(Exception):
+    """Tile index failed and no last known document is available"""
+    pass
+
+
+class TileIndexLoading(Exception):
+    """Tile index plugin is being loaded by another thread"""
+    pass
+
+
+class GuardedTileIndex:
+    """Tile index lookups with circuit breaker and stale fallback"""
+
+    def __init__(self, loader, breaker=None, stale_size=0, stale_ttl=0,
+                 load_timeout=0):
+        """
+        Initialize object
+
+        :param loader: callable returning the tile index plugin
+        :param breaker: `geomet_mapfile.breaker.CircuitBreaker`
+        :param stale_size: `int` of maximum number of last known documents
+                           (0 to disable stale fallback)
+        :param stale_ttl: `float` of age below which last known documents
+                          are served without lookup, and above which they
+                          are revalidated in the background (0 to always
+                          look up)
+        :param load_timeout: `float` of maximum time to wait for another
+                             thread loading the tile index plugin (0 to
+                             wait until loaded)
+
+        :returns: `geomet_mapfile.tileindex.guard.GuardedTileIndex`
+        """
+
+        self.loader = loader
+        self.breaker = breaker or CircuitBreaker('tileindex', 0)
+        self.stale_size = stale_size
+        self.stale_ttl = stale_ttl
+        self.load_timeout = load_timeout
+
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._tileindex = None
+        self._documents = OrderedDict()
+        self._pending = set()
+        self._executor = None
+
+    @property
+    def tileindex(self):
+        """
+        tile index plugin, loaded (through the circuit breaker) on first
+        lookup. Loading does not hold the lock of last known documents, so
+        that they can be served while the tile index does not answer
+        """
+
+        if self._tileindex is not None:
+            return self._tileindex
+
+        if not self._load_lock.acquire(timeout=self.load_timeout or -1):
+            raise TileIndexLoading('Tile index is being loaded')
+
+        try:
+            if self._tileindex is None:
+                self._tileindex = self.breaker.call(self.loader)
+        finally:
+            self._load_lock.release()
+
+        return self._tileindex
+
+    def _remember(self, identifier, document):
+        if self.stale_size <= 0 or document is None:
+            return
+
+        with self._lock:
+            self._documents[identifier] = (time.monotonic(), document)
+            self._documents.move_to_end(identifier)
+            while len(self._documents) > self.stale_size:
+                self._documents.popitem(last=False)
+
+    def _last_known(self, identifier):
+        with self._lock:
+            return self._documents.get(identifier)
+
+    def known(self):
+        """
+        Count the last known documents
+
+        :returns: `int` of number of last known documents
+        """
+
+        with self._lock:
+            return len(self._documents)
+
+    def _get(self, identifier):
+        return self.breaker.call(self.tileindex.get, identifier,
+                                 expected=(TileNotFoundError,))
+
+    def _revalidate(self, identifier):
+        try:
+            self._remember(identifier, self._get(identifier))
+        except TileNotFoundError:
+            with self._lock:
+                self._documents.pop(identifier, None)
+        except Exception as err:
+            LOGGER.debug('Could not revalidate {}: {}'.format(
+                identifier, err))
+        finally:
+            with self._lock:
+                self._pending.discard(identifier)
+
+    def _schedule_revalidation(self, identifier):
+        with self._lock:
+            if identifier in self._pending:
+                return
+            self._pending.add(identifier)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(1)
+            self._executor.submit(self._revalidate, identifier)
+
+    def _stale(self, identifier, err):
+        # serve last known document of a failed lookup
+        last_known = self._last_known(identifier)
+
+        if last_known is None:
+            METRICS.incr('tileindex.unavailable')
+            raise TileIndexUnavailable(
+                'Tile index unavailable ({}): {}'.format(
+                    type(err).__name__, err))
+
+        METRICS.incr('tileindex.stale_served')
+        LOGGER.warning('Serving last known {} (tile index unavailable: '
+                       '{})'.format(identifier, err))
+
+        return last_known[1]
+
+    def get(self, identifier):
+        """
+        Get a document
+
+        :param identifier: identifier of document to retrieve
+
+        :raises: `geomet_mapfile.tileindex.guard.TileIndexUnavailable` if
+                 the tile index failed and the document is not known
+
+        :returns: `dict` of single GeoJSON feature
+        """
+
+        if self.stale_ttl > 0:
+            last_known = self._last_known(identifier)
+            if last_known is not None:
+                if time.monotonic() - last_known[0] >= self.stale_ttl:
+                    self._schedule_revalidation(identifier)
+                METRICS.incr('tileindex.cache_hits')
+                return last_known[1]
+
+        try:
+            document = self._get(identifier)
+        except TileNotFoundError:
+            raise
+        except Exception as err:
+            return self._stale(identifier, err)
+
+        self._remember(identifier, document)
+
+        return document
+
+    def get_many(self, identifiers):
+        """
+        Get many documents at once
+
+        :param identifiers: `list` of identifiers of documents to retrieve
+
+        :raises: `geomet_mapfile.tileindex.guard.TileIndexUnavailable` if
+                 the tile index failed and no document is known
+
+        :returns: `dict` of identifier to GeoJSON feature (`None` if not
+                  found)
+        """
+
+        def lookup(tileindex):
+            if hasattr(tileindex, 'get_many'):
+                return tileindex.get_many(identifiers)
+            documents = {}
+            for id_ in identifiers:
+                try:
+                    documents[id_] = tileindex.get(id_)
+                except TileNotFoundError:
+                    documents[id_] = None
+            return documents
+
+        try:
+            documents = self.breaker.call(lookup, self.tileindex)
+        except Exception as err:
+            documents = {}
+            for id_ in identifiers:
+                last_known = self._last_known(id_)
+                documents[id_] = last_known[1] if last_known else None
+            if not any(documents.values()):
+                METRICS.incr('tileindex.unavailable')
+                raise TileIndexUnavailable(
+                    'Tile index unavailable ({}): {}'.format(
+                        type(err).__name__, err))
+            METRICS.incr('tileindex.stale_served')
+            LOGGER.warning('Serving last known documents (tile index '
+                           'unavailable: {})'.format(err))
+            return documents
+
+        for id_, document in documents.items():
+            self._remember(id_, document)
+
+        return documents
@@ -0,0 +1,221 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Local replica of the tile index.
+#
+# The replica is a SQLite tile index refreshed incrementally from the
+# source tile index (Elasticsearch): every sync fetches the documents
+# registered since the last checkpoint (the most recent register datetime
+# seen, minus a safety margin for documents not yet searchable) and drops
+# expired documents. Lookups are served by the replica and fall back to the
+# source tile index for documents not replicated yet.
+
+from datetime import datetime, timedelta
+import logging
+import threading
+
+from geomet_data_registry.tileindex.base import TileNotFoundError
+
+from geomet_mapfile.metrics import METRICS
+from geomet_mapfile.plugin import load_plugin
+from geomet_mapfile.tileindex.sqlite_ import SQLiteTileIndex
+
+LOGGER = logging.getLogger(__name__)
+
+CHECKPOINT_KEY = 'register_datetime'
+
+# overlap of two consecutive syncs (seconds)
+SYNC_MARGIN = 300
+
+# number of documents written to the replica at once
+SYNC_BATCH_SIZE = 1000
+
+
+def utcnow():
+    """
+    Get the current datetime in the tile index datetime format
+
+    :returns: `str` of current UTC datetime
+    """
+
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def sync_start(checkpoint, margin=SYNC_MARGIN):
+    """
+    Get the register datetime a sync starts from
+
+    :param checkpoint: `str` of most recent register datetime replicated
+    :param margin: `int` of overlap with the previous sync (seconds)
+
+    :returns: `str` of register datetime
+    """
+
+    start = datetime.strptime(checkpoint[:19], '%Y-%m-%dT%H:%M:%S')
+    start -= timedelta(seconds=margin)
+
+    return start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def sync_replica(source, replica, full=False):
+    """
+    Refresh a replica from its source tile index
+
+    :param source: source tile index plugin (with `registered_since`)
+    :param replica: `geomet_mapfile.tileindex.sqlite_.SQLiteTileIndex`
+    :param full: `bool` of whether to replicate all documents
+
+    :returns: `int` of number of documents replicated
+    """
+
+    checkpoint = None if full else replica.get_state(CHECKPOINT_KEY)
+
+    if checkpoint is None:
+        LOGGER.info('Replicating all documents of {}'.format(source.name))
+        start = '1970-01-01T00:00:00.000Z'
+    else:
+        start = sync_start(checkpoint)
+        LOGGER.debug('Replicating documents registered since '
+                     '{}'.format(start))
+
+    count = 0
+    batch = []
+    latest = checkpoint
+
+    for feature in source.registered_since(start):
+        batch.append(feature)
+        registered = feature['properties'].get('register_datetime')
+        if registered is not None and (latest is None or
+                                       registered > latest):
+            latest = registered
+        if len(batch) >= SYNC_BATCH_SIZE:
+            replica.bulk_add(batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        replica.bulk_add(batch)
+        count += len(batch)
+
+    if latest is not None:
+        replica.set_state(CHECKPOINT_KEY, latest)
+
+    expired = replica.remove_expired(utcnow())
+
+    LOGGER.info('Replicated {} documents, removed {} expired '
+                'documents'.format(count, expired))
+
+    return count
+
+
+class ReplicatedTileIndex:
+    """Tile index lookups served by a local replica"""
+
+    def __init__(self, provider_def, replica_path):
+        """
+        Initialize object
+
+        :param provider_def: provider definition `dict` of source
+                             tile index
+        :param replica_path: path to SQLite replica
+
+        :returns: `geomet_mapfile.tileindex.replica.ReplicatedTileIndex`
+        """
+
+        self.provider_def = provider_def
+        self.replica = SQLiteTileIndex({'type': 'SQLite',
+                                        'url': replica_path,
+                                        'name': provider_def.get('name',
+                                                                 'tileindex')})
+
+        self._lock = threading.Lock()
+        self._source = None
+
+    @property
+    def source(self):
+        """source tile index plugin, loaded on first replica miss"""
+
+        with self._lock:
+            if self._source is None:
+                self._source = load_plugin('tileindex', self.provider_def)
+
+        return self._source
+
+    def get(self, identifier):
+        """
+        Get a document
+
+        :param identifier: identifier of document to retrieve
+
+        :returns: `dict` of single GeoJSON feature
+        """
+
+        try:
+            feature = self.replica.get(identifier)
+            METRICS.incr('tileindex.replica_hits')
+            return feature
+        except TileNotFoundError:
+            METRICS.incr('tileindex.replica_misses')
+
+        return self.source.get(identifier)
+
+    def get_many(self, identifiers):
+        """
+        Get many documents at once
+
+        :param identifiers: `list` of identifiers of documents to retrieve
+
+        :returns: `dict` of identifier to GeoJSON feature (`None` if not
+                  found)
+        """
+
+        result = self.replica.get_many(identifiers)
+
+        missing = [id_ for id_, feature in result.items() if feature is None]
+
+        METRICS.incr('tileindex.replica_hits', len(result) - len(missing))
+
+        if missing:
+            METRICS.incr('tileindex.replica_misses', len(missing))
+            if hasattr(self.source, 'get_many'):
+                result.update(self.source.get_many(missing))
+            else:
+                for id_ in missing:
+                    try:
+                        result[id_] = self.source.get(id_)
+                    except TileNotFoundError:
+                        pass
+
+        return result
+
+    def query_layer(self, layer, reference_datetime=None, start=None,
+                    end=None):
+        """
+        Get the documents of a layer from the replica
+
+        :param layer: `str` of layer name
+        :param reference_datetime: `str` of model run
+        :param start: `str` of first forecast hour datetime
+        :param end: `str` of last forecast hour datetime
+
+        :returns: `list` of GeoJSON features, sorted by forecast hour
+        """
+
+        return self.replica.query_layer(layer, reference_datetime, start, end)
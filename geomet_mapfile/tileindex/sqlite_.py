@@ -0,0 +1,296 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import json
+import logging
+
+from geomet_data_registry.tileindex.base import (BaseTileIndex,
+                                                 TileNotFoundError)
+
+from geomet_mapfile.util import SQLiteDatabase
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS tiles (
+        identifier TEXT PRIMARY KEY,
+        layer TEXT,
+        reference_datetime TEXT,
+        forecast_hour_datetime TEXT,
+        register_datetime TEXT,
+        expiry_datetime TEXT,
+        feature TEXT
+    )''',
+    '''CREATE INDEX IF NOT EXISTS tiles_layer
+        ON tiles (layer, reference_datetime, forecast_hour_datetime)''',
+    '''CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )'''
+]
+
+# maximum number of SQL variables of a single query
+MAX_VARIABLES = 500
+
+
+class SQLiteTileIndex(BaseTileIndex):
+    """SQLite tile index implementation, in a single local file"""
+
+    def __init__(self, provider_def):
+        """
+        Initialize object
+
+        :param provider_def: provider definition `dict` (url is the path
+                             to the SQLite file)
+
+        :returns: `geomet_mapfile.tileindex.sqlite_.SQLiteTileIndex`
+        """
+
+        super().__init__(provider_def)
+
+        self.database = SQLiteDatabase(self.url, SCHEMA)
+        self.filepath = self.database.filepath
+
+    @property
+    def db(self):
+        """`sqlite3.Connection` of current thread"""
+
+        return self.database.connect()
+
+    def setup(self):
+        """
+        Create the tileindex
+
+        :returns: `bool` of process status
+        """
+
+        return self.db is not None
+
+    def teardown(self):
+        """
+        Delete the tileindex
+
+        :returns: `bool` of process status
+        """
+
+        with self.db as db:
+            db.execute('DELETE FROM tiles')
+            db.execute('DELETE FROM state')
+
+        return True
+
+    def get(self, identifier):
+        """
+        Get a document
+
+        :param identifier: identifier of document to retrieve
+
+        :returns: `dict` of single GeoJSON feature
+        """
+
+        row = self.db.execute(
+            'SELECT feature FROM tiles WHERE identifier = ?', (identifier,)
+        ).fetchone()
+
+        if row is None:
+            raise TileNotFoundError(identifier)
+
+        return json.loads(row[0])
+
+    def get_many(self, identifiers):
+        """
+        Get many documents at once
+
+        :param identifiers: `list` of identifiers of documents to retrieve
+
+        :returns: `dict` of identifier to GeoJSON feature (`None` if not
+                  found)
+        """
+
+        result = {identifier: None for identifier in identifiers}
+
+        for i in range(0, len(identifiers), MAX_VARIABLES):
+            chunk = identifiers[i:i + MAX_VARIABLES]
+            rows = self.db.execute(
+                'SELECT identifier, feature FROM tiles '
+                'WHERE identifier IN ({})'.format(','.join('?' * len(chunk))),
+                chunk
+            )
+            for identifier, feature in rows:
+                result[identifier] = json.loads(feature)
+
+        return result
+
+    def query_layer(self, layer, reference_datetime=None, start=None,
+                    end=None):
+        """
+        Get the documents of a layer, optionally of a single model run and
+        range of forecast hours
+
+        :param layer: `str` of layer name
+        :param reference_datetime: `str` of model run
+        :param start: `str` of first forecast hour datetime
+        :param end: `str` of last forecast hour datetime
+
+        :returns: `list` of GeoJSON features, sorted by forecast hour
+        """
+
+        sql = 'SELECT feature FROM tiles WHERE layer = ?'
+        args = [layer]
+
+        if reference_datetime is not None:
+            sql += ' AND reference_datetime = ?'
+            args.append(reference_datetime)
+        if start is not None:
+            sql += ' AND forecast_hour_datetime >= ?'
+            args.append(start)
+        if end is not None:
+            sql += ' AND forecast_hour_datetime <= ?'
+            args.append(end)
+
+        sql += ' ORDER BY forecast_hour_datetime'
+
+        return [json.loads(row[0]) for row in self.db.execute(sql, args)]
+
+    def add(self, identifier, data):
+        """
+        Add an item to the tileindex
+
+        :param identifier: tileindex item id
+        :param data: GeoJSON dict
+
+        :returns: `int` of status (as per HTTP status codes)
+        """
+
+        data['properties']['identifier'] = identifier
+        self.bulk_add([data])
+
+        return 201
+
+    def bulk_add(self, data):
+        """
+        Add (or replace) many items to the tileindex
+
+        :param data: `list` of GeoJSON dicts
+
+        :returns: `dict` {layer_id: HTTP status code}
+        """
+
+        rows = []
+        for feature in data:
+            properties = feature['properties']
+            rows.append((
+                properties['identifier'],
+                properties.get('layer'),
+                properties.get('reference_datetime'),
+                properties.get('forecast_hour_datetime'),
+                properties.get('register_datetime'),
+                properties.get('expiry_datetime'),
+                json.dumps(feature)
+            ))
+
+        with self.db as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+        return {row[0]: 201 for row in rows}
+
+    def update(self, identifier, update_dict):
+        """
+        Update the properties of an item
+
+        :param identifier: tileindex item id
+        :param update_dict: `dict` of properties to update
+
+        :returns: `bool` of update status
+        """
+
+        try:
+            feature = self.get(identifier)
+        except TileNotFoundError:
+            return False
+
+        feature['properties'].update(update_dict)
+        self.bulk_add([feature])
+
+        return True
+
+    def remove(self, identifier):
+        """
+        Remove an item from the tileindex
+
+        :param identifier: tileindex item id
+
+        :returns: `bool` of removal status
+        """
+
+        with self.db as db:
+            cursor = db.execute('DELETE FROM tiles WHERE identifier = ?',
+                                (identifier,))
+
+        return cursor.rowcount > 0
+
+    def remove_expired(self, now):
+        """
+        Remove items whose expiry datetime has passed
+
+        :param now: `str` of current datetime (ISO 8601)
+
+        :returns: `int` of number of removed items
+        """
+
+        with self.db as db:
+            cursor = db.execute(
+                'DELETE FROM tiles WHERE expiry_datetime < ?', (now,))
+
+        return cursor.rowcount
+
+    def get_state(self, key):
+        """
+        Get a tileindex state value (e.g. replication checkpoint)
+
+        :param key: `str` of state key
+
+        :returns: `str` of state value (`None` if not set)
+        """
+
+        row = self.db.execute('SELECT value FROM state WHERE key = ?',
+                              (key,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_state(self, key, value):
+        """
+        Set a tileindex state value
+
+        :param key: `str` of state key
+        :param value: `str` of state value
+
+        :returns: `None`
+        """
+
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                       (key, value))
+
+    def __repr__(self):
+        return '<SQLiteTileIndex> {}'.format(self.filepath)
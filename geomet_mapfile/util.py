@@ -21,6 +21,9 @@
 import json
 import logging
 import os
+import sqlite3
+import tempfile
+import threading
 
 import click
 from lark.exceptions import UnexpectedToken
@@ -74,6 +77,107 @@ def get_nearest(items, target):
     return min(items, key=lambda x: abs(x - target))
 
 
+def atomic_write(filepath, content, encoding='utf-8'):
+    """
+    Utility function to write a file atomically: content is written to a
+    temporary file in the same directory, which then replaces the file, so
+    that readers never see a partially written file
+
+    :param filepath: path of file to write
+    :param content: `str` or `bytes` of file content
+    :param encoding: encoding of `str` content
+
+    :returns: `None`
+    """
+
+    dirname, basename = os.path.split(filepath)
+    fd, tmp_filepath = tempfile.mkstemp(dir=dirname, prefix=f'.{basename}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            if isinstance(content, str):
+                content = content.encode(encoding)
+            fh.write(content)
+        os.chmod(tmp_filepath, 0o644)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+
+class FileWrapper:
+    """
+    Iterable over a file in fixed size chunks, for use as a WSGI response
+    when the server does not provide wsgi.file_wrapper
+    """
+
+    def __init__(self, fh, chunk_size=1048576):
+        """
+        Initialize object
+
+        :param fh: file object opened in binary mode
+        :param chunk_size: `int` of chunk size in bytes
+
+        :returns: `geomet_mapfile.util.FileWrapper`
+        """
+
+        self.fh = fh
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            chunk = self.fh.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.fh.close()
+
+
+class SQLiteDatabase:
+    """
+    Per-thread connections to a SQLite database, reopened in forked
+    processes (connections cannot be shared across threads or processes)
+    """
+
+    def __init__(self, url, schema=None):
+        """
+        Initialize object
+
+        :param url: path to SQLite file (optionally sqlite:// prefixed)
+        :param schema: `list` of SQL statements creating the database
+
+        :returns: `geomet_mapfile.util.SQLiteDatabase`
+        """
+
+        self.filepath = remove_prefix(url, 'sqlite://')
+        self.schema = schema or []
+        self._local = threading.local()
+
+    def connect(self):
+        """
+        Get the connection of the current thread
+
+        :returns: `sqlite3.Connection`
+        """
+
+        pid = os.getpid()
+
+        if getattr(self._local, 'pid', None) != pid:
+            db = sqlite3.connect(self.filepath, timeout=30)
+            # concurrent readers while writing
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with db:
+                for statement in self.schema:
+                    db.execute(statement)
+            self._local.db = db
+            self._local.pid = pid
+
+        return self._local.db
+
+
 def clean_style(filepath, output_format='json'):
     # TODO: docstring
     with open(filepath, 'r') as f:
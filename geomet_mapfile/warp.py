@@ -0,0 +1,450 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+# Copyright (C) 2020 Louis-Philippe Rousseau-Lambert
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Warped layer data, rendered without reprojection.
+#
+# MapServer reprojects raster data on every request, recomputing the same
+# transformation for the same grid, output CRS and extent. A warp grid maps
+# every pixel of a requested map (extent and size in a target CRS) to the
+# nearest pixel of the source grid. It only depends on the source
+# projection, geotransform and size, so a single grid is shared by all
+# layers and files of a forecast model, for all requests of the same tile.
+# Only tiles of the metatile grids (geomet_mapfile.metatile) are warped, as
+# arbitrary map extents would each need their own grid.
+# Warping a data file is then a mere lookup of its pixels, to an in-memory
+# raster aligned on the map, which MapServer renders without reprojecting
+# nor resampling it again.
+
+from collections import OrderedDict
+from hashlib import sha256
+import json
+import logging
+import os
+import tempfile
+import threading
+from urllib.parse import parse_qsl
+import uuid
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = osr = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from geomet_mapfile.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# MapServer projections of target CRSs
+WARP_PROJECTIONS = {
+    'EPSG:3857': 'init=epsg:3857',
+    'EPSG:4326': 'init=epsg:4326'
+}
+
+# grid value of pixels outside of the source grid
+NODATA_INDEX = 4294967295
+
+# maximum number of warp grids kept in memory
+GRID_CACHE_SIZE = 64
+
+# number of warp grids written between disk evictions
+GRID_EVICTION_INTERVAL = 16
+
+
+def warp_extent(query_string):
+    """
+    Get the extent and size of a GetMap request in a target CRS
+
+    :param query_string: `str` of request query string
+
+    :returns: `tuple` of CRS, bounds (minx, miny, maxx, maxy), width and
+              height, or `None` if not in a target CRS
+    """
+
+    params = {
+        key.upper(): value
+        for key, value in parse_qsl(query_string, keep_blank_values=True)
+    }
+
+    crs = (params.get('CRS') or params.get('SRS') or '').upper()
+
+    if crs not in WARP_PROJECTIONS:
+        return None
+
+    try:
+        width = int(params['WIDTH'])
+        height = int(params['HEIGHT'])
+        bounds = tuple(float(value) for value in params['BBOX'].split(','))
+    except (KeyError, ValueError):
+        return None
+
+    if len(bounds) != 4 or width <= 0 or height <= 0:
+        return None
+
+    # WMS 1.3.0 uses lat/lon axis order for EPSG:4326
+    if crs == 'EPSG:4326' and params.get('VERSION', '1.3.0') == '1.3.0':
+        bounds = (bounds[1], bounds[0], bounds[3], bounds[2])
+
+    return crs, bounds, width, height
+
+
+def grid_key(projection, geotransform, width, height, crs, bounds, size):
+    """
+    Build the key of a warp grid
+
+    :param projection: `str` of source projection (proj string or WKT)
+    :param geotransform: `tuple` of source geotransform
+    :param width: `int` of source width
+    :param height: `int` of source height
+    :param crs: `str` of target CRS (e.g. EPSG:3857)
+    :param bounds: `tuple` of target bounds (minx, miny, maxx, maxy)
+    :param size: `tuple` of target width and height
+
+    :returns: `str` of warp grid key
+    """
+
+    key = json.dumps([projection, list(geotransform), width, height, crs,
+                      list(bounds), list(size)])
+
+    return sha256(key.encode()).hexdigest()
+
+
+def grid_window(index, width):
+    """
+    Restrict a warp grid to the window of the source grid it reads from
+
+    :param index: `numpy.ndarray` of source pixel indices
+    :param width: `int` of source width
+
+    :returns: `tuple` of window (xoff, yoff, xsize, ysize) and
+              `numpy.ndarray` of pixel indices in the window, or `None`
+              and the grid if the grid is outside of the source grid
+    """
+
+    valid = index != NODATA_INDEX
+
+    if not valid.any():
+        return None, index
+
+    rows, cols = np.divmod(index[valid], width)
+    xoff, yoff = int(cols.min()), int(rows.min())
+    xsize = int(cols.max()) - xoff + 1
+    ysize = int(rows.max()) - yoff + 1
+
+    window_index = np.full(index.shape, NODATA_INDEX, dtype=np.uint32)
+    window_index[valid] = (rows - yoff) * xsize + (cols - xoff)
+
+    return (xoff, yoff, xsize, ysize), window_index
+
+
+def build_grid(projection, geotransform, width, height, crs, bounds, size):
+    """
+    Compute a warp grid, by reprojecting the pixel indices of the source
+    grid to a target extent and size with nearest neighbour resampling
+
+    :param projection: `str` of source projection (proj string or WKT)
+    :param geotransform: `tuple` of source geotransform
+    :param width: `int` of source width
+    :param height: `int` of source height
+    :param crs: `str` of target CRS (e.g. EPSG:3857)
+    :param bounds: `tuple` of target bounds (minx, miny, maxx, maxy)
+    :param size: `tuple` of target width and height
+
+    :returns: `dict` of grid (`numpy.ndarray` of pixel indices in the source
+              window), source window, and geotransform and projection (WKT)
+              of the target extent
+    """
+
+    if width * height >= NODATA_INDEX:
+        raise ValueError('Grid too large: {}x{}'.format(width, height))
+
+    src_srs = osr.SpatialReference()
+    src_srs.SetFromUserInput(projection)
+
+    src = gdal.GetDriverByName('MEM').Create('', width, height, 1,
+                                             gdal.GDT_UInt32)
+    src.SetGeoTransform(geotransform)
+    src.SetProjection(src_srs.ExportToWkt())
+    src.GetRasterBand(1).WriteArray(
+        np.arange(width * height, dtype=np.uint32).reshape(height, width))
+
+    options = gdal.WarpOptions(format='MEM', dstSRS=crs, resampleAlg='near',
+                               outputBounds=bounds, width=size[0],
+                               height=size[1], dstNodata=NODATA_INDEX,
+                               outputType=gdal.GDT_UInt32)
+    dst = gdal.Warp('', src, options=options)
+
+    if dst is None:
+        raise ValueError('Could not warp grid to {}'.format(crs))
+
+    window, index = grid_window(dst.GetRasterBand(1).ReadAsArray(), width)
+
+    return {
+        'grid': index,
+        'window': window,
+        'geotransform': dst.GetGeoTransform(),
+        'projection': dst.GetProjection()
+    }
+
+
+class WarpGridCache:
+    """Warp grids, kept on disk and in memory"""
+
+    def __init__(self, grid_dir, disk_size, size=GRID_CACHE_SIZE):
+        """
+        Initialize object
+
+        :param grid_dir: path to directory of warp grids
+        :param disk_size: `int` of maximum size of warp grids on disk in
+                          bytes
+        :param size: `int` of maximum number of grids kept in memory
+
+        :returns: `geomet_mapfile.warp.WarpGridCache`
+        """
+
+        self.grid_dir = grid_dir
+        self.disk_size = disk_size
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._grids = OrderedDict()
+        self._disk_writes = 0
+
+    def get(self, projection, geotransform, width, height, crs, bounds,
+            size):
+        """
+        Get a warp grid, computing it if needed
+
+        :param projection: `str` of source projection
+        :param geotransform: `tuple` of source geotransform
+        :param width: `int` of source width
+        :param height: `int` of source height
+        :param crs: `str` of target CRS (e.g. EPSG:3857)
+        :param bounds: `tuple` of target bounds (minx, miny, maxx, maxy)
+        :param size: `tuple` of target width and height
+
+        :returns: `dict` of warp grid (see `build_grid`)
+        """
+
+        key = grid_key(projection, geotransform, width, height, crs, bounds,
+                       size)
+
+        with self._lock:
+            grid = self._grids.get(key)
+            if grid is not None:
+                self._grids.move_to_end(key)
+                METRICS.incr('warp_grids.hits')
+                return grid
+
+        filepath = os.path.join(self.grid_dir, key[:2], '{}.npz'.format(key))
+
+        try:
+            with np.load(filepath) as npz:
+                window = tuple(int(value) for value in npz['window'])
+                grid = {
+                    'grid': npz['grid'],
+                    'window': window or None,
+                    'geotransform': tuple(float(value) for value
+                                          in npz['geotransform']),
+                    'projection': str(npz['projection'])
+                }
+            # bump access time for LRU eviction
+            os.utime(filepath)
+            METRICS.incr('warp_grids.loads')
+        except (OSError, KeyError, ValueError):
+            LOGGER.debug('Computing warp grid {} to {} {}'.format(
+                projection, crs, bounds))
+            grid = build_grid(projection, geotransform, width, height, crs,
+                              bounds, size)
+            METRICS.incr('warp_grids.builds')
+            self._write(filepath, grid)
+
+        with self._lock:
+            self._grids[key] = grid
+            while len(self._grids) > self.size:
+                self._grids.popitem(last=False)
+
+        return grid
+
+    def _write(self, filepath, grid):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filepath),
+                                   suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez_compressed(
+                    fh, grid=grid['grid'],
+                    window=np.array(grid['window'] or (), dtype=np.int64),
+                    geotransform=np.array(grid['geotransform']),
+                    projection=np.array(grid['projection']))
+            os.replace(tmp, filepath)
+        except OSError as err:
+            LOGGER.warning('Could not write warp grid: {}'.format(err))
+            return
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        with self._lock:
+            self._disk_writes += 1
+            evict = self._disk_writes % GRID_EVICTION_INTERVAL == 0
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used warp grids until the warp grids on disk
+        fit in their configured size
+
+        :returns: `int` of number of evicted warp grids
+        """
+
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.grid_dir):
+            for file_ in files:
+                filepath = os.path.join(root, file_)
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filepath))
+                total += stat.st_size
+
+        evicted = 0
+        for mtime, size, filepath in sorted(entries):
+            if total <= self.disk_size:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+        if evicted:
+            LOGGER.debug('Evicted {} warp grids'.format(evicted))
+            METRICS.incr('warp_grids.evictions', evicted)
+
+        return evicted
+
+
+def band_nodata(band, dtype):
+    """
+    Get the nodata value of a warped band
+
+    :param band: `osgeo.gdal.Band` of source band
+    :param dtype: `numpy.dtype` of band data
+
+    :returns: nodata value (source nodata, or lowest value of data type,
+              highest for unsigned types)
+    """
+
+    nodata = band.GetNoDataValue()
+
+    if nodata is not None:
+        return nodata
+
+    if np.issubdtype(dtype, np.floating):
+        return float(np.finfo(dtype).min)
+
+    if np.issubdtype(dtype, np.unsignedinteger):
+        return int(np.iinfo(dtype).max)
+
+    return int(np.iinfo(dtype).min)
+
+
+def warp_array(data, grid, nodata):
+    """
+    Warp the data of a source window through a warp grid
+
+    :param data: `numpy.ndarray` of source window data
+    :param grid: `dict` of warp grid (see `build_grid`)
+    :param nodata: nodata value of pixels outside of the source grid
+
+    :returns: `numpy.ndarray` of warped data
+    """
+
+    index = grid['grid']
+    warped = np.full(index.shape, nodata, dtype=data.dtype)
+
+    if grid['window'] is not None:
+        valid = index != NODATA_INDEX
+        warped[valid] = data.ravel()[index[valid]]
+
+    return warped
+
+
+def warp(src, projection, crs, bounds, size, grids):
+    """
+    Warp a data file to a requested map extent, as an in-memory GeoTIFF
+    aligned on the map
+
+    :param src: `osgeo.gdal.Dataset` of data file
+    :param projection: `str` of data file projection (proj string)
+    :param crs: `str` of target CRS (e.g. EPSG:3857)
+    :param bounds: `tuple` of target bounds (minx, miny, maxx, maxy)
+    :param size: `tuple` of target width and height
+    :param grids: `geomet_mapfile.warp.WarpGridCache`
+
+    :returns: `str` of path to warped GeoTIFF (in /vsimem, to be removed
+              with `gdal.Unlink` once rendered)
+    """
+
+    if None in [gdal, np]:
+        raise RuntimeError('GDAL and numpy are required to warp data files')
+
+    grid = grids.get(projection, src.GetGeoTransform(), src.RasterXSize,
+                     src.RasterYSize, crs, bounds, size)
+
+    target = '/vsimem/geomet-mapfile-warp-{}.tif'.format(uuid.uuid4().hex)
+
+    dst = gdal.GetDriverByName('GTiff').Create(
+        target, size[0], size[1], src.RasterCount,
+        src.GetRasterBand(1).DataType)
+    dst.SetGeoTransform(grid['geotransform'])
+    dst.SetProjection(grid['projection'])
+    dst.SetMetadata(src.GetMetadata())
+
+    for i in range(1, src.RasterCount + 1):
+        src_band = src.GetRasterBand(i)
+        if grid['window'] is not None:
+            data = src_band.ReadAsArray(*grid['window'])
+        else:
+            data = src_band.ReadAsArray(0, 0, 1, 1)
+        nodata = band_nodata(src_band, data.dtype)
+
+        dst_band = dst.GetRasterBand(i)
+        dst_band.WriteArray(warp_array(data, grid, nodata))
+        dst_band.SetNoDataValue(nodata)
+        dst_band.SetDescription(src_band.GetDescription())
+        dst_band.SetMetadata(src_band.GetMetadata())
+
+    # flush dataset before rendering it
+    dst = None
+
+    METRICS.incr('warp.warped')
+
+    return target
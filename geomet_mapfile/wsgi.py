@@ -18,27 +18,86 @@
 #
 ###############################################################################
 
+from contextlib import nullcontext
+from functools import partial
 import io
+import json
 import logging
 import os
 import re
+from urllib.parse import parse_qsl
 from urllib.request import urlopen
 
 import click
 import mapscript
 
 from geomet_data_registry.tileindex.base import TileNotFoundError
+from geomet_mapfile.admission import (AdmissionController, AdmissionTimeout,
+                                      parse_limits)
+from geomet_mapfile.breaker import CircuitBreaker
+from geomet_mapfile.cache import (ResponseCache, response_cache_key,
+                                  StoreMapfileCache)
 from geomet_mapfile.env import (
     BASEDIR,
     TILEINDEX_URL,
     TILEINDEX_TYPE,
     TILEINDEX_NAME,
+    TILEINDEX_REPLICA,
+    TILEINDEX_TIMEOUT,
+    TILEINDEX_BREAKER_THRESHOLD,
+    TILEINDEX_BREAKER_RESET,
+    TILEINDEX_STALE_CACHE,
+    TILEINDEX_STALE_TTL,
     MAPFILE_STORAGE,
     STORE_TYPE,
     STORE_URL,
-    ALLOW_LAYER_DATA_DOWNLOAD
+    ALLOW_LAYER_DATA_DOWNLOAD,
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_MEMORY_SIZE,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_DISK_SIZE,
+    METATILE_SIZE,
+    METATILE_BUFFER,
+    STORE_MAPFILE_CACHE,
+    STORE_MAPFILE_CACHE_DIR,
+    STREAMING_THRESHOLD,
+    MAX_RENDERS,
+    MAX_RENDERS_PER_REQUEST,
+    MAX_RENDERS_PER_LAYER,
+    ADMISSION_TIMEOUT,
+    ADMISSION_DIR,
+    REQUEST_COLLAPSING,
+    REQUEST_COLLAPSING_STORE,
+    REQUEST_COLLAPSING_TIMEOUT,
+    LEGEND_CACHE,
+    FEATUREINFO_FAST_PATH,
+    DATASET_CACHE_SIZE,
+    OPTIMIZE_DATA,
+    OPTIMIZED_DATA_DIR,
+    PREWARP_CRS,
+    PREWARP_GRID_DISK_SIZE,
+    READINESS_TTL
 )
+from geomet_mapfile.dataset import gdal, ThreadDatasetCache
+from geomet_mapfile.featureinfo import (compile_classes, expand_times,
+                                        feature_info, FeatureInfoUnsupported,
+                                        is_time_series, time_series)
+from geomet_mapfile.flight import SingleFlight
+from geomet_mapfile.health import (check_mapfiles, check_store,
+                                   check_tileindex, ReadinessProbe,
+                                   run_checks)
+from geomet_mapfile.legend import LegendCache, UNCACHED_PARAMS
+from geomet_mapfile.metatile import Metatile, metatiling_supported
+from geomet_mapfile.metrics import METRICS
 from geomet_mapfile.plugin import load_plugin
+from geomet_mapfile.optimize import DataOptimizer
+from geomet_mapfile.snapshot import current_generation, versioned_key
+from geomet_mapfile.tileindex.guard import (GuardedTileIndex,
+                                            TileIndexUnavailable)
+from geomet_mapfile.tileindex.replica import ReplicatedTileIndex
+from geomet_mapfile.util import FileWrapper
+from geomet_mapfile.warp import (np, warp, warp_extent, WARP_PROJECTIONS,
+                                 WarpGridCache)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -49,6 +108,9 @@ TILEINDEX_PROVIDER_DEF = {
     'group': None,
 }
 
+if TILEINDEX_TIMEOUT > 0:
+    TILEINDEX_PROVIDER_DEF['timeout'] = TILEINDEX_TIMEOUT
+
 # List of all environment variable used by MapServer
 MAPSERV_ENV = [
     'CONTENT_LENGTH',
@@ -82,6 +144,9 @@ MAPSERV_ENV = [
 
 WCS_FORMATS = {'image/tiff': 'tif', 'image/netcdf': 'nc'}
 
+# chunk size of streamed responses
+STREAMING_CHUNK_SIZE = 1048576
+
 SERVICE_EXCEPTION = '''<?xml version='1.0' encoding="UTF-8" standalone="no"?>
 <ServiceExceptionReport version="1.3.0" xmlns="http://www.opengis.net/ogc"
     xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
@@ -90,6 +155,152 @@ SERVICE_EXCEPTION = '''<?xml version='1.0' encoding="UTF-8" standalone="no"?>
   <ServiceException>{}</ServiceException>
 </ServiceExceptionReport>'''
 
+# requests whose responses are cached
+CACHEABLE_REQUESTS = ['GetMap']
+
+# exception formats returning errors as images, whose responses are not
+# cached (e.g. EXCEPTIONS=INIMAGE or application/vnd.ogc.se_blank)
+UNCACHEABLE_EXCEPTIONS = ['INIMAGE', 'BLANK']
+
+# requests whose identical in-flight renders are collapsed
+COLLAPSIBLE_REQUESTS = ['GetMap', 'GetFeatureInfo']
+
+# requests reading the layer data file
+DATA_REQUESTS = ['GetMap', 'GetFeatureInfo', 'GetCoverage']
+
+# requests rendered from the optimized copy of the layer data file
+OPTIMIZED_REQUESTS = ['GetMap', 'GetFeatureInfo']
+
+if RESPONSE_CACHE:
+    RESPONSE_CACHE_ = ResponseCache(
+        RESPONSE_CACHE_MEMORY_SIZE,
+        RESPONSE_CACHE_DIR or os.path.join(BASEDIR, 'cache', 'responses'),
+        RESPONSE_CACHE_DISK_SIZE
+    )
+else:
+    RESPONSE_CACHE_ = None
+
+if STORE_MAPFILE_CACHE and MAPFILE_STORAGE == 'store':
+    STORE_MAPFILE_CACHE_ = StoreMapfileCache(
+        STORE_MAPFILE_CACHE_DIR or os.path.join(BASEDIR, 'cache', 'mapfiles')
+    )
+else:
+    STORE_MAPFILE_CACHE_ = None
+
+MAX_RENDERS_PER_REQUEST_ = parse_limits(MAX_RENDERS_PER_REQUEST)
+
+if any([MAX_RENDERS > 0, MAX_RENDERS_PER_LAYER > 0,
+        any(limit > 0 for limit in MAX_RENDERS_PER_REQUEST_.values())]):
+    ADMISSION_ = AdmissionController(
+        ADMISSION_DIR or os.path.join(BASEDIR, 'cache', 'admission'),
+        MAX_RENDERS, MAX_RENDERS_PER_REQUEST_, MAX_RENDERS_PER_LAYER,
+        ADMISSION_TIMEOUT
+    )
+else:
+    ADMISSION_ = None
+
+if LEGEND_CACHE:
+    LEGEND_CACHE_ = LegendCache(os.path.join(BASEDIR, 'legend'))
+else:
+    LEGEND_CACHE_ = None
+
+if REQUEST_COLLAPSING:
+    if REQUEST_COLLAPSING_STORE:
+        FLIGHTS_ = SingleFlight(
+            load_plugin('store', {'type': STORE_TYPE, 'url': STORE_URL}),
+            REQUEST_COLLAPSING_TIMEOUT
+        )
+    else:
+        FLIGHTS_ = SingleFlight(timeout=REQUEST_COLLAPSING_TIMEOUT)
+else:
+    FLIGHTS_ = None
+
+if DATASET_CACHE_SIZE > 0 and gdal is not None:
+    DATASETS_ = ThreadDatasetCache(DATASET_CACHE_SIZE)
+else:
+    DATASETS_ = None
+
+PREWARP_CRS_ = [crs.strip().upper() for crs in PREWARP_CRS.split(',')
+                if crs.strip().upper() in WARP_PROJECTIONS]
+
+if PREWARP_CRS_ and None in [gdal, np]:
+    LOGGER.warning('Pre-warping data files requires GDAL and numpy. '
+                   'Disabling')
+    PREWARP_CRS_ = []
+
+if OPTIMIZE_DATA and gdal is not None:
+    OPTIMIZER_ = DataOptimizer(
+        OPTIMIZED_DATA_DIR or os.path.join(BASEDIR, 'cache', 'data')
+    )
+else:
+    if OPTIMIZE_DATA:
+        LOGGER.warning('Optimizing data files requires GDAL. Disabling')
+    OPTIMIZER_ = None
+
+if PREWARP_CRS_:
+    WARP_GRIDS_ = WarpGridCache(os.path.join(
+        OPTIMIZED_DATA_DIR or os.path.join(BASEDIR, 'cache', 'data'),
+        'grids'), PREWARP_GRID_DISK_SIZE)
+else:
+    WARP_GRIDS_ = None
+
+# store plugin of worker, loaded on first use
+STORE_ = None
+
+# tile index plugin of worker, loaded on first lookup
+TILEINDEX_ = None
+
+# readiness probe of worker, created on first /ready request
+READINESS_ = None
+
+if METATILE_SIZE > 1 and RESPONSE_CACHE_ is None:
+    LOGGER.warning('Metatiling requires the response cache. Disabling')
+    METATILE_SIZE = 0
+
+
+def stream_response(env, start_response, headers, content, layer=None):
+    """
+    Stream a large response in chunks, without copying its content.
+
+    This does not bound peak memory: MapServer renders the whole output to
+    its stdout buffer, and `msIO_getStdoutBufferBytes` copies it to
+    `content` before streaming starts. MapServer's copy is released before
+    sending, so that only one copy is held during the transfer.
+
+    :param env: WSGI environment
+    :param start_response: WSGI start_response callable
+    :param headers: `list` of response headers
+    :param content: `bytes` of response content
+    :param layer: `str` of requested layer(s), used as attachment filename
+
+    :returns: WSGI response iterable
+    """
+
+    # release MapServer's copy of the output before streaming ours
+    mapscript.msIO_resetHandlers()
+
+    # BytesIO shares the buffer of content, only chunks read are copied
+    fh = io.BytesIO(content)
+
+    headers = headers + [('Content-Length', str(len(content)))]
+
+    content_type = headers[0][1].split(';')[0].strip()
+    if content_type in WCS_FORMATS:
+        filename = re.sub(r'[^\w.-]', '_', layer or 'coverage')
+        headers.append((
+            'Content-Disposition',
+            f'attachment; filename="{filename}.{WCS_FORMATS[content_type]}"'
+        ))
+
+    LOGGER.debug(f'Streaming {len(content)} bytes response')
+    METRICS.incr('responses.streamed')
+
+    start_response('200 OK', headers)
+
+    file_wrapper = env.get('wsgi.file_wrapper', FileWrapper)
+
+    return file_wrapper(fh, STREAMING_CHUNK_SIZE)
+
 
 def metadata_lang(m, layers, lang):
     """
@@ -145,6 +356,69 @@ def metadata_lang(m, layers, lang):
     return True
 
 
+def get_store():
+    """
+    function to get the store of the worker
+
+    :returns: store plugin
+    """
+
+    global STORE_
+
+    if STORE_ is None:
+        STORE_ = load_plugin('store', {'type': STORE_TYPE, 'url': STORE_URL})
+
+    return STORE_
+
+
+def get_tileindex():
+    """
+    function to get the tile index of the worker, served by the local
+    replica if configured, behind a circuit breaker and falling back to
+    last known documents when the tile index is slow or down
+
+    :returns: `geomet_mapfile.tileindex.guard.GuardedTileIndex`
+    """
+
+    global TILEINDEX_
+
+    def load_tileindex():
+        if TILEINDEX_REPLICA:
+            return ReplicatedTileIndex(TILEINDEX_PROVIDER_DEF,
+                                       TILEINDEX_REPLICA)
+        return load_plugin('tileindex', TILEINDEX_PROVIDER_DEF)
+
+    if TILEINDEX_ is None:
+        breaker = CircuitBreaker('tileindex', TILEINDEX_BREAKER_THRESHOLD,
+                                 TILEINDEX_BREAKER_RESET)
+        TILEINDEX_ = GuardedTileIndex(load_tileindex, breaker,
+                                      TILEINDEX_STALE_CACHE,
+                                      TILEINDEX_STALE_TTL,
+                                      TILEINDEX_TIMEOUT)
+
+    return TILEINDEX_
+
+
+def tileindex_id(layer, fh, mr):
+    """
+    function to build the tile index identifier of a layer file
+
+    :param layer: `str` of layer name
+    :param fh: `str` of forecast hour (time)
+    :param mr: `str` of model run (reference time)
+
+    :returns: `str` of tile index identifier
+    """
+
+    model_run = re.sub("[^0-9]", "", mr)
+    forecast = re.sub("[^0-9]", "", fh)
+
+    if model_run not in [None, '']:
+        return '{}-{}-{}'.format(layer, model_run, forecast)
+
+    return '{}-{}'.format(layer, forecast)
+
+
 def get_data_path(layer, fh, mr):
     """
     function to find the datapath
@@ -157,15 +431,9 @@ def get_data_path(layer, fh, mr):
     :returns: filepath
     """
 
-    model_run = re.sub("[^0-9]", "", mr)
-    forecast = re.sub("[^0-9]", "", fh)
+    id_ = tileindex_id(layer, fh, mr)
 
-    if model_run not in [None, '']:
-        id_ = '{}-{}-{}'.format(layer, model_run, forecast)
-    else:
-        id_ = '{}-{}'.format(layer, forecast)
-
-    ti = load_plugin('tileindex', TILEINDEX_PROVIDER_DEF)
+    ti = get_tileindex()
 
     try:
         res = ti.get(id_)
@@ -181,9 +449,504 @@ def get_data_path(layer, fh, mr):
     return res_arr
 
 
+def get_data_paths(layer, times, mr):
+    """
+    function to find the datapaths of many times of a layer at once
+
+    :param layer: `str` of layer name
+    :param times: `list` of `str` of times
+    :param mr: `str` of model run (reference time)
+
+    :returns: `list` of [filepath, url] (`None` for times not found)
+    """
+
+    ids = [tileindex_id(layer, time, mr) for time in times]
+
+    docs = get_tileindex().get_many(ids)
+
+    return [
+        [docs[id_]['properties']['filepath'], docs[id_]['properties']['url']]
+        if docs.get(id_) is not None else None
+        for id_ in ids
+    ]
+
+
+def mapfile_version(mapfile_, store_version=None):
+    """
+    function to identify the version of a mapfile, so that cached
+    responses are not reused across mapfile (re)generations
+
+    :param mapfile_: mapfile filepath or mapfile string from store
+    :param store_version: `str` of store generation and revision the
+                          mapfile was read from (`None` for disk mapfiles)
+
+    :returns: `str` of mapfile version
+    """
+
+    if store_version is None:
+        return str(os.path.getmtime(mapfile_))
+
+    if os.path.isabs(mapfile_):
+        # cached store mapfiles are keyed on their content version
+        return mapfile_
+
+    return store_version
+
+
+def load_mapfile(mapfile_, reload_=None):
+    """
+    function to load a mapfile
+
+    :param mapfile_: mapfile filepath or mapfile string from store
+    :param reload_: function getting the mapfile again, called if
+                    `mapfile_` is a cached store mapfile evicted meanwhile
+
+    :returns: `tuple` of mapfile filepath or string, and `mapscript.mapObj`
+    """
+
+    while True:
+        if not os.path.exists(mapfile_) and (
+                reload_ is None or not os.path.isabs(mapfile_)):
+            # read mapfile from string returned from store
+            return mapfile_, mapscript.fromstring(mapfile_)
+
+        try:
+            # read mapfile from filepath
+            LOGGER.debug('Loading mapfile {} from disk'.format(mapfile_))
+            return mapfile_, mapscript.mapObj(mapfile_)
+        except mapscript.MapServerError:
+            if reload_ is None or os.path.exists(mapfile_):
+                raise
+
+        LOGGER.debug('Cached mapfile {} evicted, getting it again'.format(
+            mapfile_))
+        mapfile_, reload_ = reload_(), None
+        if mapfile_ is None:
+            raise mapscript.MapServerError('Mapfile removed from store')
+
+
+def format_options(mapfile, content_type):
+    """
+    function to get the options of the output format a response was
+    rendered with
+
+    :param mapfile: `mapscript.mapObj` of rendered mapfile
+    :param content_type: `str` of response content type
+
+    :returns: `dict` of output format options (FORMATOPTION)
+    """
+
+    outputformats = [mapfile.outputformat] + [
+        mapfile.getOutputFormat(i) for i in range(mapfile.numoutputformats)
+    ]
+
+    for outputformat in outputformats:
+        if outputformat is not None and outputformat.mimetype == content_type:
+            return dict(
+                outputformat.getOptionAt(i).split('=', 1)
+                for i in range(outputformat.numformatoptions)
+            )
+
+    return {}
+
+
+def metrics(start_response):
+    """
+    function to return the metrics of the current worker
+
+    :param start_response: WSGI `start_response` callable
+
+    :returns: `list` of response content
+    """
+
+    snapshot = METRICS.snapshot()
+
+    if RESPONSE_CACHE_ is not None:
+        snapshot['response_cache'] = RESPONSE_CACHE_.stats()
+
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(snapshot).encode()]
+
+
+def health(start_response):
+    """
+    function to return the liveness of the current worker
+
+    :param start_response: WSGI `start_response` callable
+
+    :returns: `list` of response content
+    """
+
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'OK']
+
+
+def readiness_report():
+    """
+    function to check the dependencies and caches of the current worker
+
+    :returns: `tuple` of `bool` of readiness and `dict` of readiness report
+    """
+
+    checks = {}
+    optional = []
+
+    if MAPFILE_STORAGE == 'store':
+        checks['store'] = lambda: check_store(get_store())
+    else:
+        checks['mapfiles'] = lambda: check_mapfiles(
+            os.path.join(BASEDIR, 'mapfile'))
+
+    ti = get_tileindex()
+    checks['tileindex'] = lambda: check_tileindex(ti)
+
+    # requests are still served from last known documents while the tile
+    # index is down
+    if ti.known() > 0:
+        optional.append('tileindex')
+
+    ready, degraded, results = run_checks(checks, optional)
+
+    caches = {}
+
+    if RESPONSE_CACHE_ is not None:
+        caches['response_cache'] = RESPONSE_CACHE_.stats()
+    if LEGEND_CACHE_ is not None:
+        caches['legend_cache'] = {
+            'rendered': LEGEND_CACHE_.index is not None
+        }
+    if STORE_MAPFILE_CACHE_ is not None and results.get('store', {}).get(
+            'ok'):
+        caches['store_mapfile_cache'] = {
+            'mapfiles': STORE_MAPFILE_CACHE_.cached(
+                results['store']['generation'])
+        }
+
+    return ready, {'degraded': degraded, 'checks': results,
+                   'caches': caches}
+
+
+def ready(start_response):
+    """
+    function to return the readiness of the current worker to serve
+    requests, without loading mapfiles
+
+    :param start_response: WSGI `start_response` callable
+
+    :returns: `list` of response content
+    """
+
+    global READINESS_
+
+    if READINESS_ is None:
+        READINESS_ = ReadinessProbe(readiness_report, READINESS_TTL)
+
+    ready_, report, age = READINESS_.get()
+
+    response = dict(report, ready=ready_, age=round(age, 3))
+
+    # worker load is always current
+    response['workers'] = {
+        'queued': ADMISSION_.queued if ADMISSION_ is not None else 0,
+        'active': ADMISSION_.active if ADMISSION_ is not None else 0,
+        'in_flight': FLIGHTS_.in_flight() if FLIGHTS_ is not None else 0
+    }
+
+    if ready_:
+        status = '200 OK'
+    else:
+        status = '503 Service Unavailable'
+
+    start_response(status, [('Content-Type', 'application/json'),
+                            ('Cache-Control', 'no-store')])
+    return [json.dumps(response).encode()]
+
+
+def layer_query_info(layerobj, layer, params):
+    """
+    function to get what is needed to sample a raster layer
+
+    :param layerobj: layer object of requested layer
+    :param layer: `str` of requested layer
+    :param params: `dict` of (uppercase) request parameters
+
+    :returns: `tuple` of layer projection, compiled classes and `list` of
+              band numbers (`None` for all bands)
+    """
+
+    if any([layerobj.type != mapscript.MS_LAYER_RASTER,
+            layerobj.connectiontype in [mapscript.MS_UVRASTER,
+                                        mapscript.MS_CONTOUR],
+            params.get('QUERY_LAYERS', layer) != layer]):
+        raise FeatureInfoUnsupported('Not a single raster layer')
+
+    bands = None
+    for i in range(layerobj.numprocessing):
+        key, _, value = layerobj.getProcessing(i).partition('=')
+        if key.strip().upper() == 'BANDS':
+            bands = [int(band) for band in value.split(',')]
+
+    classes = []
+    for i in range(layerobj.numclasses):
+        class_ = layerobj.getClass(i)
+        if class_.numstyles > 0:
+            color = class_.getStyle(0).color
+            rgb = (color.red, color.green, color.blue)
+        else:
+            rgb = (0, 0, 0)
+        classes.append((class_.name, class_.group,
+                        class_.getExpressionString(), rgb))
+
+    classgroup = params.get('STYLES') or layerobj.classgroup
+
+    return (layerobj.getProjection(), compile_classes(classes, classgroup),
+            bands)
+
+
+def fast_feature_info(layerobj, layer, query_string):
+    """
+    function to answer a raster layer GetFeatureInfo request by sampling
+    the layer data directly, without dispatching it to MapServer
+
+    :param layerobj: layer object of requested layer
+    :param layer: `str` of requested layer
+    :param query_string: `str` of request query string
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    params = {
+        key.upper(): value
+        for key, value in parse_qsl(query_string, keep_blank_values=True)
+    }
+
+    if not os.path.isfile(layerobj.data):
+        raise FeatureInfoUnsupported('Layer data is not on disk')
+
+    projection, classes, bands = layer_query_info(layerobj, layer, params)
+
+    return feature_info(layerobj.data, layer, projection, classes, params,
+                        bands)
+
+
+def time_series_feature_info(layerobj, layer, time, ref_time, query_string):
+    """
+    function to answer a GetFeatureInfo request for a range or list of
+    times with a single time series, resolving all data files at once
+
+    :param layerobj: layer object of requested layer
+    :param layer: `str` of requested layer
+    :param time: `str` of TIME parameter (range or list)
+    :param ref_time: `str` of model run
+    :param query_string: `str` of request query string
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    params = {
+        key.upper(): value
+        for key, value in parse_qsl(query_string, keep_blank_values=True)
+    }
+
+    projection, classes, bands = layer_query_info(layerobj, layer, params)
+
+    times = expand_times(time, layerobj.getMetaData('wms_timeextent'),
+                         layerobj.getMetaData('wms_available_intervals'))
+
+    paths = get_data_paths(layer, times, ref_time)
+    filepaths = [
+        path[0] if path is not None and os.path.isfile(path[0]) else None
+        for path in paths
+    ]
+
+    METRICS.incr('featureinfo.time_series')
+    METRICS.incr('featureinfo.time_series_steps', len(times))
+
+    return time_series(layer, times, filepaths, projection, classes,
+                       params, ref_time or None, bands)
+
+
+def prewarp_supported(layerobj):
+    """
+    function to check whether a layer can be rendered from pre-warped data
+    (pre-warping resamples to the nearest pixel, as MapServer does by
+    default, and does not rotate vector components)
+
+    :param layerobj: layer object
+
+    :returns: `bool` of whether pre-warped data can be rendered
+    """
+
+    if layerobj.type != mapscript.MS_LAYER_RASTER:
+        return False
+
+    if layerobj.connectiontype == mapscript.MS_UVRASTER:
+        return False
+
+    resample = layerobj.getProcessingKey('RESAMPLE')
+
+    return resample is None or resample.upper() == 'NEAREST'
+
+
+def warped_data_path(layerobj, query_string, filepath):
+    """
+    function to warp the data file of a GetMap request to the requested
+    map extent and size (also setting the layer data and projection), so
+    that MapServer renders it without reprojecting nor resampling it
+
+    :param layerobj: layer object
+    :param query_string: `str` of query string to render
+    :param filepath: path to layer data file
+
+    :returns: `str` of path to warped data file (`None` if not warped)
+    """
+
+    extent = warp_extent(query_string)
+
+    if extent is None or extent[0] not in PREWARP_CRS_:
+        return None
+
+    if not prewarp_supported(layerobj):
+        return None
+
+    crs, bounds, width, height = extent
+
+    if DATASETS_ is not None:
+        dataset = DATASETS_.open(filepath)
+    else:
+        dataset = nullcontext(gdal.Open(filepath))
+
+    try:
+        with dataset as src:
+            if src is None:
+                return None
+            warped = warp(src, layerobj.getProjection(), crs, bounds,
+                          (width, height), WARP_GRIDS_)
+    except Exception as err:
+        LOGGER.warning('Could not warp {} to {}: {}'.format(
+            filepath, crs, err))
+        return None
+
+    layerobj.data = warped
+    layerobj.setProjection(WARP_PROJECTIONS[crs])
+
+    return warped
+
+
+def admission(request_, layer):
+    """
+    function to get the admission of a render, limiting concurrent renders
+    (see `geomet_mapfile.admission`)
+
+    :param request_: `str` of request type (e.g. GetMap)
+    :param layer: `str` of requested layer(s)
+
+    :returns: context manager holding a render slot (raises
+              `geomet_mapfile.admission.AdmissionTimeout` if none frees up)
+    """
+
+    if ADMISSION_ is None:
+        return nullcontext()
+
+    return ADMISSION_.admit(
+        request_, layer.split(',') if layer is not None else None)
+
+
+def render(mapfile, request, query_string, request_, layer, filepath=None):
+    """
+    function to render an OWS request with MapServer (to be called within
+    the admission of the request)
+
+    :param mapfile: mapfile object
+    :param request: OWS request object
+    :param query_string: `str` of query string to render
+    :param request_: `str` of request type (e.g. GetMap)
+    :param layer: `str` of requested layer(s)
+    :param filepath: path to layer data file
+
+    :returns: `tuple` of content type and `bytes` of content
+    """
+
+    if all([DATASETS_ is not None, filepath is not None,
+            request_ in DATA_REQUESTS]):
+        # MapServer opens data files as GDAL shared datasets: keeping the
+        # dataset open in this thread saves reopening it for each render
+        DATASETS_.hold(filepath)
+
+    mapscript.msIO_installStdoutToBuffer()
+
+    request.loadParamsFromURL(query_string)
+
+    try:
+        LOGGER.debug('Dispatching OWS request')
+        mapfile.OWSDispatch(request)
+    except (mapscript.MapServerError, IOError) as err:
+        # let error propagate to service exception
+        LOGGER.error(err)
+        pass
+
+    headers = mapscript.msIO_getAndStripStdoutBufferMimeHeaders()
+    content = mapscript.msIO_getStdoutBufferBytes()
+
+    return headers['Content-Type'], content
+
+
+def tileindex_unavailable(start_response, err):
+    """
+    function to respond to a request whose data could not be looked up
+    because the tile index is unavailable
+
+    :param start_response: WSGI start_response callable
+    :param err: `geomet_mapfile.tileindex.guard.TileIndexUnavailable`
+
+    :returns: `list` of `bytes` of service exception
+    """
+
+    LOGGER.error(err)
+    _error = (
+        'ServiceUnavailable: Service temporairement indisponible, veuillez '
+        'réessayer / Service temporarily unavailable, please try again'
+    )
+    retry_after = str(int(max(TILEINDEX_BREAKER_RESET, 1)))
+    start_response('503 Service Unavailable',
+                   [('Content-type', 'text/xml'),
+                    ('Retry-After', retry_after)])
+
+    return [SERVICE_EXCEPTION.format(_error).encode()]
+
+
+def server_busy(start_response, err):
+    """
+    function to respond to a request which could not be admitted before the
+    admission timeout
+
+    :param start_response: WSGI start_response callable
+    :param err: `geomet_mapfile.admission.AdmissionTimeout`
+
+    :returns: `list` of `bytes` of service exception
+    """
+
+    LOGGER.warning(err)
+    _error = (
+        'ServerBusy: Serveur occupé, veuillez réessayer / '
+        'Server busy, please try again'
+    )
+    start_response('503 Service Unavailable',
+                   [('Content-type', 'text/xml'), ('Retry-After', '1')])
+
+    return [SERVICE_EXCEPTION.format(_error).encode()]
+
+
 def application(env, start_response):
     """WSGI application for WMS/WCS"""
 
+    if env.get('PATH_INFO') == '/metrics':
+        return metrics(start_response)
+    if env.get('PATH_INFO') == '/health':
+        return health(start_response)
+    if env.get('PATH_INFO') == '/ready':
+        return ready(start_response)
+
     for key in MAPSERV_ENV:
         if key in env:
             os.environ[key] = env[key]
@@ -192,6 +955,12 @@ def application(env, start_response):
 
     layer = None
     mapfile_ = None
+    reload_mapfile = None
+    store_version = None
+    cache_key = None
+    metatile = None
+    filepath = None
+    datapath = None
 
     request = mapscript.OWSRequest()
     request.loadParams()
@@ -234,6 +1003,19 @@ def application(env, start_response):
             msg = fh.read()
             return ['{}'.format(msg).encode()]
 
+    # if requesting a legend of a single layer, return pre-rendered legend
+    if all([request_ == 'GetLegendGraphic', LEGEND_CACHE_ is not None,
+            layer is not None,
+            not any(request.getValueByName(param) is not None
+                    for param in UNCACHED_PARAMS)]):
+        legend = LEGEND_CACHE_.get(layer, request.getValueByName('STYLE'),
+                                   request.getValueByName('FORMAT'), lang)
+        if legend is not None:
+            LOGGER.debug('Returning pre-rendered legend')
+            content_type, content = legend
+            start_response('200 OK', [('Content-Type', content_type)])
+            return [content]
+
     # if requesting GetCapabilities for entire service, return cache
     if request_ == 'GetCapabilities' and layer is None:
         LOGGER.debug('Requesting global mapfile')
@@ -260,11 +1042,27 @@ def application(env, start_response):
         if not os.path.exists(mapfile_):
             mapfile_ = None
     elif MAPFILE_STORAGE == 'store':
-        st = load_plugin('store', {'type': STORE_TYPE, 'url': STORE_URL})
+        st = get_store()
+        generation, revision = current_generation(st)
+        store_version = '{}.{}'.format(generation or 0, revision)
+        METRICS.gauge('store.generation', generation)
+
+        def get_store_mapfile(key):
+            if STORE_MAPFILE_CACHE_ is not None:
+                return STORE_MAPFILE_CACHE_.get(st, key, generation,
+                                                revision)
+            return st.get_key(versioned_key(key, generation))
+
+        mapfile_key = 'geomet-weather_mapfile'
         if layer is not None and ',' not in layer:
-            mapfile_ = st.get_key('{}_mapfile'.format(layer))
+            mapfile_ = get_store_mapfile('{}_mapfile'.format(layer))
+            if mapfile_ is not None:
+                mapfile_key = '{}_mapfile'.format(layer)
         if mapfile_ is None:
-            mapfile_ = st.get_key('geomet-weather_mapfile')
+            mapfile_ = get_store_mapfile(mapfile_key)
+
+        if STORE_MAPFILE_CACHE_ is not None:
+            reload_mapfile = partial(get_store_mapfile, mapfile_key)
 
     # if no mapfile at all is found return a Unsupported service exception
     if not mapfile_:
@@ -275,19 +1073,45 @@ def application(env, start_response):
         return [SERVICE_EXCEPTION.format(msg).encode()]
 
     else:
+        version = mapfile_version(mapfile_, store_version)
+
+        # checked before loading the mapfile, so keyed on the mapfile
+        # version instead of the data filepath, which is only resolved
+        # afterwards: default times and model runs come from the mapfile,
+        # and explicit ones are in the query string, so the version and the
+        # query string identify the tile index entry of the data file
+        exceptions_ = (request.getValueByName('EXCEPTIONS') or '').upper()
+        if all([RESPONSE_CACHE_ is not None,
+                request_ in CACHEABLE_REQUESTS,
+                not any(format_ in exceptions_
+                        for format_ in UNCACHEABLE_EXCEPTIONS)]):
+            cache_query_string = env['QUERY_STRING']
+
+            if (METATILE_SIZE > 1
+                    and metatiling_supported(
+                        request.getValueByName('FORMAT') or '')):
+                metatile = Metatile.from_query_string(
+                    env['QUERY_STRING'], METATILE_SIZE, METATILE_BUFFER)
+                if metatile is not None:
+                    cache_query_string = metatile.tile_query_string(
+                        cache_query_string)
+
+            cache_key = response_cache_key(cache_query_string, version)
+            cached = RESPONSE_CACHE_.get(cache_key)
+            if cached is not None:
+                LOGGER.debug('Returning cached response')
+                content_type, content = cached
+                start_response('200 OK', [('Content-Type', content_type)])
+                return [content]
+
         LOGGER.debug('Requesting layer mapfile')
-        if os.path.exists(mapfile_):
-            # read mapfile from filepath
-            LOGGER.debug('Loading mapfile {} from disk'.format(mapfile_))
-            mapfile = mapscript.mapObj(mapfile_)
-        else:
-            # read mapfile from string returned from store
-            LOGGER.debug(
-                'Loading {}_mapfile from store'.format(
-                    layer if layer else 'geomet-mapfile'
-                )
-            )
-            mapfile = mapscript.fromstring(mapfile_)
+        loaded, mapfile = load_mapfile(mapfile_, reload_mapfile)
+        if loaded != mapfile_:
+            # cached store mapfile evicted meanwhile, possibly by a newer one
+            mapfile_ = loaded
+            version = mapfile_version(mapfile_, store_version)
+            if cache_key is not None:
+                cache_key = response_cache_key(cache_query_string, version)
 
         layerobj = mapfile.getLayerByName(layer)
         time = request.getValueByName('TIME')
@@ -303,6 +1127,24 @@ def application(env, start_response):
         if ref_time is None:
             ref_time = layerobj.getMetaData('wms_reference_time_default')
 
+        if all([FEATUREINFO_FAST_PATH, request_ == 'GetFeatureInfo',
+                is_time_series(time)]):
+            try:
+                # samples up to MAX_TIME_STEPS data files
+                with admission(request_, layer):
+                    content_type, content = time_series_feature_info(
+                        layerobj, layer, time, ref_time,
+                        env['QUERY_STRING'])
+            except FeatureInfoUnsupported as err:
+                LOGGER.debug('Dispatching GetFeatureInfo: {}'.format(err))
+            except TileIndexUnavailable as err:
+                return tileindex_unavailable(start_response, err)
+            except AdmissionTimeout as err:
+                return server_busy(start_response, err)
+            else:
+                start_response('200 OK', [('Content-Type', content_type)])
+                return [content]
+
         try:
             filepath, url = get_data_path(layer, time, ref_time)
         except TileNotFoundError as err:
@@ -312,6 +1154,8 @@ def application(env, start_response):
             )
             start_response('200 OK', [('Content-type', 'text/xml')])
             return [SERVICE_EXCEPTION.format(time_error).encode()]
+        except TileIndexUnavailable as err:
+            return tileindex_unavailable(start_response, err)
 
         try:
             if request_ in ['GetMap', 'GetFeatureInfo']:
@@ -333,7 +1177,11 @@ def application(env, start_response):
                         with open(filepath, 'wb') as fh:
                             fh.write(r.read())
 
-            layerobj.data = filepath
+            datapath = filepath
+            if OPTIMIZER_ is not None and request_ in OPTIMIZED_REQUESTS:
+                datapath = OPTIMIZER_.resolve(filepath)
+
+            layerobj.data = datapath
 
         except ValueError as err:
             LOGGER.error(err)
@@ -349,32 +1197,85 @@ def application(env, start_response):
         if request_ == 'GetCapabilities' and lang == 'fr':
             metadata_lang(mapfile, layer.split(','), lang)
 
-    mapscript.msIO_installStdoutToBuffer()
+        if FEATUREINFO_FAST_PATH and request_ == 'GetFeatureInfo':
+            try:
+                with admission(request_, layer):
+                    content_type, content = fast_feature_info(
+                        layerobj, layer, env['QUERY_STRING'])
+            except FeatureInfoUnsupported as err:
+                LOGGER.debug('Dispatching GetFeatureInfo: {}'.format(err))
+            except AdmissionTimeout as err:
+                return server_busy(start_response, err)
+            else:
+                METRICS.incr('featureinfo.fast_path')
+                start_response('200 OK', [('Content-Type', content_type)])
+                return [content]
 
     # giving we don't use properly use tileindex due to performance issues
     # we need to remove the time parameter from the request for uvraster layer
     if 'time' in env['QUERY_STRING'].lower():
         query_string = env['QUERY_STRING'].split('&')
         query_string = [x for x in query_string if 'time' not in x.lower()]
-        request.loadParamsFromURL('&'.join(query_string))
+        query_string = '&'.join(query_string)
     else:
-        request.loadParamsFromURL(env['QUERY_STRING'])
+        query_string = env['QUERY_STRING']
+
+    if metatile is not None:
+        LOGGER.debug('Rendering {} metatile'.format(metatile.tiles))
+        query_string = metatile.render_query_string(query_string)
+
+    prewarp = all([WARP_GRIDS_ is not None, request_ == 'GetMap',
+                   datapath is not None])
+    if prewarp and metatile is None:
+        # only tiles of the metatile grids are warped, arbitrary map
+        # extents would each compute and keep their own warp grid
+        prewarp = Metatile.from_query_string(query_string, 1) is not None
+
+    def render_():
+        # pre-warping is part of the render, as costly as MapServer's own
+        # reprojection
+        with admission(request_, layer):
+            warped = None
+            if prewarp:
+                warped = warped_data_path(layerobj, query_string, datapath)
+
+            try:
+                return render(mapfile, request, query_string, request_,
+                              layer, datapath if warped is None else None)
+            finally:
+                if warped is not None:
+                    gdal.Unlink(warped)
 
     try:
-        LOGGER.debug('Dispatching OWS request')
-        mapfile.OWSDispatch(request)
-    except (mapscript.MapServerError, IOError) as err:
-        # let error propagate to service exception
-        LOGGER.error(err)
-        pass
-
-    headers = mapscript.msIO_getAndStripStdoutBufferMimeHeaders()
+        if FLIGHTS_ is not None and request_ in COLLAPSIBLE_REQUESTS:
+            flight_key = response_cache_key(query_string, filepath, version)
+            content_type, content = FLIGHTS_.do(flight_key, render_)
+        else:
+            content_type, content = render_()
+    except AdmissionTimeout as err:
+        return server_busy(start_response, err)
 
     headers_ = [
-        ('Content-Type', headers['Content-Type']),
+        ('Content-Type', content_type),
     ]
 
-    content = mapscript.msIO_getStdoutBufferBytes()
+    if metatile is not None and metatiling_supported(content_type):
+        tiles = metatile.split(content, content_type,
+                               format_options(mapfile, content_type))
+        for (col, row), tile in tiles.items():
+            tile_cache_key = response_cache_key(
+                metatile.tile_query_string(env['QUERY_STRING'], col, row),
+                version
+            )
+            RESPONSE_CACHE_.set(tile_cache_key, content_type, tile)
+        METRICS.incr('metatile.renders')
+        METRICS.incr('metatile.tiles', len(tiles))
+        content = tiles[(metatile.col, metatile.row)]
+    elif cache_key is not None and content_type.startswith('image/'):
+        RESPONSE_CACHE_.set(cache_key, content_type, content)
+
+    if STREAMING_THRESHOLD > 0 and len(content) >= STREAMING_THRESHOLD:
+        return stream_response(env, start_response, headers_, content, layer)
 
     start_response('200 OK', headers_)
 
@@ -82,6 +82,22 @@ class PyTest(Command):
         raise SystemExit(errno)
 
 
+class PyBenchmark(Command):
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        import subprocess
+        errno = subprocess.call([sys.executable,
+                                 'tests/run_benchmarks.py'])
+        raise SystemExit(errno)
+
+
 class PyCoverage(Command):
     user_options = []
 
@@ -166,5 +182,6 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python'
     ],
-    cmdclass={'test': PyTest, 'coverage': PyCoverage}
+    cmdclass={'test': PyTest, 'benchmark': PyBenchmark,
+              'coverage': PyCoverage}
 )
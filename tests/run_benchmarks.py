@@ -0,0 +1,624 @@
+###############################################################################
+#
+# Copyright (C) 2020 Etienne Pelletier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Benchmark suite for mapfile generation and request serving.
+#
+# The suite runs against a synthetic configuration, an in-memory (or
+# embedded SQLite) store and tile index and a stubbed mapscript module, so
+# that it can be run without any outside service:
+#
+#     python tests/run_benchmarks.py --output results.json
+#     python tests/run_benchmarks.py --backend sqlite
+#     python tests/run_benchmarks.py --update-baseline
+#
+# Results are compared against tests/benchmarks-baseline.json, and the run
+# fails if any benchmark is slower than the baseline by more than the
+# regression threshold. Median timings are compared relative to a pure
+# Python calibration loop timed before every run, so that the comparison
+# holds across machines and machine load.
+
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
+import gc
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+from unittest.mock import patch
+
+import click
+from yaml import dump, load, CLoader
+
+THISDIR = os.path.dirname(os.path.realpath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix='geomet-mapfile-benchmarks-')
+
+BASELINE = os.path.join(THISDIR, 'benchmarks-baseline.json')
+TEST_CONFIG = os.path.join(THISDIR, 'geomet-weather-test.yml')
+TEMPLATE_LAYER = 'GDPS.ETA_TT'
+
+DATEFORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# minimum duration of a single benchmark run (seconds)
+MIN_RUN_TIME = 0.2
+
+# 1x1 transparent PNG returned by the stubbed MapServer
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000000000500010d0a2db40000'
+    '000049454e44ae426082'
+)
+
+# the package requires these to be set at import time
+os.environ.setdefault('GEOMET_MAPFILE_BASEDIR', WORKDIR)
+os.environ.setdefault('GEOMET_MAPFILE_CONFIG',
+                      os.path.join(WORKDIR, 'config.yml'))
+for gdr_variable in ['GDR_BASEDIR', 'GDR_DATADIR', 'GDR_TILEINDEX_TYPE',
+                     'GDR_TILEINDEX_BASEURL', 'GDR_TILEINDEX_NAME',
+                     'GDR_STORE_TYPE', 'GDR_STORE_URL',
+                     'GDR_METPX_EVENT_FILE_PY',
+                     'GDR_METPX_EVENT_MESSAGE_PY']:
+    os.environ.setdefault(gdr_variable, WORKDIR)
+
+
+def stub_mapscript():
+    """
+    Create a mapscript stand-in so that the WSGI request path can be
+    benchmarked without MapServer rendering
+
+    :returns: `module` of mapscript stub
+    """
+
+    mapscript = types.ModuleType('mapscript')
+    buffer_ = {}
+
+    class MapServerError(Exception):
+        pass
+
+    class OWSRequest:
+        def __init__(self):
+            self.params = {}
+
+        def loadParams(self):
+            self.loadParamsFromURL(os.environ.get('QUERY_STRING', ''))
+
+        def loadParamsFromURL(self, query_string):
+            self.params = {}
+            for param in query_string.split('&'):
+                key, _, value = param.partition('=')
+                self.params[key.upper()] = value
+
+        def getValueByName(self, name):
+            return self.params.get(name.upper())
+
+    class layerObj:
+        def __init__(self, metadata):
+            self.data = None
+            self.metadata = metadata
+
+        def getMetaData(self, key):
+            return self.metadata.get(key, '')
+
+        def setMetaData(self, key, value):
+            self.metadata[key] = value
+
+    class mapObj:
+        def __init__(self, filepath=None):
+            self.metadata = {}
+            self.layers = {}
+            if filepath is not None:
+                with open(filepath) as fh:
+                    fh.read()
+
+        def getLayerByName(self, name):
+            if name not in self.layers:
+                self.layers[name] = layerObj({
+                    'wms_timedefault': '2020-01-14T00:00:00Z',
+                    'wms_reference_time_default': '2020-01-14T00:00:00Z'
+                })
+            return self.layers[name]
+
+        def getMetaData(self, key):
+            return self.metadata.get(key, '')
+
+        def setMetaData(self, key, value):
+            self.metadata[key] = value
+
+        def OWSDispatch(self, request):
+            buffer_['headers'] = {'Content-Type': 'image/png'}
+            buffer_['content'] = PNG
+
+    mapscript.MapServerError = MapServerError
+    mapscript.OWSRequest = OWSRequest
+    mapscript.mapObj = mapObj
+    mapscript.fromstring = lambda string: mapObj()
+    mapscript.msIO_installStdoutToBuffer = lambda: None
+    mapscript.msIO_resetHandlers = lambda: None
+    mapscript.msIO_getAndStripStdoutBufferMimeHeaders = \
+        lambda: buffer_['headers']
+    mapscript.msIO_getStdoutBufferBytes = lambda: buffer_['content']
+
+    return mapscript
+
+
+sys.modules['mapscript'] = stub_mapscript()
+sys.path.insert(0, os.path.dirname(THISDIR))
+
+from geomet_mapfile import mapfile, plugin, wsgi  # noqa
+from geomet_mapfile.cache import ResponseCache  # noqa
+
+
+class FakeStore:
+    """In-memory store mimicking the Redis store plugin"""
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else {}
+
+    def get_key(self, key, raw=False):
+        if not raw:
+            key = f'geomet-mapfile_{key}'
+        return self.data.get(key)
+
+    def set_key(self, key, value, raw=False):
+        if not raw:
+            key = f'geomet-mapfile_{key}'
+        self.data[key] = value
+        return True
+
+    def get_keys(self, keys, raw=False):
+        return {key: self.get_key(key, raw) for key in keys}
+
+    def set_keys(self, values, raw=False):
+        for key, value in values.items():
+            self.set_key(key, value, raw)
+        return True
+
+    def incr_key(self, key):
+        key = f'geomet-mapfile_{key}'
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def set_key_nx(self, key, value, expire=None):
+        if self.get_key(key) is not None:
+            return False
+        return self.set_key(key, value)
+
+    def delete_key(self, key):
+        return self.data.pop(f'geomet-mapfile_{key}', None) is not None
+
+    def add_members(self, key, members):
+        members_ = self.data.setdefault(f'geomet-mapfile_{key}', set())
+        count = len(set(members) - members_)
+        members_.update(members)
+        return count
+
+    def pop_members(self, key):
+        return self.data.pop(f'geomet-mapfile_{key}', set())
+
+    def delete_keys(self, keys, raw=False):
+        for key in keys:
+            self.data.pop(key if raw else f'geomet-mapfile_{key}', None)
+        return len(keys)
+
+    def list_keys(self, pattern=None):
+        return [key for key in self.data
+                if pattern is None or fnmatch(key, pattern)]
+
+
+class FakeTileIndex:
+    """In-memory tile index mimicking the tileindex plugin"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def get(self, identifier):
+        return {
+            'properties': {
+                'identifier': identifier,
+                'filepath': self.filepath,
+                'url': 'https://dd.weather.gc.ca/fake.grib2'
+            }
+        }
+
+
+def synthetic_config(num_layers):
+    """
+    Generate a synthetic configuration by cloning the test layer
+
+    :param num_layers: `int` of number of layers to generate
+
+    :returns: `tuple` of configuration `dict` and store data `dict`
+    """
+
+    with open(TEST_CONFIG) as fh:
+        cfg = load(fh, Loader=CLoader)
+
+    mcf_file = os.path.join(WORKDIR, 'synthetic-mcf.yml')
+    with open(mcf_file, 'w') as fh:
+        dump({
+            'metadata': {'dataseturi': 'https://fake.uri/synthetic'},
+            'identification': {
+                'abstract': {'en': 'Synthetic', 'fr': 'Synthétique'},
+                'keywords': {
+                    'default': {
+                        'keywords': {'en': ['synthetic'], 'fr': ['synthèse']}
+                    }
+                }
+            }
+        }, fh)
+
+    forecast_model = deepcopy(cfg['layers'][TEMPLATE_LAYER]['forecast_model'])
+    # absolute MCF path overrides the resources/mcf directory
+    forecast_model['mcf'] = mcf_file
+    cfg['forecast_models']['synthetic'] = forecast_model
+
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    start = (now - timedelta(hours=12)).strftime(DATEFORMAT)
+    end = (now + timedelta(hours=228)).strftime(DATEFORMAT)
+    model_run = (now - timedelta(hours=12)).strftime(DATEFORMAT)
+
+    layers = {}
+    store_data = {}
+    for i in range(num_layers):
+        name = f'SYNTH.{i:04d}_TT'
+        layer = deepcopy(cfg['layers'][TEMPLATE_LAYER])
+        layer['forecast_model'] = forecast_model
+        layers[name] = layer
+
+        prefix = f'geomet-data-registry_{name}'
+        store_data[f'{prefix}_time_extent'] = f'{start}/{end}/PT3H'
+        store_data[f'{prefix}_default_time'] = start
+        store_data[f'{prefix}_model_run_extent'] = \
+            f'{model_run}/{model_run}/PT12H'
+        store_data[f'{prefix}_default_model_run'] = model_run
+
+    cfg['layers'] = layers
+
+    return cfg, store_data
+
+
+def calibration_loop():
+    """
+    Fixed pure Python workload (string formatting, dict and list
+    operations, as in mapfile generation and request handling) timed
+    alongside the benchmarks, to normalize timings for machine speed
+
+    :returns: `int` of checksum
+    """
+
+    values = {}
+    for i in range(20000):
+        key = 'LAYER.{:05d}_TT'.format(i)
+        values[key] = key.lower().split('.')
+    return sum(len(value) for value in values.values())
+
+
+def measure(func, repeat):
+    """
+    Time a benchmark. Fast benchmarks are looped so that every run lasts at
+    least `MIN_RUN_TIME`, in order to reduce timer and scheduling noise.
+    Every run is preceded by a run of the calibration loop, so that timings
+    can be normalized for the machine speed and load at the time of the run
+
+    :param func: callable to benchmark
+    :param repeat: `int` of number of runs
+
+    :returns: `dict` of per-call timing statistics (seconds)
+    """
+
+    start = time.perf_counter()
+    func()
+    number = max(1, math.ceil(MIN_RUN_TIME / (time.perf_counter() - start)))
+
+    timings = []
+    calibrations = []
+    for _ in range(repeat):
+        # garbage of previous runs is collected outside of the timings
+        gc.collect()
+        start = time.perf_counter()
+        calibration_loop()
+        calibrations.append(time.perf_counter() - start)
+
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+
+    return {
+        'runs': repeat,
+        'loops': number,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'calibration': statistics.median(calibrations),
+        # timing in calibration loop units, as compared against baselines
+        'normalized': statistics.median(
+            timing / calibration
+            for timing, calibration in zip(timings, calibrations))
+    }
+
+
+def _generate_layer(layer):
+    return mapfile.generate_mapfile(layer, 'file')
+
+
+def sqlite_backends(store_data, layer_names, filepath):
+    """
+    Create the embedded SQLite store and tile index plugins
+
+    :param store_data: `dict` of store keys and values
+    :param layer_names: `list` of layer names
+    :param filepath: path to data file of every tile
+
+    :returns: `tuple` of store and tile index plugins
+    """
+
+    store = plugin.load_plugin('store', {
+        'type': 'SQLite',
+        'url': os.path.join(WORKDIR, 'store.db')
+    })
+    store.set_keys(store_data, raw=True)
+
+    tileindex = plugin.load_plugin('tileindex', {
+        'type': 'SQLite',
+        'url': os.path.join(WORKDIR, 'tileindex.db'),
+        'name': 'geomet-data-registry'
+    })
+    # tiles of the default time of the stubbed mapscript layers
+    tileindex.bulk_add([{
+        'type': 'Feature',
+        'geometry': None,
+        'properties': {
+            'identifier': wsgi.tileindex_id(name, '2020-01-14T00:00:00Z',
+                                            '2020-01-14T00:00:00Z'),
+            'layer': name,
+            'filepath': filepath,
+            'url': 'https://dd.weather.gc.ca/fake.grib2'
+        }
+    } for name in layer_names])
+
+    return store, tileindex
+
+
+def run_benchmarks(num_layers, repeat, workers, backend='memory'):
+    """
+    Run the benchmark suite
+
+    :param num_layers: `int` of number of synthetic layers
+    :param repeat: `int` of number of runs per benchmark
+    :param workers: `int` of number of processes for parallel generation
+    :param backend: `str` of store and tile index backend (memory or
+                    sqlite)
+
+    :returns: `dict` of benchmark results
+    """
+
+    cfg, store_data = synthetic_config(num_layers)
+    config_file = os.path.join(WORKDIR, 'config.yml')
+    with open(config_file, 'w') as fh:
+        dump(cfg, fh, allow_unicode=True)
+
+    data_file = os.path.join(WORKDIR, 'data.grib2')
+    with open(data_file, 'wb') as fh:
+        fh.write(b'GRIB')
+
+    layer_names = list(cfg['layers'].keys())
+
+    if backend == 'sqlite':
+        store, tileindex = sqlite_backends(store_data, layer_names,
+                                           data_file)
+    else:
+        store = FakeStore(store_data)
+        tileindex = FakeTileIndex(data_file)
+
+    def load_plugin(plugin_type, plugin_def):
+        return store if plugin_type == 'store' else tileindex
+
+    first_layer = layer_names[0]
+    mapfile_dir = os.path.join(WORKDIR, 'mapfile')
+
+    results = {}
+
+    with patch.multiple(mapfile, BASEDIR=WORKDIR, CONFIG=config_file,
+                        load_plugin=load_plugin), \
+            patch.multiple(wsgi, BASEDIR=WORKDIR, MAPFILE_STORAGE='file',
+                           STORE_=None, TILEINDEX_=None,
+                           load_plugin=load_plugin):
+
+        results['layer_time_config'] = measure(
+            lambda: [mapfile.layer_time_config(name)
+                     for name in layer_names], repeat)
+
+        results['gen_layer'] = measure(
+            lambda: [mapfile.gen_layer(name, cfg['layers'][name])
+                     for name in layer_names], repeat)
+
+        results['generate_mapfile_serial'] = measure(
+            lambda: mapfile.generate_mapfile(None, 'file'), repeat)
+
+        with ProcessPoolExecutor(workers) as executor:
+            results['generate_mapfile_parallel'] = measure(
+                lambda: list(executor.map(_generate_layer, layer_names)),
+                repeat)
+
+        # per-layer refreshes of a Celery worker, with a warm context
+        context = mapfile.GenerationContext()
+        results['refresh_mapfile_warm'] = measure(
+            lambda: [mapfile.generate_mapfile(name, 'file', context=context)
+                     for name in layer_names], repeat)
+
+        # batched refresh of all layers, as done by refresh_mapfiles
+        results['refresh_mapfiles_batch'] = measure(
+            lambda: mapfile.generate_mapfile(layer_names, 'store',
+                                             context=context), repeat)
+
+        results['generate_mapfile_store'] = measure(
+            lambda: mapfile.generate_mapfile(None, 'store'), repeat)
+
+        layer_mapfile = os.path.join(
+            mapfile_dir, f'geomet-weather-{first_layer}_layer.map')
+        with open(layer_mapfile) as fh:
+            layer_mapfile_content = fh.read()
+
+        results['find_replace_wms_timedefault'] = measure(
+            lambda: [mapfile.find_replace_wms_timedefault(
+                first_layer, layer_mapfile_content)
+                for _ in layer_names], repeat)
+
+        results['update_mapfile'] = measure(
+            lambda: mapfile.update_mapfile(), repeat)
+
+        query_string = (
+            'SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&LAYERS={}'
+            '&CRS=EPSG:4326&BBOX=-90,-180,90,180&WIDTH=256&HEIGHT=256'
+            '&FORMAT=image/png'
+        )
+
+        def serve_requests():
+            for name in layer_names:
+                env = {'QUERY_STRING': query_string.format(name),
+                       'PATH_INFO': '/'}
+                os.environ['QUERY_STRING'] = env['QUERY_STRING']
+                wsgi.application(env, lambda status, headers: None)
+
+        results['wsgi_getmap'] = measure(serve_requests, repeat)
+
+        # response cache hits, answered before loading mapfiles
+        with patch.object(wsgi, 'RESPONSE_CACHE_', ResponseCache(67108864)):
+            serve_requests()
+            results['wsgi_getmap_cached'] = measure(serve_requests, repeat)
+
+    return {
+        'metadata': {
+            'datetime': datetime.utcnow().strftime(DATEFORMAT),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'layers': num_layers,
+            'repeat': repeat,
+            'workers': workers,
+            'backend': backend
+        },
+        'results': results
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare benchmark results against a baseline. Median timings are
+    compared in calibration loop units, so that differences in machine
+    speed and load between the runs are factored out
+
+    :param results: `dict` of benchmark results
+    :param baseline: `dict` of baseline benchmark results
+    :param threshold: `float` of allowed slowdown ratio (0.5 = 50%)
+
+    :returns: `list` of regressed benchmark names
+    """
+
+    regressions = []
+
+    for name, result in sorted(results['results'].items()):
+        if 'normalized' not in baseline['results'].get(name, {}):
+            click.echo(f'{name}: {result["median"]:.4f}s (no baseline)')
+            continue
+
+        reference = baseline['results'][name]
+        ratio = result['normalized'] / reference['normalized']
+        status = 'OK'
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+
+        click.echo(f'{name}: {result["median"]:.4f}s vs '
+                   f'{reference["median"]:.4f}s ({ratio:.2f}x normalized) '
+                   f'{status}')
+
+    return regressions
+
+
+@click.command()
+@click.option('--layers', '-n', 'num_layers', type=int, default=50,
+              help='Number of synthetic layers')
+@click.option('--repeat', '-r', type=int, default=5,
+              help='Number of runs per benchmark')
+@click.option('--workers', '-w', type=int, default=4,
+              help='Number of processes for parallel generation')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Path to write JSON results')
+@click.option('--baseline', '-b', type=click.Path(dir_okay=False),
+              default=BASELINE, help='Path to baseline JSON results')
+@click.option('--threshold', '-t', type=float, default=0.5,
+              help='Allowed slowdown against baseline (0.5 = 50%)')
+@click.option('--update-baseline', is_flag=True,
+              help='Write results as the new baseline')
+@click.option('--backend', type=click.Choice(['memory', 'sqlite']),
+              default='memory', help='Store and tile index backend')
+def benchmark(num_layers, repeat, workers, output, baseline, threshold,
+              update_baseline, backend):
+    """Run geomet-mapfile benchmarks"""
+
+    try:
+        results = run_benchmarks(num_layers, repeat, workers, backend)
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    if output is not None:
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=4)
+
+    if update_baseline:
+        with open(baseline, 'w') as fh:
+            json.dump(results, fh, indent=4)
+        click.echo(f'Baseline written to {baseline}')
+        return
+
+    if not os.path.exists(baseline):
+        click.echo(json.dumps(results, indent=4))
+        return
+
+    with open(baseline) as fh:
+        baseline_results = json.load(fh)
+
+    if baseline_results['metadata']['layers'] != num_layers:
+        raise click.ClickException(
+            'Baseline was run with {} layers'.format(
+                baseline_results['metadata']['layers']))
+
+    if baseline_results['metadata'].get('backend', 'memory') != backend:
+        raise click.ClickException(
+            'Baseline was run with the {} backend'.format(
+                baseline_results['metadata'].get('backend', 'memory')))
+
+    regressions = compare(results, baseline_results, threshold)
+
+    if regressions:
+        raise click.ClickException(
+            'Performance regression in {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -18,16 +18,70 @@
 ###############################################################################
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fnmatch import fnmatchcase
+import io
 import json
 import os
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+from geomet_data_registry.tileindex.base import TileNotFoundError
 from yaml import load, CLoader
 
-from geomet_mapfile.mapfile import gen_web_metadata, gen_layer
+from geomet_mapfile.admission import AdmissionController, AdmissionTimeout
+from geomet_mapfile.breaker import (CircuitBreaker, CircuitOpenError, CLOSED,
+                                    OPEN)
+from geomet_mapfile.catalog import LayerCatalog, load_catalog
+from geomet_mapfile.dataset import (DatasetCache, overview_levels,
+                                    ThreadDatasetCache)
+from geomet_mapfile.featureinfo import (classify, compile_classes,
+                                        compile_expression, expand_times,
+                                        format_items, format_response,
+                                        FeatureInfoUnsupported,
+                                        is_time_series, request_point,
+                                        time_series, transform)
+from geomet_mapfile.flight import encode_result, SingleFlight
+from geomet_mapfile.health import (check_mapfiles, check_store,
+                                   check_tileindex, ReadinessProbe,
+                                   run_checks)
+from geomet_mapfile.legend import (legend_filename, legend_key,
+                                   legend_styles, LegendCache,
+                                   write_legend_index)
+from geomet_mapfile.cache import (ResponseCache, response_cache_key,
+                                  StoreMapfileCache)
+from geomet_mapfile.mapfile import (GenerationContext, gen_web_metadata,
+                                    gen_layer, layer_time_config,
+                                    layer_time_keys, LayerTimeConfigError,
+                                    mapfile_lock, new_mapfile_version,
+                                    publish_mapfile_version, select_layers,
+                                    watch_mapfiles)
+from geomet_mapfile.metatile import Image, Metatile
+from geomet_mapfile.metrics import METRICS
+from geomet_mapfile.optimize import DataOptimizer, optimized_source
 from geomet_mapfile.plugin import load_plugin
+from geomet_mapfile.snapshot import (content_version, current_generation,
+                                     delete_old_generations,
+                                     publish_snapshot, update_snapshot,
+                                     version_key, versioned_key,
+                                     write_generation)
+from geomet_mapfile.profiling import PhaseProfiler
 from geomet_mapfile.store.redis_ import RedisStore
+from geomet_mapfile.store.sqlite_ import SQLiteStore
+from geomet_mapfile.tileindex.guard import (GuardedTileIndex,
+                                            TileIndexUnavailable)
+from geomet_mapfile.tileindex.replica import (ReplicatedTileIndex,
+                                              sync_replica)
+from geomet_mapfile.tileindex.sqlite_ import SQLiteTileIndex
+from geomet_mapfile.util import atomic_write
+from geomet_mapfile.wsgi import (load_mapfile, mapfile_version,
+                                 stream_response)
+from geomet_mapfile.warp import (grid_key, grid_window, NODATA_INDEX, np,
+                                 warp_array, warp_extent, WarpGridCache)
 
 THISDIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -61,6 +115,49 @@ class Store:
         except KeyError:
             return None
 
+    def get_keys(self, keys, raw=False):
+        return {key: self.get_key(key, raw) for key in keys}
+
+    def set_key(self, key, value, raw=False, expire=None):
+        self.data[key if raw else f'geomet-mapfile_{key}'] = str(value)
+        return True
+
+    def set_key_nx(self, key, value, expire=None):
+        if self.get_key(key) is not None:
+            return False
+        return self.set_key(key, value)
+
+    def delete_key(self, key):
+        return self.data.pop(f'geomet-mapfile_{key}', None) is not None
+
+    def add_members(self, key, members):
+        members_ = self.data.setdefault(f'geomet-mapfile_{key}', set())
+        count = len(set(members) - members_)
+        members_.update(members)
+        return count
+
+    def pop_members(self, key):
+        return self.data.pop(f'geomet-mapfile_{key}', set())
+
+    def set_keys(self, values, raw=False):
+        for key, value in values.items():
+            self.set_key(key, value, raw)
+        return True
+
+    def incr_key(self, key):
+        value = int(self.get_key(key) or 0) + 1
+        self.set_key(key, value)
+        return value
+
+    def list_keys(self, pattern=None):
+        return [key for key in self.data
+                if pattern is None or fnmatchcase(key, pattern)]
+
+    def delete_keys(self, keys, raw=False):
+        for key in keys:
+            self.data.pop(key if raw else f'geomet-mapfile_{key}', None)
+        return len(keys)
+
 
 class GeoMetMapfileTest(unittest.TestCase):
     """Test suite for geomet-mapfile package"""
@@ -135,6 +232,1210 @@ class GeoMetMapfileTest(unittest.TestCase):
         self.assertTrue(
             result[0]['metadata']['wms_layer_group_fr'] == wms_layer_group_fr)
 
+    def test_layer_time_config_prefetched(self):
+        """test prefetched time keys match time keys fetched from store"""
+
+        store = Store()
+
+        self.assertEqual(
+            layer_time_config('GDPS.ETA_TT', time_keys=store.data),
+            layer_time_config('GDPS.ETA_TT', store)
+        )
+
+        with self.assertRaises(LayerTimeConfigError):
+            layer_time_config('GDPS.ETA_TT', time_keys={})
+
+        # default time is the interval nearest to the time of the call
+        time_keys = dict(zip(layer_time_keys('GDPS.ETA_TT'), [
+            '2020-01-14T00:00:00Z/2020-01-15T00:00:00Z/PT3H',
+            '2020-01-14T00:00:00Z',
+            '2020-01-14T00:00:00Z/2020-01-14T00:00:00Z/PT12H',
+            '2020-01-14T00:00:00Z'
+        ]))
+
+        for now, default_time in [((2020, 1, 14, 4), '2020-01-14T03:00:00Z'),
+                                  ((2020, 1, 14, 17), '2020-01-14T18:00:00Z')]:
+            class Clock(datetime):
+                @classmethod
+                def utcnow(cls):
+                    return cls(*now)
+
+            with patch('geomet_mapfile.mapfile.datetime', Clock):
+                self.assertEqual(layer_time_config(
+                    'GDPS.ETA_TT', time_keys=time_keys)['default_time'],
+                    default_time)
+
+    def test_response_cache(self):
+        """test response cache keys and memory tier LRU eviction"""
+
+        key1 = response_cache_key('layers=A&request=GetMap', '/data/a.grib2')
+        key2 = response_cache_key('REQUEST=GetMap&LAYERS=A', '/data/a.grib2')
+        key3 = response_cache_key('REQUEST=GetMap&LAYERS=A', '/data/b.grib2')
+
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+
+        cache = ResponseCache(memory_size=10)
+        cache.set('a', 'image/png', b'12345')
+        cache.set('b', 'image/png', b'12345')
+        self.assertEqual(cache.get('a'), ('image/png', b'12345'))
+
+        # 'b' is least recently used and gets evicted
+        cache.set('c', 'image/png', b'12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), ('image/png', b'12345'))
+
+    def test_metatile(self):
+        """test detection of grid aligned tiles and metatile extent"""
+
+        query_string = ('SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap'
+                        '&CRS=EPSG:4326&BBOX=0,-90,90,0'
+                        '&WIDTH=256&HEIGHT=256&FORMAT=image/png')
+
+        metatile = Metatile.from_query_string(query_string, 4)
+
+        self.assertEqual((metatile.zoom, metatile.col, metatile.row),
+                         (1, 1, 0))
+        # zoom level 1 only has 4 x 2 tiles
+        self.assertEqual(len(metatile.tiles), 8)
+        self.assertEqual((metatile.width, metatile.height), (1024, 512))
+        self.assertEqual(metatile.bbox, '-90.0,-180.0,90.0,180.0')
+
+        query_string = query_string.replace('0,-90,90,0', '1,-90,90,0')
+        self.assertIsNone(Metatile.from_query_string(query_string, 4))
+
+    @unittest.skipIf(Image is None, 'Pillow not installed')
+    def test_metatile_split(self):
+        """test metatiles are rendered with a buffer and split in tiles
+        encoded with the options of the MapServer output format"""
+
+        metatile = Metatile('EPSG:4326', 0, 0, 0, 2, buffer=8)
+
+        self.assertEqual((metatile.width, metatile.height), (528, 272))
+        self.assertEqual(metatile.bbox, '-185.625,-95.625,185.625,95.625')
+
+        # quantized metatile, the buffer is left out of the tiles
+        image = Image.new('P', (metatile.width, metatile.height), 1)
+        image.putpalette([0, 0, 0, 255, 0, 0] + [0] * 762)
+        image.paste(0, (0, 0, metatile.width, 8))
+        content = io.BytesIO()
+        image.save(content, format='PNG', transparency=0)
+
+        tiles = metatile.split(content.getvalue(), 'image/png',
+                               {'COMPRESSION': '9'})
+        self.assertEqual(sorted(tiles), [(0, 0), (1, 0)])
+        tile = Image.open(io.BytesIO(tiles[(0, 0)]))
+        self.assertEqual((tile.mode, tile.info['transparency']), ('P', 0))
+        self.assertEqual(tile.size, (256, 256))
+        self.assertEqual(tile.getcolors(), [(65536, 1)])
+
+        image = Image.effect_noise((metatile.width, metatile.height), 64)
+        content = io.BytesIO()
+        image.convert('RGB').save(content, format='JPEG', quality=95)
+
+        sizes = [
+            len(metatile.split(content.getvalue(), 'image/jpeg',
+                               {'QUALITY': quality})[(0, 0)])
+            for quality in ['95', '30']
+        ]
+        self.assertGreater(sizes[0], sizes[1])
+
+    def test_phase_profiler(self):
+        """test nested phases are only accounted for once"""
+
+        profiler = PhaseProfiler()
+
+        with profiler.timed('layer build', 'A'):
+            with profiler.timed('style load', 'A'):
+                time.sleep(0.02)
+
+        self.assertLess(profiler.phases['layer build'], 0.02)
+        self.assertGreaterEqual(profiler.phases['style load'], 0.02)
+        self.assertAlmostEqual(
+            profiler.layers['A'], sum(profiler.phases.values()))
+
+    def test_load_catalog(self):
+        """test compiled layer catalog matches configuration"""
+
+        with tempfile.TemporaryDirectory() as basedir:
+            catalog = load_catalog(self.yml_file, basedir)
+            self.assertTrue(os.path.exists(catalog.filepath))
+
+            # reload from compiled catalog
+            catalog = load_catalog(self.yml_file, basedir)
+            self.assertEqual(catalog.layer_names, ['GDPS.ETA_TT'])
+            self.assertEqual(catalog.get_layer('GDPS.ETA_TT'),
+                             self.cfg['layers']['GDPS.ETA_TT'])
+            self.assertEqual(catalog.metadata, self.cfg['metadata'])
+            self.assertEqual(catalog.get_model_layers('gdps'),
+                             ['GDPS.ETA_TT'])
+
+            with self.assertRaises(KeyError):
+                catalog.get_layer('__metadata__')
+
+            # forecast models merged into a layer forecast model
+            config = os.path.join(basedir, 'merge.yml')
+            with open(config, 'w') as fh:
+                fh.write('forecast_models:\n'
+                         '    a: &a {mcf: a.yml}\n'
+                         'metadata: {}\n'
+                         'layers:\n'
+                         '    A: {forecast_model: *a}\n'
+                         '    B: {forecast_model: {<<: *a, interval: 12}}\n')
+
+            catalog = load_catalog(config, basedir)
+            self.assertEqual(catalog.get_model_layers('a'), ['A', 'B'])
+
+            # entries are read from the catalog the header was read from,
+            # even if it is compiled again meanwhile
+            catalog = load_catalog(config, basedir)
+            with open(config, 'w') as fh:
+                fh.write('forecast_models:\n'
+                         '    a: &a {mcf: a.yml}\n'
+                         'metadata: {}\n'
+                         'layers:\n'
+                         '    Z: {forecast_model: *a, interval: 6}\n'
+                         '    B: {forecast_model: *a}\n')
+            LayerCatalog(config, catalog.filepath).compile()
+
+            self.assertEqual(catalog.get_layer('B'),
+                             {'forecast_model': {'mcf': 'a.yml',
+                                                 'interval': 12}})
+            catalog.close()
+
+    def test_generation_context(self):
+        """test generation context reloads modified inputs"""
+
+        context = GenerationContext()
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fh:
+            json.dump([{'name': 'a'}], fh)
+            fh.flush()
+
+            style = context.style(fh.name)
+            self.assertIs(context.style(fh.name), style)
+
+            fh.seek(0)
+            json.dump([{'name': 'b'}], fh)
+            fh.flush()
+            os.utime(fh.name, ns=(0, time.time_ns() + 10 ** 9))
+
+            self.assertEqual(context.style(fh.name), [{'name': 'b'}])
+
+        self.assertEqual(context.dumps({'__type__': 'layer', 'name': 'a'}),
+                         'LAYER\n    NAME "a"\nEND')
+
+    def test_select_layers(self):
+        """test layer selection by forecast model, name and update time"""
+
+        with tempfile.TemporaryDirectory() as basedir:
+            catalog = load_catalog(self.yml_file, basedir)
+
+            self.assertEqual(select_layers(catalog, ['gdps']),
+                             ['GDPS.ETA_TT'])
+            self.assertEqual(select_layers(catalog, patterns=['RDPS.*']), [])
+            self.assertEqual(select_layers(catalog, regex='ETA_TT$'),
+                             ['GDPS.ETA_TT'])
+            self.assertEqual(
+                select_layers(catalog, changed_since=datetime(2020, 1, 13),
+                              store=Store()),
+                ['GDPS.ETA_TT']
+            )
+            self.assertEqual(
+                select_layers(catalog, ['gdps'],
+                              changed_since=datetime(2020, 1, 15),
+                              store=Store()),
+                []
+            )
+
+            with self.assertRaises(KeyError):
+                select_layers(catalog, ['rdps'])
+
+    def test_watch_mapfiles(self):
+        """test layers are regenerated when their time keys change"""
+
+        class WatchedStore(Store):
+            def listen_keys(self, patterns, timeout=1):
+                yield 'geomet-data-registry_GDPS.ETA_TT_time_extent'
+                yield 'geomet-data-registry_GDPS.ETA_TT_default_time'
+                yield 'geomet-data-registry_UNKNOWN_time_extent'
+
+        with tempfile.TemporaryDirectory() as basedir, \
+                patch.multiple('geomet_mapfile.mapfile', BASEDIR=basedir,
+                               CONFIG=self.yml_file,
+                               load_plugin=lambda *args: WatchedStore()), \
+                patch('geomet_mapfile.mapfile.generate_mapfile',
+                      return_value=True) as generate_mapfile:
+            watch_mapfiles('store', debounce=60)
+
+        self.assertEqual(generate_mapfile.call_count, 1)
+        self.assertEqual(generate_mapfile.call_args[0][:2],
+                         (['GDPS.ETA_TT'], 'store'))
+
+        # generation and store errors do not end the watcher
+        class FlakyStore(Store):
+            listens = 0
+
+            def listen_keys(self, patterns, timeout=1):
+                FlakyStore.listens += 1
+                yield 'geomet-data-registry_GDPS.ETA_TT_time_extent'
+                if FlakyStore.listens == 1:
+                    raise ConnectionError('store connection lost')
+
+        with tempfile.TemporaryDirectory() as basedir, \
+                patch.multiple('geomet_mapfile.mapfile', BASEDIR=basedir,
+                               CONFIG=self.yml_file, WATCH_RETRY_DELAY=0,
+                               load_plugin=lambda *args: FlakyStore()), \
+                patch('geomet_mapfile.mapfile.generate_mapfile',
+                      side_effect=[KeyError('UNKNOWN'), True]) \
+                as generate_mapfile:
+            watch_mapfiles('store', debounce=60, max_delay=0)
+
+        self.assertEqual(generate_mapfile.call_count, 2)
+        self.assertEqual(FlakyStore.listens, 2)
+
+        with self.assertRaises(ValueError):
+            watch_mapfiles('store', debounce=0)
+
+    def test_publish_mapfile_version(self):
+        """test mapfile directory versions are swapped atomically"""
+
+        with tempfile.TemporaryDirectory() as basedir:
+            mapfile_dir = os.path.join(basedir, 'mapfile')
+            os.makedirs(mapfile_dir)
+            with open(os.path.join(mapfile_dir, 'caps.xml'), 'w') as fh:
+                fh.write('<caps/>')
+
+            for i in range(4):
+                version_dir = new_mapfile_version(basedir)
+                atomic_write(os.path.join(version_dir, 'test.map'), str(i))
+                publish_mapfile_version(basedir, version_dir, keep=1)
+
+            self.assertTrue(os.path.islink(mapfile_dir))
+            self.assertEqual(sorted(os.listdir(mapfile_dir)),
+                             ['caps.xml', 'test.map'])
+            with open(os.path.join(mapfile_dir, 'test.map')) as fh:
+                self.assertEqual(fh.read(), '3')
+            self.assertEqual(
+                len(os.listdir(os.path.join(basedir, 'mapfile-versions'))), 2)
+
+            # partial generations wait for entire generations to publish
+            # their version, and do not wait for each other
+            events = []
+
+            def partial_generation():
+                with mapfile_lock(basedir, shared=True):
+                    events.append('partial')
+
+            with mapfile_lock(basedir):
+                with ThreadPoolExecutor(2) as executor:
+                    futures = [executor.submit(partial_generation)
+                               for _ in range(2)]
+                    time.sleep(0.05)
+                    events.append('published')
+            for future in futures:
+                future.result()
+
+            self.assertEqual(events, ['published', 'partial', 'partial'])
+
+            with mapfile_lock(basedir, shared=True):
+                with ThreadPoolExecutor(1) as executor:
+                    executor.submit(partial_generation).result(timeout=1)
+
+    def test_store_snapshots(self):
+        """test store snapshots are published and garbage collected"""
+
+        store = Store()
+        store.set_key('GDPS.ETA_TT_mapfile', 'legacy')
+
+        self.assertEqual(current_generation(store), (None, 0))
+
+        for i in range(3):
+            generation = publish_snapshot(store, {'GDPS.ETA_TT_mapfile': i})
+        update_snapshot(store, {'GDPS.ETA_TT_mapfile': 'updated'})
+
+        self.assertEqual(current_generation(store), (3, 4))
+        self.assertEqual(
+            store.get_key(versioned_key('GDPS.ETA_TT_mapfile', generation)),
+            'updated')
+        self.assertEqual(sorted(store.list_keys('geomet-mapfile_GDPS*')),
+                         ['geomet-mapfile_GDPS.ETA_TT_mapfile@2',
+                          'geomet-mapfile_GDPS.ETA_TT_mapfile@2#version',
+                          'geomet-mapfile_GDPS.ETA_TT_mapfile@3',
+                          'geomet-mapfile_GDPS.ETA_TT_mapfile@3#version'])
+        self.assertEqual(
+            store.get_key(version_key('GDPS.ETA_TT_mapfile', generation)),
+            content_version('updated'))
+        # old generations are deleted through their tracked keys
+        self.assertEqual(store.get_key('generation_1_keys'), None)
+        self.assertEqual(store.get_key('generation_3_keys'),
+                         {'GDPS.ETA_TT_mapfile@3',
+                          'GDPS.ETA_TT_mapfile@3#version'})
+        self.assertIsNone(store.get_key('generation_lock'))
+
+        # updates of a replaced generation are not written
+        publish_snapshot(store, {'GDPS.ETA_TT_mapfile': 'new'})
+        self.assertEqual(
+            update_snapshot(store, {'GDPS.ETA_TT_mapfile': 'stale'}, 3), 4)
+        self.assertEqual(store.get_key('GDPS.ETA_TT_mapfile@4'), 'new')
+
+        # updates racing a publication are written to the new generation
+        set_keys = store.set_keys
+
+        def racing_set_keys(values, raw=False):
+            if 'GDPS.ETA_TT_mapfile@4' in values:
+                store.set_key('current', 5)
+            return set_keys(values, raw)
+
+        with patch.object(store, 'set_keys', side_effect=racing_set_keys), \
+                patch.object(store, 'set_key_nx', return_value=False), \
+                patch('geomet_mapfile.snapshot.LOCK_TIMEOUT', 0):
+            self.assertEqual(
+                update_snapshot(store, {'GDPS.ETA_TT_mapfile': 'raced'}), 5)
+        self.assertEqual(store.get_key('GDPS.ETA_TT_mapfile@5'), 'raced')
+
+        # generations beyond a gap left by an interrupted publication
+        store = Store()
+        for generation in [1, 3, 4]:
+            write_generation(store, {'GDPS.ETA_TT_mapfile': 'MAP END'},
+                             generation)
+        self.assertEqual(delete_old_generations(store, 4), 2)
+        self.assertIsNone(store.get_key('GDPS.ETA_TT_mapfile@1'))
+        self.assertEqual(store.get_key('GDPS.ETA_TT_mapfile@3'), 'MAP END')
+
+    def test_store_mapfile_cache(self):
+        """test store mapfiles are cached per store generation and content"""
+
+        store = Store()
+        write_generation(store, {'GDPS.ETA_TT_mapfile': 'MAP END',
+                                 'RDPS_mapfile': 'MAP NAME "r" END'}, 1)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = StoreMapfileCache(cache_dir)
+            generation_dir = os.path.join(cache_dir, '1')
+
+            filepath = cache.get(store, 'GDPS.ETA_TT_mapfile', 1, 1)
+            with open(filepath) as fh:
+                self.assertEqual(fh.read(), 'MAP END')
+            rdps = cache.get(store, 'RDPS_mapfile', 1, 1)
+            self.assertIsNone(cache.get(store, 'HRDPS_mapfile', 1, 1))
+            self.assertEqual(len(os.listdir(generation_dir)), 2)
+
+            # a write only invalidates the mapfiles it changed
+            write_generation(
+                store, {'GDPS.ETA_TT_mapfile': 'MAP NAME "a" END'}, 1)
+            self.assertEqual(cache.get(store, 'RDPS_mapfile', 1, 2), rdps)
+            updated = cache.get(store, 'GDPS.ETA_TT_mapfile', 1, 2)
+            self.assertNotEqual(updated, filepath)
+            with open(updated) as fh:
+                self.assertEqual(fh.read(), 'MAP NAME "a" END')
+
+            # superseded versions are kept for readers, lock files removed
+            self.assertTrue(os.path.exists(filepath))
+            self.assertEqual(len(os.listdir(generation_dir)), 3)
+
+            # an evicted file is fetched again
+            os.remove(updated)
+            self.assertEqual(cache.get(store, 'GDPS.ETA_TT_mapfile', 1, 2),
+                             updated)
+
+            with patch('geomet_mapfile.cache.STORE_MAPFILE_CACHE_GRACE', 0):
+                write_generation(
+                    store, {'GDPS.ETA_TT_mapfile': 'MAP NAME "b" END'}, 1)
+                cache.get(store, 'GDPS.ETA_TT_mapfile', 1, 3)
+                self.assertFalse(os.path.exists(filepath))
+                self.assertTrue(os.path.exists(updated))
+
+                for generation in range(2, 5):
+                    write_generation(store, {'RDPS_mapfile': 'MAP END'},
+                                     generation)
+                    cache.get(store, 'RDPS_mapfile', generation, 1)
+
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['3', '4'])
+            self.assertEqual(cache.cached(4), 1)
+            self.assertEqual(cache.cached(1), 0)
+
+    def test_mapfile_version(self):
+        """test mapfile versions are known without reading mapfiles"""
+
+        with tempfile.TemporaryDirectory() as basedir:
+            filepath = os.path.join(basedir, 'geomet-weather.map')
+            atomic_write(filepath, 'MAP END')
+
+            self.assertEqual(mapfile_version(filepath),
+                             str(os.path.getmtime(filepath)))
+            # cached store mapfile paths include their content version
+            self.assertEqual(mapfile_version(filepath, '3.7'), filepath)
+            self.assertEqual(mapfile_version('MAP END', '3.7'), '3.7')
+
+    def test_load_evicted_mapfile(self):
+        """test cached store mapfiles evicted before loading are fetched"""
+
+        class MapServerError(Exception):
+            pass
+
+        mapscript = MagicMock(MapServerError=MapServerError)
+        mapscript.mapObj.side_effect = [MapServerError, 'map']
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('geomet_mapfile.wsgi.mapscript', mapscript):
+            evicted = os.path.join(cache_dir, 'evicted.map')
+            cached = os.path.join(cache_dir, 'cached.map')
+            atomic_write(cached, 'MAP END')
+
+            self.assertEqual(load_mapfile(evicted, lambda: cached),
+                             (cached, 'map'))
+            mapscript.mapObj.assert_called_with(cached)
+
+            mapscript.fromstring.return_value = 'map'
+            self.assertEqual(load_mapfile('MAP END'), ('MAP END', 'map'))
+
+    def test_streamed_response(self):
+        """test large responses are streamed in chunks"""
+
+        content = os.urandom(2500)
+        start_response = MagicMock()
+
+        with patch('geomet_mapfile.wsgi.mapscript'), \
+                patch('geomet_mapfile.wsgi.STREAMING_CHUNK_SIZE', 1000):
+            response = stream_response(
+                {}, start_response, [('Content-Type', 'image/tiff')],
+                content, 'GDPS.ETA_TT')
+        chunks = list(response)
+        response.close()
+
+        self.assertEqual([len(chunk) for chunk in chunks], [1000, 1000, 500])
+        self.assertEqual(b''.join(chunks), content)
+        self.assertTrue(response.fh.closed)
+        start_response.assert_called_once_with('200 OK', [
+            ('Content-Type', 'image/tiff'),
+            ('Content-Length', '2500'),
+            ('Content-Disposition',
+             'attachment; filename="GDPS.ETA_TT.tif"')
+        ])
+
+    def test_admission_controller(self):
+        """test concurrent renders are capped per layer and per request"""
+
+        with tempfile.TemporaryDirectory() as lock_dir:
+            admission = AdmissionController(
+                lock_dir, max_renders=2,
+                max_renders_per_request={'GetMap': 1},
+                timeout=0.05)
+
+            self.assertEqual(admission.limits('GetMap', ['GDPS.ETA_TT']),
+                             [('request-GetMap', 1), ('render', 2)])
+
+            with admission.admit('GetMap', ['GDPS.ETA_TT']):
+                self.assertEqual(admission.active, 1)
+                with self.assertRaises(AdmissionTimeout):
+                    with admission.admit('GetMap', ['RDPS.ETA_TT']):
+                        pass
+                with admission.admit('GetFeatureInfo', ['GDPS.ETA_TT']):
+                    with self.assertRaises(AdmissionTimeout):
+                        with admission.admit('GetFeatureInfo'):
+                            pass
+
+            with admission.admit('GetMap'):
+                pass
+
+            self.assertEqual((admission.active, admission.queued), (0, 0))
+
+    def test_single_flight(self):
+        """test identical concurrent renders are collapsed"""
+
+        calls = []
+
+        def render():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'image/png', b'PNG'
+
+        flights = SingleFlight()
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(flights.do, 'key', render)
+                       for _ in range(4)]
+            time.sleep(0.05)
+            self.assertEqual(flights.in_flight(), 1)
+            results = [future.result() for future in futures]
+
+        self.assertEqual(results, [('image/png', b'PNG')] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.in_flight(), 0)
+
+        # render in flight in another worker
+        store = Store()
+        store.set_key_nx('flight_key', 1)
+
+        def finish_remote_render():
+            time.sleep(0.05)
+            store.set_key('flight_key_result',
+                          encode_result(('image/png', b'REMOTE')))
+            store.delete_key('flight_key')
+
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(finish_remote_render)
+            result = SingleFlight(store).do('key', render)
+
+        self.assertEqual(result, ('image/png', b'REMOTE'))
+        self.assertEqual(len(calls), 1)
+
+        # store errors after rendering do not fail the render
+        store = Store()
+        store.set_key_nx = MagicMock(return_value=True)
+        store.set_key = MagicMock(side_effect=ConnectionError('store down'))
+        store.delete_key = MagicMock(side_effect=ConnectionError('down'))
+
+        self.assertEqual(SingleFlight(store).do('key', render),
+                         ('image/png', b'PNG'))
+        self.assertEqual(len(calls), 2)
+
+    def test_legend_cache(self):
+        """test pre-rendered legends are shared by layers of same style"""
+
+        classes = [{'__type__': 'class', 'group': 'TEMPERATURE'},
+                   {'__type__': 'class', 'group': 'TEMPERATURE'},
+                   {'__type__': 'class', 'group': 'TEMPERATURE-LINEAR'}]
+
+        self.assertEqual(legend_styles(classes),
+                         ['TEMPERATURE', 'TEMPERATURE-LINEAR'])
+        self.assertEqual(legend_key({'type': 'raster'}, classes),
+                         legend_key({}, classes))
+        self.assertNotEqual(legend_key({'type': 'point'}, classes),
+                            legend_key({}, classes))
+
+        key = legend_key({}, classes)
+        filename = legend_filename(None, 'fr', 'image/png')
+        self.assertEqual(filename, 'default_fr.png')
+
+        with tempfile.TemporaryDirectory() as legend_dir:
+            os.makedirs(os.path.join(legend_dir, key))
+            os.makedirs(os.path.join(legend_dir, 'stale'))
+            with open(os.path.join(legend_dir, key, filename), 'wb') as fh:
+                fh.write(b'PNG')
+            write_legend_index(
+                legend_dir,
+                {'GDPS.ETA_TT': key, 'RDPS.ETA_TT': key},
+                {key: {filename: 'image/png'}})
+
+            self.assertEqual(sorted(os.listdir(legend_dir)),
+                             [key, 'legends.json'])
+
+            cache = LegendCache(legend_dir)
+            self.assertEqual(cache.get('RDPS.ETA_TT', '', 'image/png', 'fr'),
+                             ('image/png', b'PNG'))
+            self.assertIsNone(cache.get('RDPS.ETA_TT', None, 'image/png',
+                                        'en'))
+            self.assertIsNone(cache.get('HRDPS.CONTINENTAL_TT', None,
+                                        'image/png', 'fr'))
+
+    def test_feature_info(self):
+        """test GetFeatureInfo point sampling helpers"""
+
+        expression = compile_expression(
+            '( ( ([pixel] * (10 ^ 3)) >= 5 ) AND ( [pixel] < 0.01 ) )')
+        self.assertTrue(expression(0.005))
+        self.assertFalse(expression(0.004))
+        self.assertTrue(compile_expression('( [pixel] = 2 )')(2))
+
+        for unsupported in ['( [uv_length] < 5 )', '( __import__("os") )']:
+            with self.assertRaises(FeatureInfoUnsupported):
+                compile_expression(unsupported)
+
+        classes = compile_classes([
+            ('0 5', 'TT', '( [pixel] < 5 )', (0, 0, 143)),
+            ('5 10', 'TT', '( ( [pixel] >= 5 ) AND ( [pixel] < 10 ) )',
+             (0, 0, 223)),
+            ('0 5', 'TT-LINEAR', '( [pixel] < 5 )', (1, 1, 1))
+        ], 'TT')
+        self.assertEqual(classify(7.5, classes), ('5 10', (0, 0, 223)))
+        self.assertIsNone(classify(12, classes))
+
+        # WMS 1.3.0 EPSG:4326 BBOX is in lat/lon order
+        x, y, crs = request_point({
+            'VERSION': '1.3.0', 'CRS': 'EPSG:4326', 'BBOX': '40,-80,50,-70',
+            'WIDTH': '10', 'HEIGHT': '10', 'I': '0', 'J': '9'})
+        self.assertEqual((x, y, crs), (-79.5, 40.5, 'EPSG:4326'))
+
+        items = format_items(-79.5, 40.5, [7.5], classify(7.5, classes))
+        content_type, content = format_response('GDPS.ETA_TT', items,
+                                                'text/plain')
+        self.assertEqual(content_type, 'text/plain; charset=UTF-8')
+        self.assertEqual(content.decode().splitlines(), [
+            'GetFeatureInfo results:', '', "Layer 'GDPS.ETA_TT'",
+            '  Feature 0: ', "    x = '-79.5'", "    y = '40.5'",
+            "    value_0 = '7.5'", "    value_list = '7.5'",
+            "    class = '5 10'", "    red = '0'", "    green = '0'",
+            "    blue = '223'"])
+
+        _, content = format_response('GDPS.ETA_TT', None, 'application/json')
+        self.assertEqual(json.loads(content)['features'], [])
+
+        # coordinate transformations are not shared between threads
+        with patch('geomet_mapfile.featureinfo.osr') as mock_osr:
+            mock_osr.SpatialReference.return_value.SetFromUserInput \
+                .return_value = 0
+            mock_osr.CoordinateTransformation.side_effect = \
+                lambda *args: MagicMock()
+            ct = transform('EPSG:3857', 'EPSG:4326')
+            self.assertIs(transform('EPSG:3857', 'EPSG:4326'), ct)
+            with ThreadPoolExecutor(1) as executor:
+                ct_ = executor.submit(transform, 'EPSG:3857',
+                                      'EPSG:4326').result()
+            self.assertIsNot(ct_, ct)
+            self.assertIsNone(transform('EPSG:4326', 'EPSG:4326'))
+
+    def test_time_series_times(self):
+        """test expansion of time series GetFeatureInfo TIME values"""
+
+        extent = '2020-01-14T00:00:00Z/2020-01-24T00:00:00Z/PT3H'
+
+        self.assertFalse(is_time_series('2020-01-14T00:00:00Z'))
+        self.assertTrue(is_time_series(extent))
+
+        self.assertEqual(
+            expand_times('2020-01-14T02:00:00Z/2020-01-14T09:00:00Z',
+                         extent),
+            ['2020-01-14T03:00:00Z', '2020-01-14T06:00:00Z',
+             '2020-01-14T09:00:00Z'])
+        self.assertEqual(
+            expand_times('2020-01-14T00:00:00Z/2020-01-15T00:00:00Z/P1D'),
+            ['2020-01-14T00:00:00Z', '2020-01-15T00:00:00Z'])
+        self.assertEqual(
+            expand_times('2020-01-14T00:00:00Z/2020-01-15T00:00:00Z',
+                         extent, '2020-01-13T00:00:00Z,2020-01-14T12:00:00Z'),
+            ['2020-01-14T12:00:00Z'])
+        self.assertEqual(
+            expand_times('2020-01-14T06:00:00Z,2020-01-14T00:00:00Z'),
+            ['2020-01-14T06:00:00Z', '2020-01-14T00:00:00Z'])
+
+        for value in ['2020-01-14T00:00:00Z/2021-01-14T00:00:00Z/PT1M',
+                      '2020-01-14/2020-01-15', '2020-01-15T00:00:00Z/'
+                      '2020-01-14T00:00:00Z/PT1H']:
+            with self.assertRaises(FeatureInfoUnsupported):
+                expand_times(value, extent)
+
+        classes = compile_classes([
+            ('0 5', 'TT', '( [pixel] < 5 )', (0, 0, 143))
+        ])
+        params = {'VERSION': '1.1.1', 'SRS': 'EPSG:4326',
+                  'BBOX': '-80,40,-70,50', 'WIDTH': '10', 'HEIGHT': '10',
+                  'X': '0', 'Y': '9', 'INFO_FORMAT': 'application/json'}
+
+        def sample(filepath, x, y, crs, projection, bands=None):
+            return x, y, [{'a': 2.5, 'b': 7.5}[filepath]]
+
+        with patch('geomet_mapfile.featureinfo.gdal'), \
+                patch('geomet_mapfile.featureinfo.sample',
+                      side_effect=sample) as mock_sample:
+            _, content = time_series(
+                'GDPS.ETA_TT', ['2020-01-14T00:00:00Z',
+                                '2020-01-14T03:00:00Z',
+                                '2020-01-14T06:00:00Z'],
+                ['a', 'b', None], 'EPSG:4326', classes, params)
+
+        # files are sampled in the raster CRS
+        self.assertEqual(mock_sample.call_args[0][3:5],
+                         ('EPSG:4326', 'EPSG:4326'))
+        # values which do not match any class are dropped, as by
+        # feature_info
+        self.assertEqual(
+            [(item['value'], item['class'])
+             for item in json.loads(content)['series']],
+            [(2.5, '0 5'), (None, None), (None, None)])
+
+    def test_tileindex_replica(self):
+        """test incremental sync and lookups of the tile index replica"""
+
+        def tile(identifier, fh, registered, expiry='2999-01-01T00:00:00Z'):
+            return {
+                'type': 'Feature',
+                'geometry': None,
+                'properties': {
+                    'identifier': identifier,
+                    'layer': 'GDPS.ETA_TT',
+                    'filepath': '/data/{}.grib2'.format(identifier),
+                    'url': None,
+                    'reference_datetime': '2020-01-14T00:00:00Z',
+                    'forecast_hour_datetime': fh,
+                    'register_datetime': registered,
+                    'expiry_datetime': expiry
+                }
+            }
+
+        class SourceTileIndex:
+            name = 'geomet-data-registry'
+
+            def __init__(self, features):
+                self.features = features
+                self.lookups = 0
+
+            def registered_since(self, datetime_):
+                return [feature for feature in self.features
+                        if feature['properties']['register_datetime'] >=
+                        datetime_]
+
+            def get_many(self, identifiers):
+                self.lookups += len(identifiers)
+                features = {f['properties']['identifier']: f
+                            for f in self.features}
+                return {id_: features.get(id_) for id_ in identifiers}
+
+        source = SourceTileIndex([
+            tile('GDPS.ETA_TT-20200114000000-20200114000000',
+                 '2020-01-14T00:00:00Z', '2020-01-14T00:00:00.000Z'),
+            tile('GDPS.ETA_TT-20200114000000-20200114030000',
+                 '2020-01-14T03:00:00Z', '2020-01-14T01:01:00.000Z'),
+            tile('GDPS.ETA_TT-20200113000000-20200113000000',
+                 '2020-01-13T00:00:00Z', '2020-01-13T03:00:00.000Z',
+                 expiry='2020-01-14T00:00:00.000Z')
+        ])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filepath = os.path.join(tmp, 'tileindex.db')
+            replica = SQLiteTileIndex({'type': 'SQLite', 'url': filepath,
+                                       'name': 'geomet-data-registry'})
+
+            self.assertEqual(sync_replica(source, replica), 3)
+            self.assertEqual(replica.get_state('register_datetime'),
+                             '2020-01-14T01:01:00.000Z')
+            # expired tiles are not kept
+            self.assertEqual(len(replica.query_layer('GDPS.ETA_TT')), 2)
+
+            source.features.append(
+                tile('GDPS.ETA_TT-20200114000000-20200114060000',
+                     '2020-01-14T06:00:00Z', '2020-01-14T04:00:00.000Z'))
+            # only tiles registered since the checkpoint (minus the sync
+            # margin) are replicated
+            self.assertEqual(sync_replica(source, replica), 2)
+
+            features = replica.query_layer(
+                'GDPS.ETA_TT', '2020-01-14T00:00:00Z',
+                '2020-01-14T03:00:00Z', '2020-01-14T06:00:00Z')
+            self.assertEqual(
+                [f['properties']['forecast_hour_datetime']
+                 for f in features],
+                ['2020-01-14T03:00:00Z', '2020-01-14T06:00:00Z'])
+
+            ti = ReplicatedTileIndex({'type': 'Elasticsearch',
+                                      'name': 'geomet-data-registry'},
+                                     filepath)
+            ti._source = source
+            source.features.append(
+                tile('GDPS.ETA_TT-20200114000000-20200114090000',
+                     '2020-01-14T09:00:00Z', '2020-01-14T05:00:00.000Z'))
+
+            docs = ti.get_many([
+                'GDPS.ETA_TT-20200114000000-20200114060000',
+                'GDPS.ETA_TT-20200114000000-20200114090000',
+                'GDPS.ETA_TT-20200114000000-20200114120000'
+            ])
+            self.assertEqual(
+                docs['GDPS.ETA_TT-20200114000000-20200114060000']
+                ['properties']['filepath'],
+                '/data/GDPS.ETA_TT-20200114000000-20200114060000.grib2')
+            # not yet replicated tiles are looked up in the source
+            self.assertIsNotNone(
+                docs['GDPS.ETA_TT-20200114000000-20200114090000'])
+            self.assertIsNone(
+                docs['GDPS.ETA_TT-20200114000000-20200114120000'])
+            self.assertEqual(source.lookups, 2)
+
+    def test_sqlite_store(self):
+        """test embedded SQLite store plugin"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            st = load_plugin('store', {
+                'type': 'SQLite',
+                'url': 'sqlite://{}'.format(os.path.join(tmp, 'store.db'))
+            })
+            self.assertIsInstance(st, SQLiteStore)
+
+            st.set_key('GDPS.ETA_TT_en', 'MAP END')
+            st.set_keys({'geomet-data-registry_GDPS.ETA_TT_default_time':
+                         '2020-01-14T00:00:00Z'}, raw=True)
+            self.assertEqual(
+                st.get_keys(['GDPS.ETA_TT_en', 'GDPS.ETA_TT_fr']),
+                {'GDPS.ETA_TT_en': 'MAP END', 'GDPS.ETA_TT_fr': None})
+            self.assertEqual(
+                st.list_keys('geomet-data-registry_*'),
+                ['geomet-data-registry_GDPS.ETA_TT_default_time'])
+
+            self.assertEqual(st.incr_key('generation'), 1)
+            self.assertEqual(st.incr_key('generation'), 2)
+            self.assertEqual(st.get_key('generation'), '2')
+
+            self.assertTrue(st.set_key_nx('lock', 1, expire=0.05))
+            self.assertFalse(st.set_key_nx('lock', 1))
+            time.sleep(0.1)
+            self.assertIsNone(st.get_key('lock'))
+            self.assertTrue(st.set_key_nx('lock', 1))
+
+            self.assertEqual(st.add_members('pending', ['a', 'b', 'a']), 2)
+            self.assertEqual(st.pop_members('pending'), {'a', 'b'})
+            self.assertEqual(st.pop_members('pending'), set())
+
+            changes = st.listen_keys(['geomet-mapfile_*_en'], timeout=0)
+            self.assertIsNone(next(changes))
+            st.set_key('GDPS.ETA_TT_fr', 'MAP END')
+            st.set_key('GDPS.ETA_TT_en', 'MAP END')
+            self.assertEqual(next(changes), 'geomet-mapfile_GDPS.ETA_TT_en')
+            self.assertIsNone(next(changes))
+
+            self.assertEqual(st.delete_keys(['GDPS.ETA_TT_en', 'lock']), 2)
+            self.assertTrue(st.teardown())
+            self.assertEqual(
+                st.list_keys(),
+                ['geomet-data-registry_GDPS.ETA_TT_default_time'])
+
+    @patch('geomet_mapfile.dataset.gdal')
+    def test_dataset_cache(self, mock_gdal):
+        """test cache of opened GDAL datasets"""
+
+        mock_gdal.Open.side_effect = lambda filepath: MagicMock()
+        mock_gdal.OpenShared.side_effect = lambda filepath: MagicMock()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filepaths = [os.path.join(tmp, '{}.grib2'.format(i))
+                         for i in range(3)]
+            for filepath in filepaths:
+                atomic_write(filepath, b'GRIB')
+
+            counters = METRICS.snapshot()['counters']
+            hits = counters.get('dataset_cache.hits', 0)
+            misses = counters.get('dataset_cache.misses', 0)
+
+            datasets = DatasetCache(size=2)
+            with datasets.open(filepaths[0]) as first:
+                pass
+            with datasets.open(filepaths[0]) as dataset:
+                self.assertIs(dataset, first)
+            self.assertEqual(mock_gdal.Open.call_count, 1)
+
+            # replaced files are reopened
+            os.utime(filepaths[0], ns=(0, 0))
+            with datasets.open(filepaths[0]) as dataset:
+                self.assertIsNot(dataset, first)
+            self.assertEqual(len(datasets._datasets), 1)
+
+            # least recently used datasets are closed
+            for filepath in filepaths:
+                datasets.hold(filepath)
+            self.assertEqual([key[0] for key in datasets._datasets],
+                             filepaths[1:])
+
+            counters = METRICS.snapshot()['counters']
+            self.assertEqual(counters['dataset_cache.hits'] - hits, 2)
+            self.assertEqual(counters['dataset_cache.misses'] - misses, 4)
+
+            # shared datasets are cached per thread
+            held = ThreadDatasetCache(size=2)
+            self.assertTrue(held.hold(filepaths[0]))
+            with ThreadPoolExecutor(1) as executor:
+                executor.submit(held.hold, filepaths[0]).result()
+            self.assertEqual(mock_gdal.OpenShared.call_count, 2)
+
+            mock_gdal.OpenShared.side_effect = lambda filepath: None
+            self.assertFalse(held.hold(filepaths[2]))
+
+    def test_data_optimizer(self):
+        """test mapping of data files to their optimized copies"""
+
+        self.assertEqual(overview_levels(2576, 1456), [2, 4, 8])
+        self.assertEqual(overview_levels(200, 100), [])
+
+        def convert(filepath, target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            atomic_write(target, b'TIFF')
+            stat = os.stat(filepath)
+            os.utime(target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            return True
+
+        def wait(optimizer):
+            while optimizer._pending:
+                time.sleep(0.01)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filepath = os.path.join(tmp, 'model_gem_global', 'grib2',
+                                    'CMC_glb_TMP_TGL_2_latlon.15x.15.grib2')
+            os.makedirs(os.path.dirname(filepath))
+            atomic_write(filepath, b'GRIB')
+
+            optimizer = DataOptimizer(os.path.join(tmp, 'optimized'))
+            optimized = optimizer.path(filepath)
+            self.assertEqual(optimized, os.path.join(
+                tmp, 'optimized', filepath.lstrip(os.sep) + '.tif'))
+
+            with patch('geomet_mapfile.optimize.convert',
+                       side_effect=convert) as mock_convert:
+                # first render uses the data file, while it is converted
+                self.assertEqual(optimizer.resolve(filepath), filepath)
+                wait(optimizer)
+                self.assertEqual(optimizer.resolve(filepath), optimized)
+                self.assertEqual(mock_convert.call_count, 1)
+
+                # replaced data files are not rendered from stale copies
+                os.utime(filepath, ns=(0, 0))
+                self.assertEqual(optimizer.resolve(filepath), filepath)
+                wait(optimizer)
+                self.assertEqual(mock_convert.call_count, 2)
+
+                netcdf = os.path.join(tmp, 'data.nc')
+                self.assertEqual(optimizer.resolve(netcdf), netcdf)
+
+            # warp grids are not optimized copies
+            grid = os.path.join(tmp, 'optimized', 'grids', 'ab', 'abcd.npz')
+            os.makedirs(os.path.dirname(grid))
+            atomic_write(grid, b'NPZ')
+
+            self.assertEqual(optimizer.prune(), 0)
+            os.remove(filepath)
+            self.assertEqual(optimizer.prune(), 1)
+            self.assertFalse(os.path.exists(optimized))
+            self.assertTrue(os.path.exists(grid))
+
+    def test_prewarp(self):
+        """test warp grids of requested map extents"""
+
+        gdps = '+proj=longlat +lon_wrap=0 +R=6371229 +no_defs'
+        geotransform = (-0.075, 0.15, 0, 90.075, 0, -0.15)
+        bounds = (0.0, 0.0, 20037508.342789244, 20037508.342789244)
+
+        query_string = ('SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap'
+                        '&CRS=EPSG:4326&BBOX=0,-90,90,0'
+                        '&WIDTH=256&HEIGHT=256&FORMAT=image/png')
+        self.assertEqual(warp_extent(query_string),
+                         ('EPSG:4326', (-90.0, 0.0, 0.0, 90.0), 256, 256))
+        self.assertEqual(
+            warp_extent(query_string.replace('1.3.0', '1.1.1'))[1],
+            (0.0, -90.0, 90.0, 0.0))
+        self.assertIsNone(
+            warp_extent(query_string.replace('EPSG:4326', 'EPSG:2960')))
+
+        # warp grids are shared by all files of a grid, per map extent
+        key = grid_key(gdps, geotransform, 2400, 1201, 'EPSG:3857', bounds,
+                       (256, 256))
+        self.assertEqual(key, grid_key(gdps, list(geotransform), 2400, 1201,
+                                       'EPSG:3857', list(bounds), [256, 256]))
+        self.assertNotEqual(key, grid_key(gdps, geotransform, 2400, 1201,
+                                          'EPSG:3857', bounds, (512, 512)))
+
+        self.assertEqual(optimized_source('data/file.grib2.tif'),
+                         'data/file.grib2')
+
+        # least recently used warp grids are evicted beyond the disk size
+        with tempfile.TemporaryDirectory() as tmp:
+            grids = WarpGridCache(tmp, 20)
+            for i, key in enumerate(['aa01', 'ab02', 'ac03']):
+                filepath = os.path.join(tmp, key[:2], key + '.npz')
+                os.makedirs(os.path.dirname(filepath))
+                atomic_write(filepath, b'0123456789')
+                os.utime(filepath, (i, i))
+
+            self.assertEqual(grids.evict(), 1)
+            self.assertFalse(os.path.exists(
+                os.path.join(tmp, 'aa', 'aa01.npz')))
+            self.assertEqual(grids.evict(), 0)
+
+    @unittest.skipIf(np is None, 'numpy not installed')
+    def test_warp_array(self):
+        """test data is warped from the source window of a warp grid"""
+
+        # 2x3 map from a 4x5 source grid, with a pixel outside of it
+        index = np.array([[6, 7, NODATA_INDEX], [11, 12, 18]],
+                         dtype=np.uint32)
+        window, window_index = grid_window(index, 5)
+
+        self.assertEqual(window, (1, 1, 3, 3))
+        grid = {'grid': window_index, 'window': window}
+
+        data = np.arange(20, dtype=np.float32).reshape(4, 5)
+        xoff, yoff, xsize, ysize = window
+        warped = warp_array(data[yoff:yoff + ysize, xoff:xoff + xsize],
+                            grid, -1)
+
+        # single lookup of the nearest source pixel of each map pixel
+        self.assertEqual(warped.tolist(), [[6, 7, -1], [11, 12, 18]])
+
+        window, window_index = grid_window(
+            np.full((2, 2), NODATA_INDEX, dtype=np.uint32), 5)
+        self.assertIsNone(window)
+        self.assertEqual(warp_array(data[:1, :1], {'grid': window_index,
+                                                   'window': None},
+                                    -1).tolist(), [[-1, -1], [-1, -1]])
+
+    def test_tileindex_guard(self):
+        """test circuit breaker and stale fallback of tile index lookups"""
+
+        class FlakyTileIndex:
+            def __init__(self):
+                self.down = False
+                self.lookups = 0
+
+            def get(self, identifier):
+                self.lookups += 1
+                if self.down:
+                    raise ConnectionError('tile index timed out')
+                if identifier.endswith('missing'):
+                    raise TileNotFoundError(identifier)
+                return {'properties': {'filepath': identifier + '.grib2',
+                                       'url': None}}
+
+        breaker = CircuitBreaker('test_tileindex', 2, reset_timeout=0.05)
+        METRICS.gauge('test_tileindex.breaker_open', 0)
+        source = FlakyTileIndex()
+        ti = GuardedTileIndex(lambda: source, breaker, stale_size=2)
+
+        self.assertEqual(ti.get('a')['properties']['filepath'], 'a.grib2')
+        with self.assertRaises(TileNotFoundError):
+            ti.get('missing')
+        # not found documents are not failures of the tile index
+        self.assertEqual(breaker.state, CLOSED)
+
+        source.down = True
+        # last known documents are served while the tile index is down
+        self.assertEqual(ti.get('a')['properties']['filepath'], 'a.grib2')
+        with self.assertRaises(TileIndexUnavailable):
+            ti.get('b')
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(
+            METRICS.snapshot()['gauges']['test_tileindex.breaker_open'], 1)
+
+        # the open circuit fails fast, without tile index lookups
+        lookups = source.lookups
+        docs = ti.get_many(['a', 'b'])
+        self.assertEqual(docs['a']['properties']['filepath'], 'a.grib2')
+        self.assertIsNone(docs['b'])
+        self.assertEqual(source.lookups, lookups)
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(source.get, 'a')
+
+        # a failed trial call opens the circuit again
+        time.sleep(0.06)
+        with self.assertRaises(TileIndexUnavailable):
+            ti.get('b')
+        self.assertEqual(breaker.state, OPEN)
+
+        # a successful trial call closes the circuit
+        source.down = False
+        time.sleep(0.06)
+        self.assertEqual(ti.get('b')['properties']['filepath'], 'b.grib2')
+        self.assertEqual(breaker.state, CLOSED)
+
+        # load failures count as tile index failures, and known
+        # documents are served while another thread loads the tile index
+        loading = threading.Event()
+
+        def load():
+            if not loading.is_set():
+                raise ConnectionError('Cannot connect to Elasticsearch')
+            time.sleep(0.2)
+            return source
+
+        breaker = CircuitBreaker('test_tileindex', 2, reset_timeout=60)
+        ti = GuardedTileIndex(load, breaker, stale_size=2, load_timeout=0.01)
+        ti._remember('a', {'properties': {'filepath': 'a.grib2'}})
+        self.assertEqual(ti.get('a')['properties']['filepath'], 'a.grib2')
+        self.assertEqual(breaker.failures, 1)
+
+        loading.set()
+        with ThreadPoolExecutor(1) as executor:
+            loaded = executor.submit(ti.get, 'b')
+            time.sleep(0.05)
+            start = time.monotonic()
+            self.assertEqual(ti.get('a')['properties']['filepath'],
+                             'a.grib2')
+            self.assertLess(time.monotonic() - start, 0.1)
+            self.assertEqual(loaded.result()['properties']['filepath'],
+                             'b.grib2')
+
+        # stale-while-revalidate serves known documents without waiting
+        # for the tile index, and refreshes them in the background
+        ti = GuardedTileIndex(lambda: source, stale_size=2, stale_ttl=0.05)
+        ti.get('a')
+        lookups = source.lookups
+        ti.get('a')
+        self.assertEqual(source.lookups, lookups)
+        time.sleep(0.06)
+        ti.get('a')
+        ti._executor.shutdown(wait=True)
+        self.assertEqual(source.lookups, lookups + 1)
+
+    def test_readiness(self):
+        """test readiness checks and reuse of readiness reports"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            version_dir = os.path.join(tmp, 'mapfile-versions',
+                                       '20200114T000000000000')
+            os.makedirs(version_dir)
+            os.symlink(version_dir, os.path.join(tmp, 'mapfile'))
+
+            st = load_plugin('store', {
+                'type': 'SQLite',
+                'url': 'sqlite://{}'.format(os.path.join(tmp, 'store.db'))
+            })
+            publish_snapshot(st, {'GDPS.ETA_TT_mapfile': 'MAP END'})
+
+            class DownTileIndex:
+                def get(self, identifier):
+                    raise ConnectionError('tile index timed out')
+
+            breaker = CircuitBreaker('test_readiness', 1, reset_timeout=60)
+            tileindex = GuardedTileIndex(DownTileIndex, breaker)
+
+            checks = {
+                'mapfiles': lambda: check_mapfiles(
+                    os.path.join(tmp, 'mapfile')),
+                'store': lambda: check_store(st),
+                'tileindex': lambda: check_tileindex(tileindex)
+            }
+            ready, degraded, results = run_checks(checks)
+
+            self.assertFalse(ready)
+            self.assertEqual(results['mapfiles']['version'],
+                             '20200114T000000000000')
+            self.assertEqual(results['store']['generation'], 1)
+            self.assertTrue(results['store']['ok'])
+            self.assertIn('latency_ms', results['store'])
+            self.assertFalse(results['tileindex']['ok'])
+            self.assertEqual(breaker.state, OPEN)
+
+            # a tile index with a fallback only degrades readiness
+            ready, degraded, results = run_checks(checks, ['tileindex'])
+            self.assertTrue(ready)
+            self.assertTrue(degraded)
+            self.assertIn('CircuitOpenError', results['tileindex']['error'])
+
+            ready, degraded, results = run_checks({
+                'mapfiles': lambda: check_mapfiles(
+                    os.path.join(tmp, 'missing'))
+            })
+            self.assertFalse(ready)
+            self.assertIn('FileNotFoundError', results['mapfiles']['error'])
+
+        class SlowReport:
+            def __init__(self):
+                self.calls = 0
+
+            def __call__(self):
+                self.calls += 1
+                time.sleep(0.05)
+                return True, {'calls': self.calls}
+
+        report = SlowReport()
+        probe = ReadinessProbe(report, ttl=0.1)
+
+        self.assertEqual(probe.get()[:2], (True, {'calls': 1}))
+        self.assertEqual(probe.get()[1], {'calls': 1})
+
+        # probes arriving during a refresh get the previous report
+        time.sleep(0.1)
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda _: probe.get()[1],
+                                        range(4)))
+        self.assertEqual(report.calls, 2)
+        self.assertIn({'calls': 1}, results)
+
 
 if __name__ == '__main__':
     unittest.main()